@@ -0,0 +1,82 @@
+# Enigmata, an obfuscator for Minecraft Bedrock Editon resource packs.
+# Copyright (C) 2024 github.com/Eric-Joker
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import asyncio
+import itertools
+import os
+from dataclasses import dataclass
+
+from main import async_obf_pack, check_config
+from config import cfg
+from config.base import EnigmataConfig
+from models import vd
+
+
+@dataclass
+class ObfuscationResult:
+    namespace: str
+    work_path: str
+    archive: str | None
+    references: dict[str, dict[str, str]]
+
+
+# Pack-wise options, which also accept a single string for the one-pack case.
+PACK_OPTIONS = (
+    "path",
+    "namespace",
+    "zip_name",
+    "pack_name",
+    "header_uuid",
+    "header_version",
+    "modules_uuid",
+    "modules_version",
+)
+
+
+# `options` are keyed like the command line flags' destinations (namespace, zip_name, image_compress, ...), and "config"
+# may name a YAML file to start from. Console output is off unless asked for, and "progress" may be a callable that
+# receives the same events as the jsonl sink. The vanilla data and worker processes are loaded once and reused across
+# calls; everything else is built per call. Calls share module state, so one that starts while another is still running
+# in the process raises RuntimeError.
+async def async_obfuscate_packs(options: dict) -> list[ObfuscationResult]:
+    options = {k: [v] if k in PACK_OPTIONS and isinstance(v, str) else v for k, v in options.items()}
+    with cfg.use(EnigmataConfig({"console": False, **options})):
+        check_config(cfg)
+        vd.ensure_loaded()
+        results = []
+        for root_path, namespace, zip_name, *manifest in itertools.zip_longest(
+            cfg.path,
+            cfg.namespace,
+            cfg.zip_name,
+            cfg.pack_name,
+            cfg.header_uuid,
+            cfg.header_version,
+            cfg.modules_uuid,
+            cfg.modules_version,
+            fillvalue=None,
+        ):
+            work_path, references = await async_obf_pack(cfg, root_path, namespace, zip_name, *manifest)
+            results.append(
+                ObfuscationResult(namespace, work_path, os.path.join(work_path, zip_name) if zip_name else None, references)
+            )
+        return results
+
+
+async def async_obfuscate_pack(source: str, options: dict = None) -> ObfuscationResult:
+    return (await async_obfuscate_packs({**(options or {}), "path": [source]}))[0]
+
+
+def obfuscate_pack(source: str, options: dict = None) -> ObfuscationResult:
+    return asyncio.run(async_obfuscate_pack(source, options))
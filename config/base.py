@@ -17,12 +17,14 @@ import argparse
 import itertools
 import logging
 import os
+import threading
 import time
+from contextlib import contextmanager
 
 import regex as re
 import yaml
 
-from utils import CustomStrAction, default_read, mkdirs, str2bool
+from utils import CustomStrAction, NameMatcher, default_read, mkdirs, str2bool
 
 CONFIG_FILE = "./config.yaml"
 
@@ -34,6 +36,9 @@ class EnigmataConfig:
     VANILLAS_PATH = ""
     LOG_PATH = ""
     CONSOLE = True
+    PROGRESS = "bar"
+    IO_LIMIT = 16
+    JOBS = 0
     PATH = []
     PACK_NAME = []
     HEADER_UUID = []
@@ -64,7 +69,9 @@ class EnigmataConfig:
     OBF_REFERENCES = ("**/ui/**/*.json", "**/entity/*.json", "**/particles/*.json", "!**/textures/**")
     EXTRAINFO = True
     IMAGE_COMPRESS = 9
+    KEEP_CHUNKS = set()
     PACK_COMPRESS = 9
+    PASSTHROUGH = "clone"
     MTIME = (1989, 8, 10, 11, 45, 14)
     DEBUG = False
     EXCLUDE_JSONS = (
@@ -83,11 +90,32 @@ class EnigmataConfig:
     EXCLUDE_IMAGE_NAMES = set()
     EXCLUDE_JSONUI_NAMES = set()
     EXCLUDE_ENTITY_NAMES = set()
+    _in_use = threading.Lock()
 
-    def __init__(self):
-        self._add_arguments()
+    def __init__(self, options: dict = None, args: list[str] = None):
         self.logger = logging.getLogger(__name__)
-        self.reload(self.args.config.strip("'"))
+        if options is not None or args is not None:
+            self.load(options, args)
+
+    # `args` defaults to the command line. Library callers pass `options` instead, keyed like the flags' destinations,
+    # and a YAML file is only read when they name one with the "config" option.
+    def load(self, options: dict = None, args: list[str] = None):
+        self._add_arguments([] if options is not None and args is None else args)
+        self.reload(self.args.config.strip("'") if options is None else options.get("config"), options)
+
+    # Modules share the `cfg` object, so a call-specific config is swapped into it for the duration.
+    # The name maps, vanilla data, progress and I/O state are process-wide too, so a second swap while one is active, from
+    # another thread, another task or a nested call, is refused instead of mixing two runs.
+    @contextmanager
+    def use(self, other: "EnigmataConfig"):
+        if not EnigmataConfig._in_use.acquire(blocking=False):
+            raise RuntimeError("Another obfuscation is already running in this process; calls must not overlap.")
+        saved, self.__dict__ = self.__dict__, other.__dict__
+        try:
+            yield self
+        finally:
+            self.__dict__ = saved
+            EnigmataConfig._in_use.release()
 
     def __getattr__(self, key: str):
         def traverse(d: dict):
@@ -101,10 +129,16 @@ class EnigmataConfig:
 
         return traverse(vars(self))
 
-    def _add_arguments(self):
+    def _add_arguments(self, args: list[str] = None):
         parser = argparse.ArgumentParser(description="Console parameters will take precedence over configuration files.")
         argsGroup1 = parser.add_argument_group("Common Parameters")
-        argsGroup1.add_argument("--path", "-p", nargs="*", type=str, help="Path to the resource pack to obfuscate.")
+        argsGroup1.add_argument(
+            "--path",
+            "-p",
+            nargs="*",
+            type=str,
+            help="Path to the resource pack to obfuscate, a directory or a .mcpack/.zip archive.",
+        )
         argsGroup1.add_argument(
             "--namespace",
             "-n",
@@ -122,6 +156,12 @@ class EnigmataConfig:
         argsGroup1.add_argument(
             "--extract", "-e", action="store_true", default=None, help="Extracting data from vanillas path."
         )
+        argsGroup1.add_argument(
+            "--watch",
+            action="store_true",
+            default=None,
+            help="Keep running after obfuscation and rebuild a pack's output whenever its files change.",
+        )
         argsGroup1.add_argument("--config", "-c", type=str, default=CONFIG_FILE, help="Path to yaml configuration file.")
         argsGroup1.add_argument("--pack-name", nargs="*", type=str, help="For manifest.json.")
         argsGroup1.add_argument("--header-uuid", nargs="*", type=str, help="For manifest.json.")
@@ -143,7 +183,9 @@ class EnigmataConfig:
         )
         argsGroup2.add_argument("--work-path", "-w", type=str, help="Path to output directory.")
         argsGroup2.add_argument("--data-path", "-d", type=str, help="Path to data directory.")
-        argsGroup2.add_argument("--vanillas-path", "-v", type=str, help="Path to the game's original resource pack.")
+        argsGroup2.add_argument(
+            "--vanillas-path", "-v", type=str, help="The game's resource packs directory, a zip of it, or the APK."
+        )
         argsGroup2.add_argument("--vanilla-data", type=str, help="Specify the path to the extracted vanilla data file.")
         argsGroup2.add_argument(
             "--log-path",
@@ -154,6 +196,20 @@ class EnigmataConfig:
             help="The directory of the log file. If no parameter is passed, the log file will not be written.",
         )
         argsGroup2.add_argument("--console", type=str2bool, help="Console log.")
+        argsGroup2.add_argument(
+            "--progress",
+            choices=("bar", "jsonl"),
+            help="Progress output: a console bar, or one JSON object per line on stdout for build dashboards.",
+        )
+        argsGroup2.add_argument(
+            "--progress-file",
+            type=str,
+            help="Append the jsonl progress to this file instead. Without it, every other console message goes to stderr.",
+        )
+        argsGroup2.add_argument("--io-limit", type=int, help="Maximum number of file operations in flight at once.")
+        argsGroup2.add_argument(
+            "--jobs", "-j", type=int, help="Number of worker processes for per-file transforms. 0 uses every CPU."
+        )
         argsGroup2.add_argument("--debug", type=str2bool)
         argsGroup3 = parser.add_argument_group("Function Options")
         argsGroup3.add_argument(
@@ -231,11 +287,22 @@ class EnigmataConfig:
         argsGroup3.add_argument(
             "--image-compress", type=int, help="Compression level for all PNG, enable TGA compression when >6."
         )
+        argsGroup3.add_argument(
+            "--keep-chunks",
+            nargs="*",
+            type=str,
+            help="Ancillary PNG chunks kept when re-encoding, e.g. iCCP, pHYs, eXIf, tEXt. All others are stripped.",
+        )
         argsGroup3.add_argument(
             "--pack-compress",
             type=int,
             help="The compression level of the zip archive after obfuscation. ",
         )
+        argsGroup3.add_argument(
+            "--passthrough",
+            choices=("copy", "clone", "link", "archive"),
+            help="How unprocessed files reach the output: copy, clone (reflink or in-kernel copy), link (hard link), or archive (only streamed into the zip archive).",
+        )
         argsGroup3.add_argument(
             "--mtime",
             nargs="*",
@@ -266,51 +333,52 @@ class EnigmataConfig:
             type=str,
             help="Key names and names of entity series ID, and molang variable names without obfuscation, escaping, or de-formatting.",
         )
-        self.args = parser.parse_args()
+        self.args = parser.parse_args(args)
 
-    def reload(self, file: str):
-        try:
-            with default_read(file) as f:
-                cfg = yaml.safe_load(f)
-        except Exception as e:
-            print(f"An error occurred while loading config file ({file}):{e}")
-            self.logger.exception(e)
+    def reload(self, file: str, options: dict = None):
+        cfg = {}
+        if file:
+            try:
+                with default_read(file) as f:
+                    cfg = yaml.safe_load(f) or {}
+            except Exception as e:
+                print(f"An error occurred while loading config file ({file}):{e}")
+                self.logger.exception(e)
 
         # Convert user-friendly to program-friendly.
-        if "cfg" in locals():
-            self.path = (pack := cfg.get("packs", {})).get("path", self.PATH)
-            self.pack_name = (manifest := pack.get("manifest")).get("name", self.PACK_NAME)
-            self.header_uuid = manifest.get("header_uuid", self.HEADER_UUID)
-            self.header_version = manifest.get("header_version", self.HEADER_VERSION)
-            self.modules_uuid = manifest.get("modules_uuid", self.MODULES_UUID)
-            self.modules_version = manifest.get("modules_version", self.MODULES_VERSION)
-            self.log_path = cfg.get("log", {}).get("path", self.LOG_PATH) if cfg.get("log", {}).get("file", True) else ""
-            obfuscator = cfg.get("obfuscator", {})
-            self.merged_ui_path = (
-                json_funs.get("merge_jsonui", {}).get("path", self.MERGED_UI_PATH)
-                if (json_funs := obfuscator.get("json_funs", {})).get("merge_jsonui", {}).get("enable", True)
-                else ""
-            )
-            wm_enable = (file_funs := obfuscator.get("file_funs", {}))
-            wm = file_funs.get("filename_watermark", {})
-            self.watermark_paths = (
-                wm.get("paths", self.WATERMARK_PATHS) if (wm_enable.get("filename_watermark", {}).get("enable", True)) else []
-            )
-            self.wm_references = wm.get("references", self.WM_REFERENCES) if wm_enable else []
-            obf_enable = (file_funs := obfuscator.get("file_funs", {}))
-            obf = file_funs.get("filename_obfuscation", {})
-            self.obfuscate_paths = (
-                obf.get("paths", self.OBFUSCATE_PATHS)
-                if (obf_enable.get("filename_obfuscation", {}).get("enable", True))
-                else []
-            )
-            self.obf_references = obf.get("references", self.OBF_REFERENCES) if obf_enable else []
+        self.path = (pack := cfg.get("packs", {})).get("path", self.PATH)
+        self.pack_name = (manifest := pack.get("manifest", {})).get("name", self.PACK_NAME)
+        self.header_uuid = manifest.get("header_uuid", self.HEADER_UUID)
+        self.header_version = manifest.get("header_version", self.HEADER_VERSION)
+        self.modules_uuid = manifest.get("modules_uuid", self.MODULES_UUID)
+        self.modules_version = manifest.get("modules_version", self.MODULES_VERSION)
+        self.log_path = cfg.get("log", {}).get("path", self.LOG_PATH) if cfg.get("log", {}).get("file", True) else ""
+        obfuscator = cfg.get("obfuscator", {})
+        self.merged_ui_path = (
+            json_funs.get("merge_jsonui", {}).get("path", self.MERGED_UI_PATH)
+            if (json_funs := obfuscator.get("json_funs", {})).get("merge_jsonui", {}).get("enable", True)
+            else ""
+        )
+        wm_enable = (file_funs := obfuscator.get("file_funs", {}))
+        wm = file_funs.get("filename_watermark", {})
+        self.watermark_paths = (
+            wm.get("paths", self.WATERMARK_PATHS) if (wm_enable.get("filename_watermark", {}).get("enable", True)) else []
+        )
+        self.wm_references = wm.get("references", self.WM_REFERENCES) if wm_enable else []
+        obf_enable = (file_funs := obfuscator.get("file_funs", {}))
+        obf = file_funs.get("filename_obfuscation", {})
+        self.obfuscate_paths = (
+            obf.get("paths", self.OBFUSCATE_PATHS)
+            if (obf_enable.get("filename_obfuscation", {}).get("enable", True))
+            else []
+        )
+        self.obf_references = obf.get("references", self.OBF_REFERENCES) if obf_enable else []
 
-            for key, value in cfg.items():
-                if value is not None:
-                    setattr(self, key, value)
+        for key, value in cfg.items():
+            if value is not None:
+                setattr(self, key, value)
         # Flags have a higher priority than configuration files
-        for key, value in vars(self.args).items():
+        for key, value in itertools.chain(vars(self.args).items(), (options or {}).items()):
             if value is not None:
                 setattr(self, key, value)
 
@@ -323,12 +391,17 @@ class EnigmataConfig:
         self.merge_entity = self.MERGE_ENTITY if self.merge_entity is None else self.merge_entity
         self.extrainfo = self.EXTRAINFO if self.extrainfo is None else self.extrainfo
         self.console = self.CONSOLE if self.console is None else self.console
+        self.progress = self.PROGRESS if self.progress is None else self.progress
+        self.io_limit = self.IO_LIMIT if self.io_limit is None else self.io_limit
+        self.jobs = self.JOBS if self.jobs is None else self.jobs
         self.image_compress = self.IMAGE_COMPRESS if self.image_compress is None else self.image_compress
         self.pack_compress = self.PACK_COMPRESS if self.pack_compress is None else self.pack_compress
+        self.passthrough = self.PASSTHROUGH if self.passthrough is None else self.passthrough
         self.sort = self.SORT if self.sort is None else self.sort
         self.merged_ui_path = self.MERGED_UI_PATH if self.merged_ui_path is None else self.merged_ui_path
         self.nomedia = self.NOMEDIA if self.nomedia is None else self.nomedia
         self.extract = False if self.extract is None else self.extract
+        self.watch = False if self.watch is None else self.watch
         self.vanillas_path = self.VANILLAS_PATH if self.vanillas_path is None else self.vanillas_path
         self.defs_confused = self.DEFS_CONFUSED if self.defs_confused is None else self.defs_confused
 
@@ -342,6 +415,7 @@ class EnigmataConfig:
         self.obfuscate_paths = tuple(self.obfuscate_paths)
         self.obf_references = tuple(self.obf_references)
         self.exclude_jsons = tuple(self.exclude_jsons) if self.exclude_jsons else self.EXCLUDE_JSONS
+        self.keep_chunks = set(self.keep_chunks) if self.keep_chunks else self.KEEP_CHUNKS
         self.exclude_image_names = (
             set(self.exclude_image_names) if self.exclude_image_names else self.EXCLUDE_IMAGE_NAMES
         )
@@ -370,6 +444,7 @@ class EnigmataConfig:
         self.exclude_jsonui_names.add("namespace")
         self.exclude_entity_names.update(("player.base", "format_version", "version"))
         self.exclude_names = self.exclude_jsonui_names | self.exclude_entity_names
+        self.exclude_matcher = NameMatcher(self.exclude_names, self.exclude_entity_names, self.exclude_entity_names)
         uuid_pattern = re.compile("^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$")
         if self.pack_name and len(self.path) != len(self.pack_name):
             raise ValueError("The pack name needs to correspond to the resource package.")
@@ -406,9 +481,12 @@ class EnigmataConfig:
             else:
                 self.data_path = ""
                 self.logger.error("Cannot read the data directory.")
-                return
-        # Select Vanilla Data, prioritizing files with the specified format in their filenames, with newer files taking precedence.
-        if not self.vanilla_data and self.is_vanilla_data_needed:
+
+    # Select Vanilla Data, prioritizing files with the specified format in their filenames, with newer files taking precedence.
+    # Only called once a stage needs the vanilla data or an extraction can start from it, so plain runs never scan the data
+    # directory.
+    def select_vanilla_data(self):
+        if self.data_path and not self.vanilla_data and (self.is_vanilla_data_needed or self.extract):
             latest_version = 0  # datetime filename => str; mtime => int
             datetime_pattern = re.compile(r"(\d{4}-\d{2}-\d{2}-\d{2}-\d{2}-\d{2})")
             time_format = "%Y-%m-%d-%H-%M-%S"
@@ -428,4 +506,5 @@ class EnigmataConfig:
             print(f"Reading Vanilla Data by {self.vanilla_data}")
 
 
+# Loaded from the command line by main.py, or swapped per call by api.obfuscate_pack.
 cfg = EnigmataConfig()
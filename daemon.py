@@ -0,0 +1,230 @@
+# Enigmata, an obfuscator for Minecraft Bedrock Editon resource packs.
+# Copyright (C) 2024 github.com/Eric-Joker
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import argparse
+import asyncio
+import hmac
+import importlib
+import json
+import logging
+import multiprocessing
+import os
+import secrets
+import socket
+import sys
+from dataclasses import asdict
+
+from api import async_obfuscate_packs
+from config import cfg
+from config.base import CONFIG_FILE, EnigmataConfig
+from models import vd, workers
+from utils import mkdirs
+
+SOCKET_PATH = os.path.join(EnigmataConfig.DATA_PATH, "enigmata.sock")
+TOKEN_PATH = os.path.join(EnigmataConfig.DATA_PATH, "enigmata.token")
+MAX_JOBS = 2
+
+logger = logging.getLogger(__name__)
+
+
+# Runs in a process forked from the warm daemon, so imports and vanilla data come for free and the obfuscation maps,
+# config and progress state are private to the job.
+def run_job(conn, request: dict):
+    try:
+        os.chdir(request.get("cwd") or os.getcwd())
+        options = {**request.get("options", {}), "progress": lambda event: conn.send({"event": "progress", **event})}
+        results = asyncio.run(async_obfuscate_packs(options))
+        event = {"event": "result", "packs": [asdict(r) for r in results]}
+    except BaseException as e:
+        event = {"event": "error", "error": f"{type(e).__name__}: {e}"}
+    finally:
+        workers.shutdown()
+    conn.send(event)
+    conn.close()
+
+
+class Daemon:
+    def __init__(self, max_jobs: int, token: str = None):
+        self.context = multiprocessing.get_context("fork")
+        self.token = token
+        self.semaphore = asyncio.Semaphore(max_jobs)
+        self.stopped = asyncio.Event()
+
+    # One request per connection, one JSON object per line in both directions.
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request = json.loads(await reader.readline())
+            # Any local user can reach a TCP port, so those requests must prove they can read the token file.
+            if self.token is not None and not hmac.compare_digest(
+                str(request.get("token", "")).encode("utf-8"), self.token.encode("utf-8")
+            ):
+                await self.send(writer, {"event": "error", "error": "The request's token is missing or wrong."})
+            elif request.get("op") == "stop":
+                self.stopped.set()
+                await self.send(writer, {"event": "stopped"})
+            elif request.get("op") == "ping":
+                await self.send(writer, {"event": "pong", "pid": os.getpid(), "vanilla_data": vd.loaded_path})
+            else:
+                async with self.semaphore:
+                    await self.run(request, writer)
+        except Exception as e:
+            print(f"An error occurred while handling a daemon request:{e}")
+            logger.exception(e)
+        finally:
+            writer.close()
+
+    # Events are read off the job's pipe by the daemon's loop itself, since forking next to helper threads is unsafe. A job
+    # whose client has gone away still runs to completion, so its worker processes are never left behind.
+    async def run(self, request: dict, writer: asyncio.StreamWriter):
+        recv_conn, send_conn = self.context.Pipe(False)
+        process = self.context.Process(target=run_job, args=(send_conn, request))
+        process.start()
+        send_conn.close()
+        loop = asyncio.get_running_loop()
+        readable = asyncio.Event()
+        loop.add_reader(fd := recv_conn.fileno(), readable.set)
+        connected = True
+        finished = False
+        try:
+            while True:
+                if not recv_conn.poll():
+                    readable.clear()
+                    await readable.wait()
+                    continue
+                try:
+                    event = recv_conn.recv()
+                except EOFError:
+                    break
+                finished = event["event"] in ("result", "error")
+                if connected:
+                    try:
+                        await self.send(writer, event)
+                    except ConnectionError:
+                        connected = False
+            if connected and not finished:
+                await self.send(writer, {"event": "error", "error": "The job process exited unexpectedly."})
+        finally:
+            loop.remove_reader(fd)
+            recv_conn.close()
+            process.join()
+
+    @staticmethod
+    async def send(writer: asyncio.StreamWriter, event: dict):
+        writer.write(json.dumps(event, ensure_ascii=False).encode("utf-8") + b"\n")
+        await writer.drain()
+
+    async def serve(self, socket_path: str, port: int):
+        if port:
+            server = await asyncio.start_server(self.handle, "127.0.0.1", port)
+        else:
+            if os.path.exists(socket_path):
+                os.remove(socket_path)
+            server = await asyncio.start_unix_server(self.handle, socket_path)
+        print(f"Enigmata daemon is listening on {f'127.0.0.1:{port}' if port else socket_path}")
+        async with server:
+            await self.stopped.wait()
+        if not port:
+            os.remove(socket_path)
+
+
+def serve(args: argparse.Namespace):
+    cfg.load({"config": args.config or CONFIG_FILE})
+    # Everything a job would otherwise pay for on startup.
+    for module in ("utils.log", "PIL.Image", "models.dag", "obfuscators.images"):
+        importlib.import_module(module)
+    vd.ensure_loaded()
+    token = None
+    if args.port:
+        # Only the owner can read the file, so only they can submit jobs over the port.
+        token = args.token or secrets.token_urlsafe(32)
+        mkdirs(os.path.dirname(args.token_file))
+        with os.fdopen(os.open(args.token_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "w") as f:
+            f.write(token)
+    try:
+        asyncio.run(Daemon(args.max_jobs, token).serve(args.socket, args.port))
+    finally:
+        if token is not None and os.path.exists(args.token_file):
+            os.remove(args.token_file)
+
+
+def request(args: argparse.Namespace, message: dict):
+    if args.port:
+        if (token := args.token) is None:
+            with open(args.token_file, encoding="utf-8") as f:
+                token = f.read().strip()
+        message = {**message, "token": token}
+        client = socket.create_connection(("127.0.0.1", args.port))
+    else:
+        (client := socket.socket(socket.AF_UNIX)).connect(args.socket)
+    with client, client.makefile("rwb") as f:
+        f.write(json.dumps(message, ensure_ascii=False).encode("utf-8") + b"\n")
+        f.flush()
+        for line in f:
+            yield json.loads(line)
+
+
+# Takes the same flags as main.py; relative paths are resolved in the client's working directory.
+def submit(args: argparse.Namespace, argv: list[str]):
+    (options := EnigmataConfig())._add_arguments(argv)
+    failed = False
+    for event in request(
+        args,
+        {"op": "obfuscate", "cwd": os.getcwd(), "options": {k: v for k, v in vars(options.args).items() if v is not None}},
+    ):
+        if options.args.progress == "jsonl":
+            print(json.dumps(event, ensure_ascii=False), flush=True)
+        elif event["event"] == "result":
+            for pack in event["packs"]:
+                print(f"{pack['namespace']}: {pack['archive'] or pack['work_path']}")
+        elif event["event"] == "error":
+            print(f"An error occurred while obfuscating in the daemon:{event['error']}", file=sys.stderr)
+        failed = event["event"] == "error"
+    return 1 if failed else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Keep Enigmata warm in memory and obfuscate packs on request.")
+    parser.add_argument("command", choices=("serve", "submit", "ping", "stop"))
+    parser.add_argument("--socket", type=str, default=SOCKET_PATH, help="Path to the daemon's Unix socket.")
+    parser.add_argument("--port", type=int, help="Listen on or connect to this localhost TCP port instead of a socket.")
+    parser.add_argument(
+        "--token",
+        type=str,
+        help="Secret for --port. The daemon makes a random one when none is given and writes it to --token-file.",
+    )
+    parser.add_argument(
+        "--token-file",
+        type=str,
+        default=TOKEN_PATH,
+        help="File the daemon writes its --port token to and clients read it from.",
+    )
+    parser.add_argument("--max-jobs", type=int, default=MAX_JOBS, help="Number of packs obfuscated at once.")
+    parser.add_argument("--config", "-c", type=str, help="Path to yaml configuration file, for the daemon or the job.")
+    args, rest = parser.parse_known_args()
+
+    # Jobs are forked from the warm daemon and their pipes are watched by the event loop, neither of which Windows offers.
+    if "fork" not in multiprocessing.get_all_start_methods():
+        sys.exit(f"The Enigmata daemon is not supported on this platform ({sys.platform}). Use main.py or api.py instead.")
+    if args.command == "serve":
+        serve(args)
+    elif args.command == "submit":
+        sys.exit(submit(args, rest + (["--config", args.config] if args.config else [])))
+    else:
+        for event in request(args, {"op": args.command}):
+            print(json.dumps(event, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -18,19 +18,32 @@ import itertools
 import logging
 import os
 import shutil
+import sys
 import time
 import zipfile
 
 import aiofiles
-from tqdm import tqdm
 from wcmatch import glob
 
 import obfuscators as obfs
 from config.base import EnigmataConfig
-from models import FileHandler, OBFStrType, obf_strs_dict, pbm, vd
+from models import (
+    FileHandler,
+    OBFStrType,
+    PackState,
+    dedup,
+    iox,
+    obf_strs_dict,
+    pack_source,
+    pbm,
+    reset_obf_strs,
+    vd,
+    workers,
+)
 from utils import default_dumps, default_write, mkdirs
 
 __VERSION__ = "0.1.0"
+WATCH_INTERVAL = 0.3
 
 
 def print_banner():
@@ -56,10 +69,7 @@ We do not want this script to be used too frequently, as it goes against the spi
 logger = logging.getLogger(__name__)
 
 
-def main():
-    print_banner()
-    from config import cfg
-
+def check_config(cfg: EnigmataConfig):
     if os.path.isdir(cfg.work_path):
         cfg.work_path = os.path.realpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), cfg.work_path))
     else:
@@ -92,27 +102,31 @@ def main():
         if any(any(not s.isascii() for s in p) for p in cfg.obfuscate_ascii):
             raise ValueError("obfuscate_ascii must be full of ascii characters.")
 
+
+def main():
+    print_banner()
+    from config import cfg
+
+    vd.load()
+    check_config(cfg)
+
     try:
         asyncio.run(async_start_obf(cfg))
+    except KeyboardInterrupt:
+        if not cfg.watch:
+            raise
     except Exception as e:
         logger.exception(e)
     finally:
+        workers.shutdown()
         if cfg.tmp_dir in cfg.data_path:
             input("Press any key to clean up temp files and exit.")
             shutil.rmtree(cfg.data_path)
 
 
 async def async_start_obf(cfg: EnigmataConfig):
-    for (
-        root_path,
-        namespace,
-        zip_name,
-        pack_name,
-        header_uuid,
-        header_version,
-        modules_uuid,
-        modules_version,
-    ) in itertools.zip_longest(
+    outputs = []
+    for args in itertools.zip_longest(
         cfg.path,
         cfg.namespace,
         cfg.zip_name,
@@ -123,186 +137,315 @@ async def async_start_obf(cfg: EnigmataConfig):
         cfg.modules_version,
         fillvalue=None,
     ):
-        manifest = None
-        pngs = []
-        tgas = []
-        renames = []
-        obf_names = []
-        jsonuis = []
-        langs = []
-        uniqueuis = []
-        acs = []
-        animations = []
-        entities = []
-        models = []
-        particles = []
-        rcs = []
-        materials = []
-        material_indexes = []
-        std_jsons = []
-        texture_jsons = []
-        texture_jsons_2 = []
-        image_jsons = []
-        ui_global_vars = []
-        ui_defs = []
-        mkdirs(work_path := os.path.join(cfg.work_path, namespace + time.strftime("_%Y-%m-%d-%H-%M-%S")))
-        pbm.pbar = tqdm(
-            total=0,
-            nrows=0,
-            disable=not cfg.console,
-            unit="items",
-            desc=f"{namespace} Statisticing: ",
-            bar_format="{desc} {percentage:3.0f}%|{bar}| {n_fmt}/{total_fmt}{unit} {elapsed}",
-        )
+        state = PackState(args[0]) if cfg.watch else None
+        outputs.append(((await async_obf_pack(cfg, *args, state=state))[0], args, state))
+    if cfg.watch:
+        await async_watch(cfg, outputs)
+
+
+# Rebuilds a pack whenever its files change, with the imports, vanilla data and worker processes kept warm. Only the files
+# that changed and the files whose output depends on them are processed again, in place; see PackState.
+async def async_watch(cfg: EnigmataConfig, outputs: list[tuple[str, tuple, PackState]]):
+    print(f"Watching {len(outputs)} pack(s) for changes. Press Ctrl+C to stop.")
+    while True:
+        await asyncio.sleep(WATCH_INTERVAL)
+        for work_path, args, state in outputs:
+            index, snapshot = state.scan()
+            if snapshot == state.snapshot:
+                continue
+            # Let a burst of saves settle first.
+            while (settled := state.scan())[1] != snapshot:
+                index, snapshot = settled
+                await asyncio.sleep(WATCH_INTERVAL)
+            state.update(index, snapshot)
+
+            start = time.perf_counter()
+            count = len(state.changed | state.removed)
+            try:
+                if not await async_rebuild(cfg, work_path, args, state):
+                    print(f"{args[1]}: the changes reach files the rebuild didn't process, building it again in full.")
+                    await async_rebuild(cfg, work_path, args, state)
+            except Exception as e:
+                print(f"An error occurred while rebuilding ({args[0]}):{e}")
+                logger.exception(e)
+                state.reset()
+                continue
+            print(
+                f"{args[1]} rebuilt in {time.perf_counter() - start:.2f}s: {count} changed file(s), "
+                f"{len(state.kept)} of {len(state.sources)} processed."
+            )
+
+
+# Builds a watched pack again and returns whether its state is built afterwards; a rebuild that finds it missed a dependant
+# leaves it unbuilt. After a failed rebuild the pack is built again from scratch, into a sibling directory that then replaces
+# the output, so the output path is stable.
+async def async_rebuild(cfg: EnigmataConfig, work_path: str, args: tuple, state: PackState) -> bool:
+    target = work_path if (full := not state.built) is False else f"{work_path}.next"
+    if full:
+        if os.path.isdir(target):
+            shutil.rmtree(target)
+        iox.made_dirs.clear()
+    await async_obf_pack(cfg, *args, work_path=target, state=state)
+    if full:
+        os.rename(work_path, old_path := f"{work_path}.old")
+        os.rename(target, work_path)
+        shutil.rmtree(old_path)
+        iox.made_dirs.clear()
+    return state.built
+
+
+# Obfuscates one pack into `work_path`, or a fresh timestamped directory under cfg.work_path; returns that directory and the
+# name table.
+async def async_obf_pack(
+    cfg: EnigmataConfig,
+    root_path,
+    namespace,
+    zip_name,
+    pack_name,
+    header_uuid,
+    header_version,
+    modules_uuid,
+    modules_version,
+    work_path: str = None,
+    state: PackState = None,
+) -> tuple[str, dict]:
+    # A watched pack that was built before is rebuilt in place from the names it was given then.
+    if rebuild := state is not None and state.built:
+        obf_strs_dict.update(state.names)
+    else:
+        reset_obf_strs()
+    dedup.reset()
+    manifest = None
+    pngs = []
+    tgas = []
+    renames = []
+    obf_names = []
+    jsonuis = []
+    langs = []
+    uniqueuis = []
+    acs = []
+    animations = []
+    entities = []
+    models = []
+    particles = []
+    rcs = []
+    materials = []
+    material_indexes = []
+    std_jsons = []
+    texture_jsons = []
+    texture_jsons_2 = []
+    image_jsons = []
+    ui_global_vars = []
+    ui_defs = []
+    passthroughs = {}
+    made_dirs = set()
+    mkdirs(work_path := work_path or os.path.join(cfg.work_path, namespace + time.strftime("_%Y-%m-%d-%H-%M-%S")))
+    if rebuild:
+        pbm.enabled = False  # the scan counts every file of the pack, but a rebuild only processes a few of them
+    else:
+        pbm.start(f"{namespace} Statisticing: ")
+
+    def process_image(fh: FileHandler, row: int, vd: set, l: list):
+        if (cut := index.cuts[row]) not in vd:
+            fh.subpack_path = index.subpack(row)
+            fh.cut = os.path.splitext(cut)[0] if fh.subpack_path else fh.path
+            if glob.globmatch(fh.path, cfg.watermark_paths, flags=glob.D | glob.G | glob.N):
+                renames.append(fh)
+                pbm.update_t_item()
+                return
+            elif glob.globmatch(fh.path, cfg.obfuscate_paths, flags=glob.D | glob.G | glob.N):
+                obf_names.append(fh)
+                pbm.update_t_item()
+                return
+        if cfg.image_compress != -1 or cfg.extrainfo:
+            l.append(fh)
+
+    source = pack_source(root_path)
+    if state is not None and not rebuild:
+        state.update(*state.scan())
+    index = source.index() if state is None else state.index
+    if not rebuild:
+        index.hash_duplicates(source, (".png", ".tga", ".json"))
+    for row, rel_path in enumerate(index.paths):
+        if glob.globmatch(
+            rel_path,
+            itertools.chain(("!manifest.json"), cfg.exclude_files) if cfg.mod_manifest else cfg.exclude_files,
+            flags=glob.D | glob.G | glob.N,
+        ):
+            continue
+        pbm.update_t_file()
+
+        fh = FileHandler(rel_path, blob=index.blobs[row])
+        if (kind := index.kinds[row]) == ".png":
+            process_image(fh, row, vd.pngs, pngs)
+            pbm.update_t_item(sum((cfg.image_compress != -1, cfg.extrainfo)))
+        elif kind == ".tga":
+            process_image(fh, row, vd.tgas, tgas)
+            pbm.update_t_item(sum((cfg.image_compress > 6, cfg.extrainfo)))
+        elif kind == ".lang":
+            if cfg.obfuscate_jsonui:
+                pbm.update_t_item()
+            langs.append(fh)
+        elif rel_path == "manifest.json":
+            manifest = fh
+            pbm.update_t_item()
+        elif glob.globmatch(rel_path, ("materials/*.material", "subpacks/*/materials/*.material"), flags=glob.D):
+            fh.subpack_path, fh.cut = index.subpack(row), index.cuts[row]
+            pbm.update_t_item(
+                sum((cfg.comment, cfg.empty_dict, cfg.sort, cfg.unicode, cfg.obfuscate_entity, cfg.merge_entity))
+            )
+            materials.append(fh)
+        elif kind == ".json":
+            fh.subpack_path, fh.cut = index.subpack(row), index.cuts[row]
+            pbm.update_t_item(sum((cfg.comment, cfg.empty_dict, cfg.sort, cfg.unicode)))
 
-        def process_image(fh: FileHandler, vd: set, l: list):
-            splited = fh.path.split(os.sep)
-            if fh.path.replace("\\", "/") not in vd and (
-                not (insub := "subpacks" in fh.path) or (cut := "/".join(splited[2:])) not in vd
+            if glob.globmatch(rel_path, cfg.wm_references, flags=glob.D | glob.G | glob.N):
+                texture_jsons.append(fh)
+                pbm.update_t_item()
+            elif glob.globmatch(rel_path, cfg.obf_references, flags=glob.D | glob.G | glob.N):
+                texture_jsons_2.append(fh)
+                pbm.update_t_item()
+            if cfg.merged_ui_path and rel_path.endswith("_global_variables.json"):
+                ui_global_vars.append(fh)
+            elif cfg.merged_ui_path and rel_path.endswith("_ui_defs.json"):
+                pbm.update_t_item()
+                ui_defs.append(fh)
+            elif glob.globmatch(
+                rel_path,
+                (f"ui/{namespace}/**/*", f"subpacks/*/ui/{namespace}/**/*", "!**/_*"),
+                flags=glob.D | glob.G | glob.N,
             ):
-                fh.subpack_path = os.sep.join(splited[:2]) if insub else ""
-                fh.cut = os.path.splitext(cut)[0] if insub else fh.path
-                if glob.globmatch(fh.path, cfg.watermark_paths, flags=glob.D | glob.G | glob.N):
-                    renames.append(fh)
-                    pbm.update_t_item()
-                    return
-                elif glob.globmatch(fh.path, cfg.obfuscate_paths, flags=glob.D | glob.G | glob.N):
-                    obf_names.append(fh)
+                pbm.update_t_item(sum(bool(i) for i in (cfg.merged_ui_path, cfg.obfuscate_jsonui)))
+                uniqueuis.append(fh)
+            elif glob.globmatch(
+                rel_path,
+                itertools.chain(("ui/**/*", "subpacks/*/ui/**/*", "!**/_*"), cfg.additional_jsonui),
+                flags=glob.D | glob.G | glob.N,
+            ):
+                pbm.update_t_item(sum(bool(i) for i in (cfg.merged_ui_path, cfg.obfuscate_jsonui)))
+                jsonuis.append(fh)
+            elif glob.globmatch(rel_path, ("entity/**/*", "subpacks/*/entity/**/*"), flags=glob.D | glob.G):
+                if cfg.obfuscate_entity:
                     pbm.update_t_item()
-                    return
-            if cfg.image_compress != -1 or cfg.extrainfo:
-                l.append(fh)
-
-        for root, _, files in os.walk(root_path):
-            for file in files:
-                rel_path = os.path.relpath((path := os.path.join(root, file)), root_path)
-                if glob.globmatch(
-                    rel_path,
-                    itertools.chain(("!manifest.json"), cfg.exclude_files) if cfg.mod_manifest else cfg.exclude_files,
-                    flags=glob.D | glob.G | glob.N,
-                ):
-                    continue
-                pbm.update_t_file()
-
-                fh = FileHandler(rel_path)
-                if (rel_path).endswith(".png"):
-                    process_image(fh, vd.pngs, pngs)
-                    pbm.update_t_item(sum((cfg.image_compress != -1, cfg.extrainfo)))
-                elif rel_path.endswith(".tga"):
-                    process_image(fh, vd.tgas, tgas)
-                    pbm.update_t_item(sum((cfg.image_compress > 6, cfg.extrainfo)))
-                elif rel_path.endswith(".lang"):
-                    if cfg.obfuscate_jsonui:
-                        pbm.update_t_item()
-                    langs.append(fh)
-                elif rel_path == "manifest.json":
-                    manifest = fh
+                entities.append(fh)
+            elif glob.globmatch(
+                rel_path,
+                ("animation_controllers/**/*", "subpacks/*/animation_controllers/**/*"),
+                flags=glob.D | glob.G,
+            ):
+                pbm.update_t_item(sum((cfg.obfuscate_entity, cfg.merge_entity)))
+                acs.append(fh)
+            elif glob.globmatch(rel_path, ("animations/**/*", "subpacks/*/animations/**/*"), flags=glob.D | glob.G):
+                pbm.update_t_item(sum((cfg.obfuscate_entity, cfg.merge_entity)))
+                animations.append(fh)
+            elif glob.globmatch(rel_path, ("models/**/*", "subpacks/*/models/**/*"), flags=glob.D | glob.G):
+                pbm.update_t_item(sum((cfg.obfuscate_entity, cfg.merge_entity)))
+                models.append(fh)
+            elif glob.globmatch(
+                rel_path, ("render_controllers/**/*", "subpacks/*/render_controllers/**/*"), flags=glob.D | glob.G
+            ):
+                pbm.update_t_item(sum((cfg.obfuscate_entity, cfg.merge_entity)))
+                rcs.append(fh)
+            elif glob.globmatch(rel_path, ("particles/**/*", "subpacks/*/particles/**/*"), flags=glob.D | glob.G):
+                if cfg.obfuscate_entity:
                     pbm.update_t_item()
-                elif glob.globmatch(rel_path, ("materials/*.material", "subpacks/*/materials/*.material"), flags=glob.D):
-                    splited = fh.path.split(os.sep)
-                    fh.subpack_path = os.sep.join(splited[:2]) if "subpacks" in fh.path else ""
-                    fh.cut = "/".join(splited[2:] if "subpacks" in fh.path else splited)
-                    pbm.update_t_item(
-                        sum((cfg.comment, cfg.empty_dict, cfg.sort, cfg.unicode, cfg.obfuscate_entity, cfg.merge_entity))
-                    )
-                    materials.append(fh)
-                elif rel_path.endswith(".json"):
-                    splited = fh.path.split(os.sep)
-                    fh.subpack_path = os.sep.join(splited[:2]) if "subpacks" in fh.path else ""
-                    fh.cut = "/".join(splited[2:] if "subpacks" in fh.path else splited)
-                    pbm.update_t_item(sum((cfg.comment, cfg.empty_dict, cfg.sort, cfg.unicode)))
-
-                    if glob.globmatch(rel_path, cfg.wm_references, flags=glob.D | glob.G | glob.N):
-                        texture_jsons.append(fh)
-                        pbm.update_t_item()
-                    elif glob.globmatch(rel_path, cfg.obf_references, flags=glob.D | glob.G | glob.N):
-                        texture_jsons_2.append(fh)
-                        pbm.update_t_item()
-                    if cfg.merged_ui_path and rel_path.endswith("_global_variables.json"):
-                        ui_global_vars.append(fh)
-                    elif cfg.merged_ui_path and rel_path.endswith("_ui_defs.json"):
-                        pbm.update_t_item()
-                        ui_defs.append(fh)
-                    elif glob.globmatch(
-                        rel_path,
-                        (f"ui/{namespace}/**/*", f"subpacks/*/ui/{namespace}/**/*", "!**/_*"),
-                        flags=glob.D | glob.G | glob.N,
-                    ):
-                        pbm.update_t_item(sum(bool(i) for i in (cfg.merged_ui_path, cfg.obfuscate_jsonui)))
-                        uniqueuis.append(fh)
-                    elif glob.globmatch(
-                        rel_path,
-                        itertools.chain(("ui/**/*", "subpacks/*/ui/**/*", "!**/_*"), cfg.additional_jsonui),
-                        flags=glob.D | glob.G | glob.N,
-                    ):
-                        pbm.update_t_item(sum(bool(i) for i in (cfg.merged_ui_path, cfg.obfuscate_jsonui)))
-                        jsonuis.append(fh)
-                    elif glob.globmatch(rel_path, ("entity/**/*", "subpacks/*/entity/**/*"), flags=glob.D | glob.G):
-                        if cfg.obfuscate_entity:
-                            pbm.update_t_item()
-                        entities.append(fh)
-                    elif glob.globmatch(
-                        rel_path,
-                        ("animation_controllers/**/*", "subpacks/*/animation_controllers/**/*"),
-                        flags=glob.D | glob.G,
-                    ):
-                        pbm.update_t_item(sum((cfg.obfuscate_entity, cfg.merge_entity)))
-                        acs.append(fh)
-                    elif glob.globmatch(rel_path, ("animations/**/*", "subpacks/*/animations/**/*"), flags=glob.D | glob.G):
-                        pbm.update_t_item(sum((cfg.obfuscate_entity, cfg.merge_entity)))
-                        animations.append(fh)
-                    elif glob.globmatch(rel_path, ("models/**/*", "subpacks/*/models/**/*"), flags=glob.D | glob.G):
-                        pbm.update_t_item(sum((cfg.obfuscate_entity, cfg.merge_entity)))
-                        models.append(fh)
-                    elif glob.globmatch(
-                        rel_path, ("render_controllers/**/*", "subpacks/*/render_controllers/**/*"), flags=glob.D | glob.G
-                    ):
-                        pbm.update_t_item(sum((cfg.obfuscate_entity, cfg.merge_entity)))
-                        rcs.append(fh)
-                    elif glob.globmatch(rel_path, ("particles/**/*", "subpacks/*/particles/**/*"), flags=glob.D | glob.G):
-                        if cfg.obfuscate_entity:
-                            pbm.update_t_item()
-                        particles.append(fh)
-                    elif glob.globmatch(rel_path, ("materials/*", "subpacks/*/materials/*"), flags=glob.D):
-                        if cfg.merge_entity:
-                            pbm.update_t_item()
-                        material_indexes.append(fh)
-                    elif glob.globmatch(
-                        rel_path,
-                        ("**/*", f"!{cfg.merged_ui_path}"),
-                        flags=glob.D | glob.G | glob.N,
-                    ):
-                        std_jsons.append(fh)
-                else:
-                    mkdirs(new_path := os.path.join(work_path, os.path.dirname(rel_path)))
-                    shutil.copy2(path, new_path)
-                    pbm.update_n_file()
-        # stats texture json
-        if cfg.watermark_paths or cfg.obfuscate_paths:
-            for file in renames + obf_names:
-                if os.path.exists(os.path.join(root_path, rel_path := f"{os.path.splitext(file.path)[0]}.json")):
-                    for j in std_jsons:
-                        if rel_path == j:
-                            image_jsons.append(j)
+                particles.append(fh)
+            elif glob.globmatch(rel_path, ("materials/*", "subpacks/*/materials/*"), flags=glob.D):
+                if cfg.merge_entity:
                     pbm.update_t_item()
+                material_indexes.append(fh)
+            elif glob.globmatch(
+                rel_path,
+                ("**/*", f"!{cfg.merged_ui_path}"),
+                flags=glob.D | glob.G | glob.N,
+            ):
+                std_jsons.append(fh)
+        else:
+            passthroughs[rel_path] = path = os.path.join(root_path, rel_path)
+            if (cfg.passthrough != "archive" or not zip_name) and (not rebuild or rel_path in state.changed):
+                mkdirs(os.path.join(work_path, os.path.dirname(rel_path)), made_dirs)
+                try:
+                    source.copy(rel_path, os.path.join(work_path, rel_path), cfg.passthrough)
+                except Exception as e:
+                    print(f"An error occurred while copying file ({path}):{e}")
+                    logger.exception(e)
+            pbm.update_n_file()
+    # stats texture json
+    if cfg.watermark_paths or cfg.obfuscate_paths:
+        std_json_paths = {j.path: j for j in std_jsons}
+        for file in renames + obf_names:
+            if (rel_path := f"{os.path.splitext(file.path)[0]}.json") in index:
+                if j := std_json_paths.get(rel_path):
+                    image_jsons.append(j)
+                pbm.update_t_item()
 
-        if cfg.nomedia:
-            with default_write(os.path.join(work_path, ".nomedia")):
-                pass
+    if state is not None:
+        lists = {
+            "manifest": [manifest] if manifest else [],
+            "pngs": pngs,
+            "tgas": tgas,
+            "renames": renames,
+            "obf_names": obf_names,
+            "jsonuis": jsonuis,
+            "langs": langs,
+            "uniqueuis": uniqueuis,
+            "acs": acs,
+            "animations": animations,
+            "entities": entities,
+            "models": models,
+            "particles": particles,
+            "rcs": rcs,
+            "materials": materials,
+            "material_indexes": material_indexes,
+            "std_jsons": std_jsons,
+            "texture_jsons": texture_jsons,
+            "texture_jsons_2": texture_jsons_2,
+            "image_jsons": image_jsons,
+            "ui_global_vars": ui_global_vars,
+            "ui_defs": ui_defs,
+        }
+        state.track(lists)
+        if rebuild:
+            keep = await state.async_select(lists)
+            for l in lists.values():
+                l[:] = [fh for fh in l if fh.path in keep]
+            manifest = manifest if lists["manifest"] else None
 
-        pbm.set_description(f"{namespace} Processing")
+    if cfg.nomedia and not rebuild:
+        with default_write(os.path.join(work_path, ".nomedia")):
+            pass
+
+    pbm.set_description(f"{namespace} Processing")
+    json_common = obfs.Jsons(root_path, work_path, namespace)
+    if manifest:
+        manifest_task = asyncio.create_task(
+            json_common.async_manifest(manifest, pack_name, header_uuid, header_version, modules_uuid, modules_version)
+        )
+    image_tasks = []
+    if pngs or tgas or renames or obf_names or texture_jsons or texture_jsons_2 or image_jsons:
         images = obfs.Images(root_path, work_path, namespace)
-        json_common = obfs.Jsons(root_path, work_path, namespace)
-        if manifest:
-            manifest_task = asyncio.create_task(
-                json_common.async_manifest(manifest, pack_name, header_uuid, header_version, modules_uuid, modules_version)
+        await images.async_rename(
+            pngs,
+            tgas,
+            renames,
+            obf_names,
+            texture_jsons,
+            texture_jsons_2,
+            image_jsons,
+            None if state is None else state.lookups,
+        )
+        image_tasks.append(images.async_obf())
+
+    # Both stages generate obfuscated file names from the same map, so they run one after the other. Interleaved, the
+    # names would follow whichever read happened to finish first.
+    # A rebuild skips the stages it has no files for, as they would write their merged files from nothing.
+    async def async_obf_names():
+        if not rebuild or jsonuis or uniqueuis or langs or ui_global_vars or ui_defs:
+            await obfs.UIs(root_path, work_path, namespace).async_obf(
+                jsonuis, uniqueuis, langs, ui_global_vars, ui_defs, None if state is None else state.lookups
             )
-        await images.async_rename(pngs, tgas, renames, obf_names, texture_jsons, texture_jsons_2, image_jsons)
-        await asyncio.gather(
-            images.async_obf(),
-            json_common.async_obf(std_jsons),
-            obfs.UIs(root_path, work_path, namespace).async_obf(jsonuis, uniqueuis, langs, ui_global_vars, ui_defs),
-            obfs.Entities(root_path, work_path, namespace).async_obf(
+        if not rebuild or acs or animations or entities or material_indexes or models or particles or rcs or materials:
+            await obfs.Entities(root_path, work_path, namespace).async_obf(
                 acs,
                 animations,
                 entities,
@@ -311,58 +454,87 @@ async def async_start_obf(cfg: EnigmataConfig):
                 particles,
                 rcs,
                 materials,
-            ),
-        )
-        await json_common.async_obf(
-            acs,
-            animations,
-            entities,
-            uniqueuis,
-            jsonuis,
-            material_indexes,
-            models,
-            particles,
-            rcs,
-            materials,
-            ui_global_vars,
-            ui_defs,
-        )
-        if manifest:
-            await manifest_task
-
-        # output obfuscation table
-        del obf_strs_dict[OBFStrType.OBFFILE]
-        obf_ref = {k.value: v.forward for k, v in obf_strs_dict.items()}
-        # obf_ref = default_dumps({k: obf_ref[k] for k in sorted(obf_ref.keys())}, indent=2)
-        obf_ref = default_dumps(obf_ref, indent=2)
-        async with aiofiles.open(os.path.join(work_path, "obfuscation_reference.json"), "w", encoding="utf-8") as f:
-            await f.write(obf_ref)
-
-        if zip_name != "":
-            pbm.set_description(f"{namespace} Compressing")
-            if not all(isinstance(i, int) for i in cfg.mtime) or cfg.mtime[0] < 1980:
-                logger.error("The mtime format is incorrect.")
-                cfg.mtime = ()
-            with zipfile.ZipFile(
-                os.path.join(work_path, zip_name), "w", compression=zipfile.ZIP_DEFLATED, compresslevel=cfg.pack_compress
-            ) as zipf:
-                for path in [
-                    os.path.join(dirpath, file)
+                None if state is None else state.dag_ops,
+            )
+
+    await asyncio.gather(*image_tasks, json_common.async_obf(std_jsons), async_obf_names())
+    await json_common.async_obf(
+        acs,
+        animations,
+        entities,
+        uniqueuis,
+        jsonuis,
+        material_indexes,
+        models,
+        particles,
+        rcs,
+        materials,
+        ui_global_vars,
+        ui_defs,
+    )
+    if manifest:
+        await manifest_task
+
+    if state is not None:
+        await state.async_record(lists, passthroughs, work_path)
+
+    # output obfuscation table
+    references = {k.value: v.forward for k, v in obf_strs_dict.items() if k is not OBFStrType.OBFFILE}
+    # obf_ref = default_dumps({k: obf_ref[k] for k in sorted(obf_ref.keys())}, indent=2)
+    obf_ref = default_dumps(references, indent=2)
+    async with aiofiles.open(os.path.join(work_path, "obfuscation_reference.json"), "w", encoding="utf-8") as f:
+        await f.write(obf_ref)
+
+    if zip_name:
+        pbm.set_description(f"{namespace} Compressing")
+        if not all(isinstance(i, int) for i in cfg.mtime) or cfg.mtime[0] < 1980:
+            logger.error("The mtime format is incorrect.")
+            cfg.mtime = ()
+        with zipfile.ZipFile(
+            os.path.join(work_path, zip_name), "w", compression=zipfile.ZIP_DEFLATED, compresslevel=cfg.pack_compress
+        ) as zipf:
+            for rel_path in itertools.chain(
+                (
+                    os.path.relpath(os.path.join(dirpath, file), work_path)
                     for dirpath, _, files in os.walk(work_path)
                     for file in files
                     if file not in [zip_name, "obfuscation_reference.json"]
-                ]:
-                    zip_info = zipfile.ZipInfo(os.path.relpath(path, work_path))
-                    if len(cfg.mtime) == 6:
-                        zip_info.date_time = cfg.mtime
-                    with open(path, "rb") as d:
-                        zipf.writestr(zip_info, d.read(), compress_type=zipfile.ZIP_DEFLATED)
+                ),
+                (p for p in passthroughs if cfg.passthrough == "archive"),
+            ):
+                # Passthrough files are streamed from the source pack instead of being read back from the work path.
+                if rel_path in passthroughs:
+                    size, stream = source.size(rel_path), source.open(rel_path)
+                else:
+                    size, stream = os.path.getsize(path := os.path.join(work_path, rel_path)), open(path, "rb")
+                zip_info = zipfile.ZipInfo(rel_path)
+                if len(cfg.mtime) == 6:
+                    zip_info.date_time = cfg.mtime
+                zip_info.compress_type = zipfile.ZIP_DEFLATED
+                zip_info.file_size = size
+                with stream as d, zipf.open(zip_info, "w") as z:
+                    shutil.copyfileobj(d, z, 1 << 20)
+
+    pbm.set_description(f"{namespace} Completed")
+    if dedup.files:
+        pbm.report(
+            "dedup",
+            f"{namespace}: {dedup.files} duplicate files reused an earlier result, {dedup.bytes} bytes were not processed again.",
+            duplicate_files=dedup.files,
+            skipped_bytes=dedup.bytes,
+        )
+    pbm.close()
 
-        pbm.set_description(f"{namespace} Completed")
-        pbm.pbar.close()
+    return work_path, references
 
 
 if __name__ == "__main__":
+    from config import cfg
+
+    cfg.load()
+    # Without a progress file, stdout carries nothing but the jsonl progress, so dashboards can parse it as is.
+    if cfg.progress == "jsonl" and not cfg.progress_file:
+        pbm.stream, sys.stdout = sys.stdout, sys.stderr
     import utils.log
 
     main()
@@ -14,9 +14,22 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 from .bi_map import BiMap
-from .dag import DAG
 from .entity_handler import EntityHandler, ProcessMapping, pm_factory
 from .file_handler import FileHandler
-from .obf_strs import OBFStrType, obf_strs_dict
+from .file_index import FileIndex, dedup
+from .io_executor import iox
+from .obf_strs import NameView, OBFStrType, commit_obf_strs, obf_strs_dict, obf_strs_view, reset_obf_strs
+from .pack_source import PackSource, copy_path, open_path, pack_source, read_path
+from .pack_state import PackState
 from .pbar_manager import pbm
-from .vanilla_data import vd
+from .vanilla_data import DAGRecorder, vd
+from .worker_pool import workers
+
+
+# rustworkx is only imported once the entity graph is built or the vanilla data is unpickled.
+def __getattr__(name: str):
+    if name == "DAG":
+        from .dag import DAG
+
+        return DAG
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
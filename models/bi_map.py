@@ -44,6 +44,12 @@ class BiMap:
     def get(self, *args, **kwargs):
         return self.forward.get(*args, **kwargs)
 
+    def pop(self, key, default=None):
+        if key not in self.forward:
+            return default
+        del self.backward[value := self.forward.pop(key)]
+        return value
+
     def replace_value(self, old_value, new_value):
         key = self.backward.pop(old_value, None)
         if key is not None:
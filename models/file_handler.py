@@ -14,11 +14,12 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 class FileHandler:
-    def __init__(self, path: str, subpack_path="", cut="", processed=False):
+    def __init__(self, path: str, subpack_path="", cut="", processed=False, blob: bytes = None):
         self.path = path
         self.processed = processed
         self.subpack_path = subpack_path
         self.cut = cut
+        self.blob = blob  # content digest, only set when another file of the pack has the same bytes
 
     def __hash__(self):
         return hash(self.path)
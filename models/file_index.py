@@ -0,0 +1,111 @@
+# Enigmata, an obfuscator for Minecraft Bedrock Editon resource packs.
+# Copyright (C) 2024 github.com/Eric-Joker
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import hashlib
+import os
+import sys
+from array import array
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from .pack_source import PackSource
+
+
+# The files of a pack in walk order, one row per file and one list per column, so that a pack of many small files costs a
+# few strings each instead of an object. Paths use os.sep like FileHandler.path, and every path is also found by its "/"
+# spelling.
+class FileIndex:
+    def __init__(self):
+        self.paths: list[str] = []
+        self.kinds: list[str] = []  # the extension after the last dot, interned; "" without one
+        self.subpacks = array("i")  # into subpack_names; 0 is the main pack
+        self.subpack_names = [""]
+        self.cuts: list[str] = []  # "/"-separated path below the subpack root
+        self.sizes = array("q")
+        self.mtimes = array("q")  # ns
+        self.blobs: list[bytes | None] = []  # see hash_duplicates
+        self.rows: dict[str, int] = {}
+        self.subpack_ids = {"": 0}
+
+    def add(self, path: str, size=-1, mtime=-1):
+        parts = path.split(os.sep)
+        is_sub = parts[0] == "subpacks" and len(parts) > 2
+        if (subpack := os.sep.join(parts[:2]) if is_sub else "") not in self.subpack_ids:
+            self.subpack_ids[subpack] = len(self.subpack_names)
+            self.subpack_names.append(subpack)
+        name = parts[-1]
+        normalized = "/".join(parts)
+        self.rows[path] = self.rows[normalized] = len(self.paths)
+        self.paths.append(path)
+        self.kinds.append(sys.intern(name[dot:]) if (dot := name.rfind(".")) != -1 else "")
+        self.subpacks.append(self.subpack_ids[subpack])
+        self.cuts.append("/".join(parts[2:]) if is_sub else normalized)
+        self.sizes.append(size)
+        self.mtimes.append(mtime)
+        self.blobs.append(None)
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __contains__(self, path: str):
+        return path in self.rows
+
+    def row(self, path: str) -> int | None:
+        return self.rows.get(path)
+
+    def subpack(self, row: int) -> str:
+        return self.subpack_names[self.subpacks[row]]
+
+    def hash_duplicates(self, source: "PackSource", kinds: tuple[str, ...]):
+        # Subpacks often ship byte-identical copies of main pack files. Only files sharing their kind and size with another
+        # can be such a copy, so only those are read; rows whose digest turns out to be shared get it as their blob.
+        groups = {}
+        for row, kind in enumerate(self.kinds):
+            if kind in kinds and self.sizes[row] > 0:
+                groups.setdefault((kind, self.sizes[row]), []).append(row)
+        rows = [row for group in groups.values() if len(group) > 1 for row in group]
+
+        def digest(row: int):
+            try:
+                with source.open(self.paths[row]) as f:
+                    return hashlib.file_digest(f, "blake2b").digest()
+            except Exception:
+                return None
+
+        with ThreadPoolExecutor() as pool:
+            digests = dict(zip(rows, pool.map(digest, rows)))
+        counts = Counter(digests.values())
+        for row, blob in digests.items():
+            if blob is not None and counts[blob] > 1:
+                self.blobs[row] = blob
+
+
+# Work skipped because a file had the same content as one already processed in the pack.
+class DedupStats:
+    def __init__(self):
+        self.files = 0
+        self.bytes = 0
+
+    def reset(self):
+        self.files = self.bytes = 0
+
+    def add(self, size: int):
+        self.files += 1
+        self.bytes += size
+
+
+dedup = DedupStats()
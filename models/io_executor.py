@@ -0,0 +1,149 @@
+# Enigmata, an obfuscator for Minecraft Bedrock Editon resource packs.
+# Copyright (C) 2024 github.com/Eric-Joker
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import asyncio
+import logging
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+
+from .pack_source import copy_path, read_path
+
+BATCH_SIZE = 32
+SMALL_WRITE = 1 << 16
+
+
+# Every file operation is a single thread hop, and at most `cfg.io_limit` of them (and their descriptors) are in flight.
+class IOExecutor:
+    def __init__(self):
+        self.logger = logging.getLogger(__name__)
+        self.loop = None
+        self.pool = None
+        self.made_dirs = set()
+        # Text reads of the files below these roots, kept for the packs being watched. Their watcher drops the changed ones.
+        self.text_roots: tuple[str, ...] = ()
+        self.texts: dict[str, str] = {}
+
+    @property
+    def limit(self) -> int:
+        from config import cfg
+
+        return max(1, cfg.io_limit)
+
+    def _bind(self):
+        if self.loop is not (loop := asyncio.get_running_loop()):
+            self.loop = loop
+            self.semaphore = asyncio.Semaphore(self.limit)
+            self.pending = []
+            self.batch = []
+            self.made_dirs = set()
+            if self.pool is None:
+                self.pool = ThreadPoolExecutor(self.limit, "enigmata-io")
+
+    async def _run(self, fun, *args):
+        self._bind()
+        async with self.semaphore:
+            return await self.loop.run_in_executor(self.pool, fun, *args)
+
+    def _mkdirs(self, path: str):
+        if (path := os.path.dirname(path)) and path not in self.made_dirs:
+            os.makedirs(path, exist_ok=True)
+            self.made_dirs.add(path)
+
+    def _write_batch(self, batch: list[tuple[str, str | bytes, str]]):
+        for path, data, desc in batch:
+            is_bytes = isinstance(data, bytes)
+            try:
+                self._mkdirs(path)
+                with open(path, "wb" if is_bytes else "w", **({} if is_bytes else {"encoding": "utf-8"})) as f:
+                    f.write(data)
+            except Exception as e:
+                print(f"An error occurred while writing {desc} ({path}):{e}")
+                self.logger.exception(e)
+
+    def _copy(self, src: str, dst: str, desc: str):
+        try:
+            self._mkdirs(dst)
+            copy_path(src, dst)
+        except Exception as e:
+            print(f"An error occurred while {desc} ({dst}):{e}")
+            self.logger.exception(e)
+
+    def _track(self, coro):
+        self.pending.append(asyncio.ensure_future(coro))
+
+    def _flush(self):
+        if self.batch:
+            batch, self.batch = self.batch, []
+            self._track(self._run(self._write_batch, batch))
+
+    async def read(self, path: str, mode="r") -> str | bytes:
+        if mode != "r" or not path.startswith(self.text_roots):
+            return await self._run(read_path, path, mode)
+        if (text := self.texts.get(path)) is None:
+            text = self.texts[path] = await self._run(read_path, path, mode)
+        return text
+
+    async def remove(self, path: str):
+        await self._run(os.remove, path)
+
+    def prefetch(self, paths):
+        # Yields one read task per path, in order, keeping up to `limit` reads ahead of the consumer. Reads still ahead when
+        # the consumer stops early are cancelled, and the outcome of those already done is retrieved, so none is logged as
+        # an exception that was never retrieved.
+        self._bind()
+        paths = iter(paths)
+        tasks = deque(asyncio.ensure_future(self.read(p)) for p in islice(paths, self.limit))
+        try:
+            while tasks:
+                if (p := next(paths, None)) is not None:
+                    tasks.append(asyncio.ensure_future(self.read(p)))
+                yield tasks.popleft()
+        finally:
+            for task in tasks:
+                task.cancel()
+                task.add_done_callback(_retrieve)
+
+    def submit_write(self, path: str, data: str | bytes, desc="file"):
+        # Small writes issued in the same loop iteration share a single thread hop.
+        self._bind()
+        if len(data) >= SMALL_WRITE:
+            return self._track(self._run(self._write_batch, [(path, data, desc)]))
+        self.batch.append((path, data, desc))
+        if len(self.batch) == 1:
+            self.loop.call_soon(self._flush)
+        elif len(self.batch) >= BATCH_SIZE:
+            self._flush()
+
+    def submit_copy(self, src: str, dst: str, desc="copying file"):
+        self._bind()
+        self._track(self._run(self._copy, src, dst, desc))
+
+    async def drain(self):
+        self._bind()
+        self._flush()
+        # Concurrent drains may share tasks, so finished ones are only pruned once awaited.
+        while self.pending:
+            await asyncio.gather(*self.pending)
+            self.pending = [t for t in self.pending if not t.done()]
+
+
+def _retrieve(task: asyncio.Future):
+    if not task.cancelled():
+        task.exception()
+
+
+iox = IOExecutor()
@@ -48,3 +48,40 @@ class OBFStrType(Enum):
 
 
 obf_strs_dict = {e: BiMap() for e in OBFStrType}
+
+
+# Every pack starts from empty maps, so obfuscated names never leak from one pack or library call into the next.
+def reset_obf_strs():
+    for e in OBFStrType:
+        obf_strs_dict[e] = BiMap()
+
+
+# Worker processes never write the maps. Each batch carries a private copy of the names assigned so far, which answers lookups
+# without locks, and queues the names it is missing. The main process then commits the queues in submission order, so the
+# generated names don't depend on which worker finished first and can't collide.
+class NameView:
+    def __init__(self, names: dict[OBFStrType, dict[str, str]]):
+        self.names = names
+        self.requests: dict[tuple[str, OBFStrType, int], None] = {}
+
+    def get(self, data: str, enum: OBFStrType, default=None):
+        return self.names.get(enum, {}).get(data, default)
+
+    def request(self, data: str, enum: OBFStrType, link=0):
+        # Returns the assigned name, or None after queueing `data` for `commit_obf_strs`.
+        if (name := self.get(data, enum)) is None:
+            self.requests[data, enum, link] = None
+        return name
+
+
+def obf_strs_view(*enums: OBFStrType):
+    return NameView({e: dict(e.bi_map.forward) for e in enums})
+
+
+def commit_obf_strs(views: list[NameView], exclude=()):
+    from utils import gen_obfstr
+
+    for view in dict.fromkeys(views):  # in-process runs hand the same view back for every item
+        for data, enum, link in view.requests:
+            if data not in exclude:
+                gen_obfstr(data, enum, link)
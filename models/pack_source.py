@@ -0,0 +1,180 @@
+# Enigmata, an obfuscator for Minecraft Bedrock Editon resource packs.
+# Copyright (C) 2024 github.com/Eric-Joker
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import io
+import os
+import shutil
+import threading
+import time
+import zipfile
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import BinaryIO
+
+from .file_index import FileIndex
+
+
+# A resource pack directory. Paths are relative to the pack root and use os.sep, like FileHandler.path.
+class PackSource:
+    def __init__(self, root: str):
+        self.root = root
+
+    def index(self) -> FileIndex:
+        # Directories are listed and their files stat'ed in parallel, then added in the order os.walk yields them.
+        def scan(path: str) -> tuple[list[tuple[str, int, int]], list[tuple[str, Future]]]:
+            files, dirs = [], []
+            try:
+                with os.scandir(path) as it:
+                    for entry in it:
+                        try:
+                            is_dir = entry.is_dir()
+                        except OSError:
+                            is_dir = False
+                        if is_dir:
+                            if not entry.is_symlink():  # os.walk doesn't follow links either
+                                dirs.append(entry.name)
+                            continue
+                        try:
+                            files.append((entry.name, (stat := entry.stat()).st_size, stat.st_mtime_ns))
+                        except OSError:
+                            files.append((entry.name, -1, -1))
+            except OSError:
+                pass
+            return files, [(d, pool.submit(scan, os.path.join(path, d))) for d in dirs]
+
+        def collect(rel: str, future: Future):
+            files, dirs = future.result()
+            for name, size, mtime in files:
+                index.add(os.path.join(rel, name), size, mtime)
+            for name, sub in dirs:
+                collect(os.path.join(rel, name), sub)
+
+        index = FileIndex()
+        with ThreadPoolExecutor() as pool:
+            collect("", pool.submit(scan, self.root))
+        return index
+
+    def exists(self, rel_path: str) -> bool:
+        return os.path.exists(os.path.join(self.root, rel_path))
+
+    def size(self, rel_path: str) -> int:
+        return os.path.getsize(os.path.join(self.root, rel_path))
+
+    def open(self, rel_path: str) -> BinaryIO:
+        return open(os.path.join(self.root, rel_path), "rb")
+
+    def read(self, rel_path: str, mode="r") -> str | bytes:
+        return read_path(os.path.join(self.root, rel_path), mode)
+
+    def copy(self, rel_path: str, dst: str, how="copy"):
+        from utils import clone_file  # utils imports models
+
+        if how == "copy":
+            shutil.copy2(os.path.join(self.root, rel_path), dst)
+        else:
+            clone_file(os.path.join(self.root, rel_path), dst, how == "link")
+
+
+# A zipped pack (.mcpack, .zip) read in place: members are found through the central directory and only decompressed
+# when read. A pack nested in a single top-level folder of the archive is found too.
+class ArchiveSource(PackSource):
+    def __init__(self, root: str):
+        super().__init__(root)
+        self.local = threading.local()
+        names = {i.filename: i for i in self.zip.infolist() if not i.is_dir()}
+        prefix = ""
+        if (
+            "manifest.json" not in names
+            and len(tops := {n.partition("/")[0] for n in names}) == 1
+            and f"{(top := tops.pop())}/manifest.json" in names
+        ):
+            prefix = f"{top}/"
+        self.members = {n[len(prefix) :].replace("/", os.sep): i for n, i in names.items() if n.startswith(prefix)}
+
+    # ZipFile isn't safe to read from several threads at once, and a forked worker mustn't share the parent's file offset,
+    # so each thread of each process gets a handle of its own.
+    @property
+    def zip(self) -> zipfile.ZipFile:
+        if getattr(self.local, "pid", None) != os.getpid():
+            self.local.zipf = zipfile.ZipFile(self.root)
+            self.local.pid = os.getpid()
+        return self.local.zipf
+
+    def index(self) -> FileIndex:
+        index = FileIndex()
+        for rel_path, i in self.members.items():
+            index.add(rel_path, i.file_size, int(time.mktime((*i.date_time, 0, 0, -1))) * 1_000_000_000)
+        return index
+
+    def exists(self, rel_path: str) -> bool:
+        return rel_path in self.members
+
+    def size(self, rel_path: str) -> int:
+        return self.members[rel_path].file_size
+
+    def open(self, rel_path: str) -> BinaryIO:
+        return self.zip.open(self.members[rel_path])
+
+    def read(self, rel_path: str, mode="r") -> str | bytes:
+        data = self.zip.read(self.members[rel_path])
+        # Decoded like a text-mode open(), newline translation included.
+        return data if "b" in mode else io.TextIOWrapper(io.BytesIO(data), encoding="utf-8").read()
+
+    def copy(self, rel_path: str, dst: str, how="copy"):
+        if os.path.lexists(dst):
+            os.remove(dst)
+        with self.open(rel_path) as fsrc, open(dst, "wb") as fdst:
+            shutil.copyfileobj(fsrc, fdst, 1 << 20)
+        mtime = time.mktime((*self.members[rel_path].date_time, 0, 0, -1))
+        os.utime(dst, (mtime, mtime))
+
+
+# Archives by the root string the pipeline joins member paths onto, with the stat they were indexed at.
+archives: dict[str, tuple[ArchiveSource, tuple[int, int]]] = {}
+
+
+def pack_source(root: str) -> PackSource:
+    if not (os.path.isfile(root) and zipfile.is_zipfile(root)):
+        return PackSource(root)
+    # Indexed once, and again only after the archive changes on disk.
+    signature = ((stat := os.stat(root)).st_mtime_ns, stat.st_size)
+    if (cached := archives.get(root)) is None or cached[1] != signature:
+        archives[root] = cached = (ArchiveSource(root), signature)
+    return cached[0]
+
+
+# Full paths under a registered archive resolve to its members; everything else is a plain file.
+def resolve(path: str) -> tuple[ArchiveSource | None, str]:
+    for root, (source, _) in archives.items():
+        if path.startswith(root) and path[len(root) : len(root) + 1] in (os.sep, "/"):
+            return source, path[len(root) + 1 :].replace("/", os.sep)
+    return None, path
+
+
+def read_path(path: str, mode="r") -> str | bytes:
+    if archives and (source := resolve(path))[0]:
+        return source[0].read(source[1], mode)
+    with open(path, mode, **({} if "b" in mode else {"encoding": "utf-8"})) as f:
+        return f.read()
+
+
+def open_path(path: str) -> BinaryIO:
+    if archives and (source := resolve(path))[0]:
+        return source[0].open(source[1])
+    return open(path, "rb")
+
+
+def copy_path(src: str, dst: str, how="copy"):
+    source, rel_path = resolve(src) if archives else (None, src)
+    (source or PackSource("")).copy(rel_path, dst, how)
@@ -0,0 +1,356 @@
+# Enigmata, an obfuscator for Minecraft Bedrock Editon resource packs.
+# Copyright (C) 2024 github.com/Eric-Joker
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import logging
+import os
+from itertools import islice
+
+from wcmatch import glob
+
+from config import cfg
+
+from .bi_map import BiMap
+from .file_handler import FileHandler
+from .file_index import FileIndex
+from .io_executor import iox
+from .obf_strs import OBFStrType, obf_strs_dict
+from .pack_source import ArchiveSource, pack_source
+from .vanilla_data import vd
+
+# The lists of async_obf_pack, grouped by the stage that reads them.
+TEXTURES = frozenset(("renames", "obf_names"))
+REFERENCES = frozenset(("texture_jsons", "texture_jsons_2"))
+UIS = frozenset(("jsonuis", "uniqueuis", "langs", "ui_global_vars", "ui_defs"))
+ENTITIES = frozenset(("acs", "animations", "entities", "material_indexes", "models", "particles", "rcs", "materials"))
+# Lists whose files are merged into one file per format version, by the type in the merged document's key.
+MERGED_TYPES = {
+    "acs": "ANIMATION_CONTROLLERS",
+    "animations": "ANIMATIONS",
+    "models": "MODELS",
+    "rcs": "RENDER_CONTROLLERS",
+    "materials": "MATERIALS",
+}
+# The walk of Entities.async_obf_bone_patterns from a render controller to the bones its patterns match.
+BONE_WALK = (("entity", False), ("model_index", True), ("model", True), ("bone", True))
+
+
+def _subpack(rel_path: str) -> str:
+    return os.sep.join(parts[:2]) if (parts := rel_path.split(os.sep))[0] == "subpacks" and len(parts) > 2 else ""
+
+
+def _calls(key: str, ops: list | None):
+    # Yields the nodes and edges of one file's graph calls, add_node(type, value, is_unique) and add_edge(type, value, type,
+    # value), as (node, None) and (node, node). The DAG makes a new node for every non-unique call, like a model index, and
+    # links the latest one, so those are told apart by file and call.
+    latest = {}
+    for n, (is_edge, args) in enumerate(ops or ()):
+        if is_edge:
+            yield latest.get(args[:2], args[:2]), latest.get(args[2:], args[2:])
+        else:
+            if len(args) > 2 and not args[2]:
+                latest[args[:2]] = (args[0], (key, n, args[1]))
+            yield latest.get(args[:2], args[:2]), None
+
+
+def _nodes(ops: dict[str, list | None], keys) -> set[tuple]:
+    return {node for k in keys for edge in _calls(k, ops.get(k)) for node in edge if node is not None}
+
+
+def _edges(ops: dict[str, list | None]) -> dict[tuple[bool, tuple], set[tuple]]:
+    # (forward, node) => the nodes the pack's graph calls link it to.
+    edges = {}
+    for k, o in ops.items():
+        for a, b in _calls(k, o):
+            if b is not None:
+                edges.setdefault((True, a), set()).add(b)
+                edges.setdefault((False, b), set()).add(a)
+    return edges
+
+
+def _neighbours(node: tuple, forward: bool, edges: dict) -> set[tuple]:
+    # The pack's calls are matched by label and the vanilla graph is read as it is, so the walk takes in no less than the
+    # obfuscator's.
+    found = set(edges.get((forward, node), ()))
+    if (dag := vd.pkl.get("dag")) is not None and isinstance(node[1], str):
+        for i in dag.label_map.get(node[0], {}).get(node[1], ()):
+            found.update(tuple(n.split("#", 1)) for n in (dag.successors(i) if forward else dag.predecessors(i)))
+    return found
+
+
+def _bone_reach(rcs: set[str], edges: dict) -> set[tuple]:
+    reach = nodes = {("rc", rc) for rc in rcs}
+    for to_type, forward in BONE_WALK:
+        reach = reach | (nodes := {n for node in nodes for n in _neighbours(node, forward, edges) if n[0] == to_type})
+    return reach
+
+
+# What the last build of a watched pack left behind, so that a rebuild only processes the files that changed and the files
+# whose output depends on them. The maps keep the names given earlier in the session, so a name never changes while the
+# pack is watched; the output can therefore differ from a fresh run that only sees the current files.
+#
+# The dependencies are the ones the stages recorded while they processed the files: the graph calls of the entity files
+# (see Entities.async_obf), and the names the JsonUIs and the texture reference JSONs looked up in the maps. A changed file
+# is only known by its calls and names of the last build until the rebuild processes it, so async_record checks the new
+# ones again; when they reach a file the rebuild left alone, the state is reset and the pack is built again in full.
+class PackState:
+    def __init__(self, root_path: str):
+        self.logger = logging.getLogger(__name__)
+        self.root_path = root_path
+        self.index: FileIndex = None
+        self.snapshot: dict[str, tuple] = {}
+        self.changed: set[str] = set()  # since the last build
+        self.removed: set[str] = set()
+        if (root := os.path.join(root_path, "")) not in iox.text_roots:
+            iox.text_roots += (root,)
+        self.reset()
+
+    def reset(self):
+        # Forgets the last build; the next one starts from empty maps.
+        self.names: dict[OBFStrType, BiMap] = None
+        self.categories: dict[str, frozenset[str]] = {}  # source path => the lists it was put in
+        self.outputs: dict[str, str] = {}  # source path => its path in the output
+        self.generated: dict[str, set[str]] = {}  # list => outputs made of several files, like the merged ones
+        self.dag_ops: dict[str, list | None] = {}  # see Entities.async_obf
+        self.merged_rcs: set[str] = set()  # render controllers in the merged documents
+        # source path => the (map, name) pairs it looked up, or ("namespace", name) for a unique JsonUI; see UIs.async_obf and
+        # Images.async_rename
+        self.lookups: dict[str, set[tuple]] = {}
+        self.sources: dict[str, FileHandler] = {}
+        self.next_categories: dict[str, frozenset[str]] = {}
+        self.kept: set[str] = set()
+        # As async_select found them, for async_record.
+        self.previous_ops: dict[str, list | None] = {}
+        self.previous_lookups: dict[str, set[tuple]] = {}
+        self.sizes: dict[OBFStrType, int] = {}
+        self._keep_texts(())
+
+    @property
+    def built(self) -> bool:
+        return self.names is not None
+
+    def _excluded(self, rel_path: str) -> bool:
+        return glob.globmatch(rel_path, cfg.exclude_files, flags=glob.D | glob.G | glob.N)
+
+    def _keep_texts(self, paths):
+        # The text cache holds at most the files of this pack that the last build processed.
+        root = os.path.join(self.root_path, "")
+        iox.texts = {p: t for p, t in iox.texts.items() if not p.startswith(root) or p[len(root) :] in paths}
+
+    def scan(self) -> tuple[FileIndex, dict[str, tuple]]:
+        # One stat per file, so polling stays cheap without a file-system event dependency. An archive is listed again only
+        # after it changed on disk; its members are told apart by CRC, as their times are only precise to two seconds.
+        index = (source := pack_source(self.root_path)).index()
+        if isinstance(source, ArchiveSource):
+            return index, {p: (i.CRC, i.file_size) for p, i in source.members.items() if not self._excluded(p)}
+        return index, {
+            p: (index.mtimes[row], index.sizes[row])
+            for row, p in enumerate(index.paths)
+            if index.sizes[row] != -1 and not self._excluded(p)
+        }
+
+    def update(self, index: FileIndex, snapshot: dict[str, tuple]):
+        # Changes pile up until a build succeeds.
+        self.removed = (self.removed | (self.snapshot.keys() - snapshot.keys())) - snapshot.keys()
+        self.changed = (self.changed | {p for p, s in snapshot.items() if self.snapshot.get(p) != s}) - self.removed
+        for p in self.changed | self.removed:
+            iox.texts.pop(os.path.join(self.root_path, p), None)
+        self.index, self.snapshot = index, snapshot
+
+    def track(self, lists: dict[str, list[FileHandler]]):
+        # Called with the scanned lists, before any stage renames or merges their files.
+        self.sources = {fh.path: fh for l in lists.values() for fh in l}
+        categories = {}
+        for name, l in lists.items():
+            for fh in l:
+                categories.setdefault(fh.path, set()).add(name)
+        self.next_categories = {p: frozenset(c) for p, c in categories.items()}
+        self.kept = set(self.sources)
+
+    async def async_select(self, lists: dict[str, list[FileHandler]]) -> set[str]:
+        # Returns the source files the rebuild processes: the changed ones and those whose output depends on them. Removed
+        # files only have their outputs deleted afterwards.
+        categories, previous = self.next_categories, self.categories
+        touched = self.changed | self.removed
+        keep = set(self.changed)
+        self.previous_ops, self.previous_lookups = dict(self.dag_ops), dict(self.lookups)
+
+        def cats(p: str) -> frozenset[str]:
+            return categories.get(p, frozenset()) | previous.get(p, frozenset())
+
+        def members(*names: str) -> set[str]:
+            return {fh.path for n in names for fh in lists[n]}
+
+        # Textures. One that starts or stops being renamed changes how the reference JSONs spell it, and the name of its
+        # sidecar JSON. In a subpack the new names also depend on what its reference JSONs mention, so the renamed textures and
+        # the reference JSONs of a subpack are processed together.
+        spellings, subpacks = set(), set()
+        for p in touched:
+            if TEXTURES & cats(p):
+                if p not in categories or p not in previous:
+                    spellings.add(stem := os.path.splitext(p)[0].replace(os.sep, "/"))
+                    spellings.add("/".join(stem.split("/")[2 if _subpack(p) else 0 :]))
+                    keep.add(f"{os.path.splitext(p)[0]}.json")
+                    OBFStrType.FILENAME.bi_map.pop(p.replace("\\", "/"))
+                subpacks.add(_subpack(p))
+            elif REFERENCES & cats(p):
+                subpacks.add(_subpack(p))
+        subpacks.discard("")
+        refs = members(*REFERENCES)
+        keep.update(p for p in members(*TEXTURES) | refs if _subpack(p) in subpacks)
+        if spellings:
+            keep.update(p for p in refs - keep if self._looked_up(p, OBFStrType.FILENAME, spellings))
+
+        # JsonUIs. The merged file and _ui_defs.json are made from every unique JsonUI, and the names the unique ones declare
+        # are seen by all of them. Other JsonUIs are processed again when the namespaces or the global variables change;
+        # whether a name the rebuild adds reaches one is known afterwards.
+        if ui := {p for p in keep | touched if UIS & cats(p)}:
+            keep |= members("uniqueuis", "ui_global_vars", "ui_defs")
+            if any(
+                "ui_global_vars" in cats(p) or "uniqueuis" in cats(p) and (p not in categories or p not in previous) for p in ui
+            ):
+                keep |= members("jsonuis")
+            elif cfg.obfuscate_jsonui or cfg.merged_ui_path:
+                keep.update(p for p in members("jsonuis") if p not in self.lookups)
+
+        # Entities. Only render controllers read the graph back, for their bone patterns, so the render controllers processed
+        # again are those whose walk to the bones meets a node that the changed files' last calls touched. Merged files are
+        # made of their whole list.
+        if ent := {p for p in keep | touched if ENTITIES & cats(p)}:
+            if cfg.obfuscate_entity:
+                rcs = {p for p, c in categories.items() if "rcs" in c}
+                keep |= self._rcs_reaching(_nodes(self.dag_ops, self._op_keys(ent & touched, cats)), rcs, self.outputs)
+                ent |= keep & rcs
+            if cfg.merge_entity:
+                keep.update(p for n in MERGED_TYPES if any(n in cats(p) for p in ent) for p in members(n))
+            if any({"materials", "material_indexes"} & cats(p) for p in ent):
+                keep |= members("materials", "material_indexes")
+            # The files processed again record their graph calls anew; the ones left unset afterwards are dropped.
+            for k in self._op_keys(ent | {p for p in keep if ENTITIES & cats(p)}, cats):
+                self.dag_ops[k] = None
+
+        for p in keep:
+            self.lookups.pop(p, None)
+        self.sizes = {t: len(t.bi_map) for t in OBFStrType}
+        self.kept = keep
+        return keep
+
+    def _looked_up(self, p: str, obf_type: OBFStrType, names: set[str]) -> bool:
+        # Files that recorded nothing are taken to depend on anything. References may spell a texture with its extension.
+        if (lookups := self.lookups.get(p)) is None:
+            return True
+        return any(
+            t is obf_type and (os.path.splitext(n)[0] if n.endswith((".png", ".tga")) else n) in names for t, n in lookups
+        )
+
+    def _op_keys(self, paths, cats) -> set[str]:
+        # The keys the graph calls of these files are kept under: their outputs, or the merged documents of their lists.
+        keys = {o for p in paths if (o := self.outputs.get(p)) in self.dag_ops}
+        for n, t in MERGED_TYPES.items():
+            if any(n in cats(p) for p in paths):
+                keys.update(k for k in self.dag_ops if k.startswith(f"MERGED#{t}#"))
+        return keys
+
+    def _rcs_reaching(self, nodes: set[tuple], rcs: set[str], outputs: dict[str, str]) -> set[str]:
+        # The render controllers whose walk meets `nodes`, and those the graph can't place: vanilla ones that the stage
+        # doesn't traverse, and new ones.
+        if not nodes:
+            return set()
+        ops = {k: o for k, o in self.dag_ops.items() if o is not None}
+        edges, reach, found = _edges(ops), {}, set()
+        merged = tuple(k for k in ops if k.startswith("MERGED#RENDER_CONTROLLERS#"))
+        for p in rcs:
+            if (key := outputs.get(p)) in ops:
+                keys = (key,)
+            elif p in self.merged_rcs and merged:
+                keys = merged
+            else:
+                found.add(p)
+                continue
+            if keys not in reach:
+                labels = {args[1] for k in keys for is_edge, args in ops[k] if not is_edge and args[0] == "rc"}
+                reach[keys] = _bone_reach(labels, edges)
+            if reach[keys] & nodes:
+                found.add(p)
+        return found
+
+    def _missed(self, outputs: dict[str, str]) -> set[str]:
+        # The files the rebuild left alone that its new graph calls or names reach.
+        left = self.sources.keys() - self.kept
+        ops = {k: o for k, o in self.dag_ops.items() if o is not None}
+        changed_ops = {k for k in ops.keys() | self.previous_ops.keys() if ops.get(k) != self.previous_ops.get(k)}
+        nodes = _nodes(self.previous_ops, changed_ops) | _nodes(ops, changed_ops)
+        missed = self._rcs_reaching(nodes, {p for p in left if "rcs" in self.next_categories[p]}, outputs)
+
+        def namespaces(lookups: set[tuple]) -> set[tuple]:
+            return {l for l in lookups if l[0] == "namespace"}
+
+        # A unique JsonUI that now declares another namespace changes how every JsonUI resolves the old and new one.
+        if any(
+            namespaces(self.previous_lookups[p]) != namespaces(self.lookups.get(p, ()))
+            for p in self.kept
+            if "uniqueuis" in self.next_categories.get(p, ()) and p in self.previous_lookups
+        ):
+            missed.update(p for p in left if "jsonuis" in self.next_categories[p])
+        added = {(t, k) for t, n in self.sizes.items() for k in islice(t.bi_map.forward, n, None)}
+        return missed | {p for p in left if not added.isdisjoint(self.lookups.get(p, ()))}
+
+    async def async_record(self, lists: dict[str, list[FileHandler]], passthroughs: dict[str, str], work_path: str):
+        # Remembers what the build produced and deletes the outputs left without a source. A rebuild that missed a dependant
+        # resets the state instead, for a full build to follow.
+        categories, renamed = self.next_categories, OBFStrType.FILENAME.bi_map
+        outputs = {p: p for p in passthroughs}
+        for p, fh in self.sources.items():
+            if p not in self.kept:
+                outputs[p] = self.outputs.get(p, p)
+            elif TEXTURES & categories[p]:
+                outputs[p] = renamed.get(slashed := p.replace("\\", "/"), slashed).replace("/", os.sep)
+            else:
+                outputs[p] = fh.path
+
+        sources = {id(fh) for fh in self.sources.values()}
+        rerun = {
+            n for p in self.kept | self.removed for n in categories.get(p, frozenset()) | self.categories.get(p, frozenset())
+        }
+        generated = {
+            n: {fh.path for fh in l if id(fh) not in sources} if n in rerun else self.generated.get(n, set())
+            for n, l in lists.items()
+            if n not in ("pngs", "tgas")  # the renamed images, already in `outputs`
+        }
+        current = set(outputs.values()).union(*generated.values())
+        stale = {self.outputs.get(p) for p in self.removed | self.kept}.union(*self.generated.values())
+        for p in stale - current - {None}:
+            try:
+                await iox.remove(os.path.join(work_path, p))
+            except FileNotFoundError:
+                pass
+            except Exception as e:
+                print(f"An error occurred while removing file ({p}):{e}")
+                self.logger.exception(e)
+
+        # The stages drop the render controllers they merge from the list.
+        present = {id(fh) for fh in lists["rcs"]}
+        merged = {p for p in self.kept if "rcs" in categories.get(p, ()) and id(self.sources[p]) not in present}
+        self.merged_rcs = (self.merged_rcs - self.kept - self.removed) | merged
+        for p in self.removed:
+            self.lookups.pop(p, None)
+        self.dag_ops = {k: v for k, v in self.dag_ops.items() if v is not None}
+        missed = self._missed(outputs) if self.built and self.kept != self.sources.keys() else ()
+
+        self.names = dict(obf_strs_dict)
+        self.categories, self.outputs, self.generated = categories, outputs, generated
+        self.changed, self.removed = set(), set()
+        self._keep_texts(self.kept)
+        if missed:
+            self.reset()
@@ -13,53 +13,139 @@
 #
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
-from tqdm import tqdm
+import json
+import sys
+import time
+from typing import TYPE_CHECKING
 
 from config import cfg
 
+if TYPE_CHECKING:
+    from tqdm import tqdm
 
+REFRESH_INTERVAL = 0.1
+
+
+# Counters are plain ints; the bar and the jsonl sink only see them at most once per REFRESH_INTERVAL.
 class PbarManager:
     def __init__(self):
         self.n_file = 0
         self.t_file = 0
-        self.pbar: tqdm = None
+        self.n = 0
+        self.total = 0
+        self.desc = ""
+        self.pbar: "tqdm" = None
+        self.enabled = False
+        self.start_time = 0
+        self.next_flush = 0
+        self.last_event = None
+        self.stream = None  # jsonl sink, stdout when unset
 
-    def check_console(func):
-        def wrapper(*args, **kwargs):
-            return func(*args, **kwargs) if cfg.console else None
+    def check_enabled(func):
+        def wrapper(self, *args, **kwargs):
+            return func(self, *args, **kwargs) if self.enabled else None
 
         return wrapper
 
-    @check_console
+    def start(self, desc):
+        self.n = self.total = self.n_file = self.t_file = 0
+        self.last_event = None
+        self.desc = desc
+        self.enabled = cfg.progress == "jsonl" or callable(cfg.progress) or cfg.console
+        self.start_time = time.monotonic()
+        if cfg.progress == "jsonl" and cfg.progress_file and self.stream is None:
+            self.stream = open(cfg.progress_file, "a", encoding="utf-8")
+        if cfg.progress == "bar" and cfg.console:
+            from tqdm import tqdm
+
+            self.pbar = tqdm(
+                total=0,
+                nrows=0,
+                unit="items",
+                desc=desc,
+                bar_format="{desc} {percentage:3.0f}%|{bar}| {n_fmt}/{total_fmt}{unit} {elapsed}",
+            )
+        self.refresh()
+
+    @check_enabled
+    def refresh(self, now: float = None):
+        self.next_flush = (now := time.monotonic() if now is None else now) + REFRESH_INTERVAL
+        if self.pbar is not None:
+            self.pbar.total = self.total
+            self.pbar.n = self.n
+            self.pbar.unit = f"items {self.n_file}/{self.t_file}files"
+            self.pbar.refresh()
+        if cfg.progress != "bar" and (event := (self.desc, self.n, self.total, self.n_file, self.t_file)) != self.last_event:
+            self.last_event = event
+            event = {
+                "stage": self.desc,
+                "items": self.n,
+                "total_items": self.total,
+                "files": self.n_file,
+                "total_files": self.t_file,
+                "elapsed": round(now - self.start_time, 3),
+            }
+            self.emit(event)
+
+    def emit(self, event: dict):
+        # Library callers may pass a callable instead of a sink name.
+        if callable(cfg.progress):
+            cfg.progress(event)
+        else:
+            (stream := self.stream or sys.stdout).write(json.dumps(event) + "\n")
+            stream.flush()
+
+    # A one-off summary: an event of its own for the jsonl sink and progress callables, a console line otherwise.
+    def report(self, summary: str, message: str, **fields):
+        if cfg.progress != "bar":
+            self.emit({"stage": self.desc, "summary": summary, "message": message, **fields})
+        elif cfg.console:
+            (print if self.pbar is None else self.pbar.write)(message)
+
+    def tick(self):
+        if (now := time.monotonic()) >= self.next_flush:
+            self.refresh(now)
+
+    @check_enabled
     def set_description(self, desc):
-        self.pbar.set_description(desc)
+        self.desc = desc
+        if self.pbar is not None:
+            self.pbar.set_description(desc, False)
+        self.refresh()
 
-    @check_console
+    @check_enabled
     def update_t_file(self):
         self.t_file += 1
-        self.pbar.unit = f"items {self.n_file}/{self.t_file}files"
-        # self.pbar.refresh()
+        self.tick()
 
-    @check_console
+    @check_enabled
     def revert_t_item(self, increment=1):
-        self.pbar.total -= increment
-        # self.pbar.refresh()
+        self.total -= increment
+        self.tick()
 
-    @check_console
+    @check_enabled
     def update_t_item(self, increment=1):
-        self.pbar.total += increment
-        # self.pbar.refresh()
+        self.total += increment
+        self.tick()
 
-    @check_console
+    @check_enabled
     def update_n_file(self, increment=1):
         self.n_file += increment
-        self.pbar.unit = f"items {self.n_file}/{self.t_file}files"
-        # self.pbar.refresh()
+        self.tick()
 
-    @check_console
+    @check_enabled
     def update(self, increment=1):
-        self.pbar.unit = f"items {self.n_file}/{self.t_file}files"
-        self.pbar.update(increment)
+        self.n += increment
+        self.tick()
+
+    def close(self):
+        self.refresh()
+        if self.pbar is not None:
+            self.pbar.close()
+            self.pbar = None
+        if cfg.progress_file and self.stream is not None:
+            self.stream.close()
+            self.stream = None
 
 
 pbm = PbarManager()
@@ -14,27 +14,28 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 import asyncio
+import hashlib
 import json
 import logging
 import os
 import pickle
 import sys
 import time
-from datetime import datetime
-from typing import Any, Callable
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, Any, Callable
 
 import regex as re
 from wcmatch import glob
 
 from config import cfg
-from models import DAG
 from utils import (
-    ENTITY_CHARS,
+    ENTITY_PREFIXES,
     IGNORE_RC_KEYS,
     TraverseControls,
     TraverseJson,
     comment_pattern,
-    default_read,
     get_ac_id,
     get_animation_id,
     get_model_id,
@@ -47,27 +48,183 @@ from utils import (
     uivar_pattern,
 )
 
+from .pack_source import ArchiveSource, open_path, pack_source, read_path
+
+if TYPE_CHECKING:
+    from models import DAG
+
 molang_var_pattern = re.compile(
     r"(?<=(?:[!&|<>=*/+\-(){}?[\];',\s]|^)(?:v|t|c|variable|temp|context))\.(.+?)(?=[!&|<>=*/+\-(){}?[\];',\s.]|$)",
     flags=re.I,
 )
+uibind_pattern = re.compile(r'(#.*?)(?=[\|\)\s"])')
+
+ENTITY_MAPPING = {
+    "animation_controllers": ("animation_index", "animation"),
+    "render_controllers": ("rc",),
+    "materials": ("material_index",),
+    "textures": ("texture_index",),
+    "geometry": ("model_index", "model"),
+    "animations": ("animation_index", "animation"),
+    "animate": ("animation_index", "animation"),
+    "particle_effects": ("particle_index", "particle"),
+}
+# Sets that list the path of every vanilla file of a kind, without the vanilla pack directory.
+PATH_SETS = {
+    "pngs": "pngs",
+    "tgas": "tgas",
+    "ac": "animation_controllers",
+    "animation": "animations",
+    "rc": "render_controllers",
+    "particle": "particles",
+    "materials": "materials",
+    "model": "models",
+}
+# Sets that are the union of what each vanilla file contributes. ui_properties and ui_keywords depend on every JSON UI file
+# at once instead.
+FILE_SETS = (
+    "pngs",
+    "tgas",
+    "l10n",
+    "ui_variables",
+    "ui_bindings",
+    "animation_controllers",
+    "animations",
+    "render_controllers",
+    "materials",
+    "models",
+    "particles",
+    "material_ids",
+)
+
+
+def vanilla_kind(rel_path: str) -> str | None:
+    if rel_path.endswith(".png"):
+        return "pngs"
+    elif rel_path.endswith(".tga"):
+        return "tgas"
+    elif glob.globmatch(rel_path, "*/animation_controllers/*.json", flags=glob.D):
+        return "ac"
+    elif glob.globmatch(rel_path, "*/animations/*.json", flags=glob.D):
+        return "animation"
+    elif glob.globmatch(rel_path, "*/render_controllers/*.json", flags=glob.D):
+        return "rc"
+    elif glob.globmatch(rel_path, "*/entity/*.json", flags=glob.D):
+        return "entity"
+    elif glob.globmatch(rel_path, "*/particles/*.json", flags=glob.D):
+        return "particle"
+    elif glob.globmatch(rel_path, "*/materials/*.material", flags=glob.D):
+        return "materials"
+    elif glob.globmatch(rel_path, "*/models/**/*.json", flags=glob.D | glob.G):
+        return "model"
+    elif glob.globmatch(rel_path, "*/ui/**/*.json", flags=glob.D | glob.G):
+        return "ui"
+    elif glob.globmatch(rel_path, "*/texts/en_US.lang", flags=glob.D):
+        return "lang"
+    return None
+
+
+# Archives that can stand in for vanilla pack directories, or for the whole resource_packs directory.
+VANILLA_ARCHIVES = (".zip", ".mcpack", ".apk")
+
+
+def is_vanillas_path(path: str) -> bool:
+    return os.path.isdir(path) or os.path.isfile(path) and zipfile.is_zipfile(path)
+
+
+# Yields (rel_path, path, size, mtime) for the files of the vanilla packs under root, with rel_path starting at the pack folder
+# as in an unpacked resource_packs directory. Zipped packs next to the unpacked ones, and root itself being an archive such
+# as the game's APK, are listed from the central directory; path then points into the archive and is read with
+# read_path/open_path without unpacking anything.
+# Sorted by path, so the packs and their files come in the same order whether they are folders, separate archives, one zip
+# or the APK, and the DAG built in that order is the same too.
+def walk_vanillas(root: str):
+    return sorted(_walk_vanillas(root), key=lambda f: f[0])
+
+
+def _walk_vanillas(root: str):
+    if isinstance(source := pack_source(root), ArchiveSource):
+        yield from walk_vanilla_archive(root, source, os.path.basename(root))
+        return
+    index = source.index()
+    for rel_path, size, mtime in zip(index.paths, index.sizes, index.mtimes):
+        path = os.path.join(root, rel_path)
+        if os.sep not in rel_path and rel_path.lower().endswith(VANILLA_ARCHIVES):
+            if isinstance(archive := pack_source(path), ArchiveSource):
+                yield from walk_vanilla_archive(path, archive, rel_path)
+                continue
+        yield rel_path, path, size, mtime
+
+
+# An archive holds either one pack, named after the archive, or several packs in its resource_packs folder
+# (assets/resource_packs/ in the APK) or else at its root.
+def walk_vanilla_archive(root: str, source: ArchiveSource, name: str):
+    index = source.index()
+    if "manifest.json" in index:
+        for rel_path, size, mtime in zip(index.paths, index.sizes, index.mtimes):
+            yield os.path.join(name, rel_path), os.path.join(root, rel_path), size, mtime
+        return
+    folder = f"{os.sep}resource_packs{os.sep}"
+    prefix = min(
+        (p[: i + len(folder) - 1] for p in index.paths if (i := f"{os.sep}{p}".find(folder)) != -1), key=len, default=""
+    )
+    for rel_path, size, mtime in zip(index.paths, index.sizes, index.mtimes):
+        if rel_path.startswith(prefix):
+            yield rel_path[len(prefix) :], os.path.join(root, rel_path), size, mtime
+
+
+def file_digest(path: str) -> bytes | None:
+    try:
+        with open_path(path) as f:
+            return hashlib.file_digest(f, "blake2b").digest()
+    except Exception:
+        return None
+
+
+# What one vanilla file contributed to the data, kept in the data file so that a re-extraction only processes the files
+# whose digest changed.
+@dataclass
+class VanillaFile:
+    kind: str
+    size: int
+    mtime: int  # ns
+    digest: bytes | None
+    entries: dict[str, tuple] = field(default_factory=dict)  # FILE_SETS name => items
+    ops: tuple = ()  # DAG calls in order, as (is_edge, args)
+
+
+# Stands in for the DAG while a file is extracted. Nodes and edges are deduplicated by what is already in the graph, so the
+# calls of every file are replayed in walk order instead of being merged into an existing graph.
+class DAGRecorder(list):
+    def add_node(self, *args):
+        self.append((False, args))
+
+    def add_edge(self, *args):
+        self.append((True, args))
 
 
 class VanillaData:
     def __init__(self):
         self.logger = logging.getLogger(__name__)
         self.pkl = {}
+        self.loaded_path = None
 
+    # Deferred to startup instead of import time, so worker processes and runs without JsonUI/entity obfuscation skip it.
+    def load(self):
         if cfg.extract:
-            asyncio.run(self.async_extract())
+            cfg.select_vanilla_data()
+            if cfg.vanilla_data:
+                self._load_pkl()
+            asyncio.run(self.async_extract(self.pkl))
             sys.exit()
+        cfg.select_vanilla_data()
         self.reload()
 
     def reload(self):
         if not cfg.is_vanilla_data_needed:
             return
         elif not cfg.vanilla_data:
-            if os.path.isdir(cfg.vanillas_path):
+            if is_vanillas_path(cfg.vanillas_path):
                 if str2bool(input("Can't find the extracted vanilla data file, generate it? (y or n) ")):
                     asyncio.run(self.async_extract())
                     return
@@ -78,94 +235,132 @@ class VanillaData:
             pause(
                 "This can cause serious problems with obfuscation. Press any key to start the obfuscation or Ctrl+C to terminate the process."
             )
-        elif cfg.vanilla_data and (datetime.now() - datetime.fromtimestamp(os.path.getmtime(cfg.vanilla_data))).days >= 60:
-            if os.path.isdir(cfg.vanillas_path):
-                if str2bool(input("The vanilla data file is too old, regenerate it? (y or n) ")):
-                    asyncio.run(self.async_extract())
-                    return
-            else:
-                pause(
-                    "The vanilla data file is too old, and can't generate it because can't read the original game resource packs directory. Press any key to start the obfuscation."
-                )
         else:
-            try:
-                with open(cfg.vanilla_data, "rb") as f:
-                    self.pkl = pickle.load(f)
-            except Exception as e:
-                print(f"An error occurred while loading Vanilla Data file ({cfg.vanilla_data}):{e}")
-                self.logger.exception(e)
-
-    async def async_extract(self):
-        dag = DAG()
-        self.pkl = {
-            "pngs": set(),
-            "tgas": set(),
-            "l10n": set(),
-            "ui_variables": set(),
-            "ui_bindings": set(),
-            "ui_properties": set(),
-            "ui_keywords": set(),
-            "animation_controllers": set(),
-            "animations": set(),
-            "render_controllers": set(),
-            "materials": set(),
-            "models": set(),
-            "particles": set(),
-            "material_ids": set(),
-            "dag": dag,
-        }
-        uibind_pattern = re.compile(r'(#.*?)(?=[\|\)\s"])')
-        jsonuis = []
-        ui_namespace = []
-        property_discarded = set()
-        entity_mapping = {
-            "animation_controllers": ("animation_index", "animation"),
-            "render_controllers": ("rc",),
-            "materials": ("material_index",),
-            "textures": ("texture_index",),
-            "geometry": ("model_index", "model"),
-            "animations": ("animation_index", "animation"),
-            "animate": ("animation_index", "animation"),
-            "particle_effects": ("particle_index", "particle"),
-        }
+            self._load_pkl()
+            if is_vanillas_path(cfg.vanillas_path) and (changes := self.count_changes()):
+                if str2bool(input(f"{changes} vanilla files changed since the data file was extracted, update it? (y or n) ")):
+                    asyncio.run(self.async_extract(self.pkl))
+
+    # For library calls: never prompts, and a file that is already loaded is reused across calls.
+    def ensure_loaded(self):
+        cfg.select_vanilla_data()
+        if not cfg.is_vanilla_data_needed or self.loaded_path == cfg.vanilla_data:
+            return
+        if not cfg.vanilla_data:
+            self.logger.error("Can't find the extracted vanilla data file.")
+            return
+        self._load_pkl()
 
-        process_path = lambda rel_path, k: self.pkl[k].add("/".join(rel_path.split(os.sep)[1:]))
+    def _load_pkl(self):
+        try:
+            with open(cfg.vanilla_data, "rb") as f:
+                self.pkl = pickle.load(f)
+            self.loaded_path = cfg.vanilla_data
+        except Exception as e:
+            print(f"An error occurred while loading Vanilla Data file ({cfg.vanilla_data}):{e}")
+            self.logger.exception(e)
 
-        def stats_jsonui(data: dict, is_control):
-            for k, v in data.items():
-                if not is_control and k not in property_discarded:
-                    if isinstance(v, str):
-                        if "#" in k or "$" in k or "_name" in k or "_control" in k or "@" in v:
-                            self.pkl["ui_properties"].discard(k)
-                            property_discarded.add(k)
-                        else:
-                            for ns in ui_namespace:
-                                if f"{ns}." in v:
-                                    self.pkl["ui_properties"].discard(k)
-                                    property_discarded.add(k)
-                                    break
-                            if k not in property_discarded:
-                                self.pkl["ui_properties"].add(k)
-                    else:
-                        self.pkl["ui_properties"].discard(k)
-                        property_discarded.add(k)
+    # Compares the vanilla resource packs with the files recorded in the data. Only files whose size or mtime differs from
+    # the record are hashed, so a check of an unchanged game only lists the files.
+    def _diff(self, records: dict[str, VanillaFile]):
+        stats = {}
+        for rel_path, path, size, mtime in walk_vanillas(cfg.vanillas_path):
+            if kind := vanilla_kind(rel_path):
+                stats[rel_path] = (kind, size, mtime, path)
+        stale = [
+            p for p, (_, size, mtime, _) in stats.items() if (r := records.get(p)) is None or (r.size, r.mtime) != (size, mtime)
+        ]
+        with ThreadPoolExecutor() as pool:
+            digests = dict(zip(stale, pool.map(file_digest, (stats[p][3] for p in stale))))
+        changed = [p for p, digest in digests.items() if (r := records.get(p)) is None or digest is None or r.digest != digest]
+        return stats, digests, changed, [p for p in records if p not in stats]
+
+    def count_changes(self) -> int:
+        _, _, changed, removed = self._diff(self.pkl.get("files", {}))
+        return len(changed) + len(removed)
+
+    # Without a previous data file every vanilla file is extracted. With one, only added and changed files are read, the
+    # sets are patched with what they and the removed files contributed, the DAG is replayed from the recorded calls and the
+    # JsonUI pass reruns if a JSON UI or language file changed.
+    async def async_extract(self, previous: dict = None):
+        from models import DAG
+
+        records: dict[str, VanillaFile] = previous.get("files", {}) if previous else {}
+        stats, digests, changed, removed = self._diff(records)
+        if records and not changed and not removed:
+            print("The vanilla data file is up to date.")
+            return
 
-                if (
-                    isinstance(v, str)
-                    and ("$" == k[0] or "#" == k[0])
-                    and "$" not in v
-                    and "#" not in v
-                    and "@" not in v
-                    and ")" not in v
-                    and v not in self.l10n
-                ):
-                    self.pkl["ui_keywords"].add(v)
-            return data, False
+        files = {}
+        changed_paths = set(changed)
+        for rel_path, (kind, size, mtime, _) in stats.items():
+            if (record := records.get(rel_path)) is None or rel_path in changed_paths:
+                record = VanillaFile(kind, size, mtime, digests[rel_path])
+            else:
+                record.size, record.mtime = size, mtime
+            files[rel_path] = record
+        dropped = [records[p] for p in removed] + [records[p] for p in changed if p in records]
+        if not records:
+            self.pkl = {
+                "pngs": set(),
+                "tgas": set(),
+                "l10n": set(),
+                "ui_variables": set(),
+                "ui_bindings": set(),
+                "ui_properties": set(),
+                "ui_keywords": set(),
+                "animation_controllers": set(),
+                "animations": set(),
+                "render_controllers": set(),
+                "materials": set(),
+                "models": set(),
+                "particles": set(),
+                "material_ids": set(),
+                "dag": DAG(),
+            }
+        else:
+            self.pkl = previous
+
+        jsonuis = {}
+        for rel_path in changed:
+            record = files[rel_path]
+            record.entries, record.ops = self._extract_file(rel_path, stats[rel_path][3], record.kind, jsonuis)
+
+        for k in FILE_SETS:
+            if gone := {v for r in dropped for v in r.entries.get(k, ())}:
+                gone.difference_update(v for r in files.values() for v in r.entries.get(k, ()))
+                self.pkl[k] -= gone
+            self.pkl[k].update(v for p in changed for v in files[p].entries.get(k, ()))
+
+        updated = dropped + [files[p] for p in changed]
+        if any(r.ops for r in updated):
+            self.pkl["dag"] = dag = DAG()
+            dag.label_map = {}
+            for record in files.values():
+                for is_edge, args in record.ops:
+                    (dag.add_edge if is_edge else dag.add_node)(*args)
+        if not records or any(r.kind in ("ui", "lang") for r in updated):
+            self._stats_jsonuis({p: stats[p][3] for p, r in files.items() if r.kind == "ui"}, jsonuis)
+        self.pkl["files"] = files
+        if records:
+            print(f"Extracted {len(changed)} added or changed vanilla files and dropped {len(removed)} removed ones.")
 
-        def stats_es(path: str, key: str = None):
-            with default_read(path) as f:
-                data = f.read()
-            data = json.loads(comment_pattern.sub("", data))
+        cfg.vanilla_data = os.path.join(cfg.data_path, time.strftime("VanillaData_%Y-%m-%d-%H-%M-%S.pkl"))
+        print(f"Vanilla Data file is saved to {cfg.vanilla_data}")
+        try:
+            with open(cfg.vanilla_data, "wb") as f:
+                pickle.dump(self.pkl, f)
+            self.loaded_path = cfg.vanilla_data
+        except Exception as e:
+            print(f"An error occurred while writing Vanilla Data file ({cfg.vanilla_data}):{e}")
+            self.logger.exception(e)
+
+    def _extract_file(self, rel_path: str, path: str, kind: str, jsonuis: dict):
+        entries = {}
+        dag = DAGRecorder()
+
+        def stats_es(key: str):
+            data = json.loads(comment_pattern.sub("", read_path(path)))
             instance = TraverseStats()
             match key:
                 case "ac":
@@ -180,7 +375,7 @@ class VanillaData:
                         dag,
                         stats_index,
                         stats_index_str,
-                        entity_mapping,
+                        ENTITY_MAPPING,
                     )
                 case "materials":
                     if controls := data.get(key):
@@ -195,73 +390,85 @@ class VanillaData:
                     instance.traverse(data, key, get_rc_id, dag, ignore_keys=IGNORE_RC_KEYS)
 
         def stats_index(k, v, entity, tag):
-            if tag in entity_mapping:
-                dag.add_node(entity_mapping[tag][0], k, tag == "render_controllers")
-                dag.add_edge("entity", entity, entity_mapping[tag][0], k)
-                if len(entity_mapping[tag]) == 2:
-                    dag.add_node(entity_mapping[tag][1], v)
-                    dag.add_edge("entity", entity, entity_mapping[tag][1], v)
-                    dag.add_edge(entity_mapping[tag][0], k, entity_mapping[tag][1], v)
+            if tag in ENTITY_MAPPING:
+                dag.add_node(ENTITY_MAPPING[tag][0], k, tag == "render_controllers")
+                dag.add_edge("entity", entity, ENTITY_MAPPING[tag][0], k)
+                if len(ENTITY_MAPPING[tag]) == 2:
+                    dag.add_node(ENTITY_MAPPING[tag][1], v)
+                    dag.add_edge("entity", entity, ENTITY_MAPPING[tag][1], v)
+                    dag.add_edge(ENTITY_MAPPING[tag][0], k, ENTITY_MAPPING[tag][1], v)
 
         def stats_index_str(data, entity, tag):
-            if tag in entity_mapping:
-                dag.add_node(entity_mapping[tag][0], data, tag == "render_controllers")
-                dag.add_edge("entity", entity, entity_mapping[tag][0], data)
+            if tag in ENTITY_MAPPING:
+                dag.add_node(ENTITY_MAPPING[tag][0], data, tag == "render_controllers")
+                dag.add_edge("entity", entity, ENTITY_MAPPING[tag][0], data)
 
         def process_bone(k, v, model, _):
             if k == "name":
                 dag.add_node("bone", v)
                 dag.add_edge("model", model, "bone", v)
 
-        for root, _, files in os.walk(cfg.vanillas_path):
-            for file in files:
-                if (rel_path := os.path.relpath((path := os.path.join(root, file)), cfg.vanillas_path)).endswith(".png"):
-                    process_path(rel_path, "pngs")
-                elif rel_path.endswith(".tga"):
-                    process_path(rel_path, "tgas")
-                elif glob.globmatch(rel_path, "*/animation_controllers/*.json", flags=glob.D):
-                    process_path(rel_path, "animation_controllers")
-                    stats_es(path, "ac")
-                elif glob.globmatch(rel_path, "*/animations/*.json", flags=glob.D):
-                    process_path(rel_path, "animations")
-                    stats_es(path, "animation")
-                elif glob.globmatch(rel_path, "*/render_controllers/*.json", flags=glob.D):
-                    process_path(rel_path, "render_controllers")
-                    stats_es(path, "rc")
-                elif glob.globmatch(rel_path, "*/entity/*.json", flags=glob.D):
-                    stats_es(path, "entity")
-                elif glob.globmatch(rel_path, "*/particles/*.json", flags=glob.D):
-                    process_path(rel_path, "particles")
-                    stats_es(path, "particle")
-                elif glob.globmatch(rel_path, "*/materials/*.material", flags=glob.D):
-                    process_path(rel_path, "materials")
-                    self.pkl["material_ids"].update(stats_es(path, "materials"))
-                elif glob.globmatch(rel_path, "*/models/**/*.json", flags=glob.D | glob.G):
-                    process_path(rel_path, "models")
-                    stats_es(path, "model")
-                elif glob.globmatch(rel_path, "*/ui/**/*.json", flags=glob.D | glob.G):
-                    with default_read(path) as f:
-                        data = f.read()
-                    self.pkl["ui_variables"].update(iter(uivar_pattern.findall(data)))
-                    self.pkl["ui_bindings"].update(iter(uibind_pattern.findall(data)))
-                    ui_namespace.append((j := json.loads(comment_pattern.sub("", data))).get("namespace"))
-                    jsonuis.append(j)
-                elif glob.globmatch(rel_path, "*/texts/en_US.lang", flags=glob.D):
-                    with default_read(path) as f:
-                        data = f.read()
-                    self.pkl["l10n"].update(iter(l10n_pattern.findall(data)))
-
-        for j in jsonuis:
-            TraverseControls(stats_jsonui).traverse(j)
+        if k := PATH_SETS.get(kind):
+            entries[k] = ("/".join(rel_path.split(os.sep)[1:]),)
+        match kind:
+            case "pngs" | "tgas":
+                pass
+            case "materials":
+                entries["material_ids"] = tuple(dict.fromkeys(stats_es(kind)))
+            case "ui":
+                data = read_path(path)
+                entries["ui_variables"] = tuple(dict.fromkeys(uivar_pattern.findall(data)))
+                entries["ui_bindings"] = tuple(dict.fromkeys(uibind_pattern.findall(data)))
+                jsonuis[rel_path] = json.loads(comment_pattern.sub("", data))
+            case "lang":
+                entries["l10n"] = tuple(dict.fromkeys(l10n_pattern.findall(read_path(path))))
+            case _:
+                stats_es(kind)
+        return entries, tuple(dag)
+
+    # Whether a key is a property depends on the namespaces of every JSON UI file, so this pass always covers all of them.
+    def _stats_jsonuis(self, paths: dict[str, str], jsonuis: dict):
+        for rel_path, path in paths.items():
+            if rel_path not in jsonuis:
+                jsonuis[rel_path] = json.loads(comment_pattern.sub("", read_path(path)))
+        ui_namespace = [jsonuis[p].get("namespace") for p in paths]
+        property_discarded = set()
+        self.pkl["ui_properties"] = set()
+        self.pkl["ui_keywords"] = set()
 
-        cfg.vanilla_data = os.path.join(cfg.data_path, time.strftime("VanillaData_%Y-%m-%d-%H-%M-%S.pkl"))
-        print(f"Vanilla Data file is saved to {cfg.vanilla_data}")
-        try:
-            with open(cfg.vanilla_data, "wb") as f:
-                pickle.dump(self.pkl, f)
-        except Exception as e:
-            print(f"An error occurred while writing Vanilla Data file ({cfg.vanilla_data}):{e}")
-            self.logger.exception(e)
+        def stats_jsonui(data: dict, is_control):
+            for k, v in data.items():
+                if not is_control and k not in property_discarded:
+                    if isinstance(v, str):
+                        if "#" in k or "$" in k or "_name" in k or "_control" in k or "@" in v:
+                            self.pkl["ui_properties"].discard(k)
+                            property_discarded.add(k)
+                        else:
+                            for ns in ui_namespace:
+                                if f"{ns}." in v:
+                                    self.pkl["ui_properties"].discard(k)
+                                    property_discarded.add(k)
+                                    break
+                            if k not in property_discarded:
+                                self.pkl["ui_properties"].add(k)
+                    else:
+                        self.pkl["ui_properties"].discard(k)
+                        property_discarded.add(k)
+
+                if (
+                    isinstance(v, str)
+                    and ("$" == k[0] or "#" == k[0])
+                    and "$" not in v
+                    and "#" not in v
+                    and "@" not in v
+                    and ")" not in v
+                    and v not in self.l10n
+                ):
+                    self.pkl["ui_keywords"].add(v)
+            return data, False
+
+        for p in paths:
+            TraverseControls(stats_jsonui).traverse(jsonuis[p])
 
     @property
     def pngs(self) -> set:
@@ -374,7 +581,7 @@ class VanillaData:
         )
 
     @property
-    def dag(self) -> DAG:
+    def dag(self) -> "DAG":
         return self.pkl["dag"]
 
 
@@ -387,7 +594,7 @@ class TraverseStats(TraverseJson):
         data,
         node_type: str,
         get_id: Callable,
-        dag: DAG,
+        dag: "DAG",
         k_extra: Callable = lambda *args: args,
         str_extra: Callable = lambda *args: args,
         tag_map: set | dict = set(),
@@ -405,7 +612,7 @@ class TraverseStats(TraverseJson):
         return super().traverse(data, output_dict)
 
     def process_id(self, identifier: str):
-        if char := next((c for c in ENTITY_CHARS if identifier.lower().startswith(c)), ""):
+        if char := ENTITY_PREFIXES.prefix_of(identifier.lower()):
             return identifier[len(char) :].partition(":")[0]
         return identifier.split(":")[-1]
 
@@ -0,0 +1,54 @@
+# Enigmata, an obfuscator for Minecraft Bedrock Editon resource packs.
+# Copyright (C) 2024 github.com/Eric-Joker
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import asyncio
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+
+# Worker processes for pure per-file transforms. Only paths and small option dicts cross the process boundary.
+class WorkerPool:
+    def __init__(self):
+        self.executor = None
+
+    @property
+    def jobs(self) -> int:
+        from config import cfg
+
+        return cfg.jobs if cfg.jobs > 0 else os.cpu_count() or 1
+
+    def chunk(self, items: list, per_job=4) -> list[list]:
+        size = max(1, -(-len(items) // (self.jobs * per_job)))
+        return [items[i : i + size] for i in range(0, len(items), size)]
+
+    async def map(self, fun, args: list[tuple]) -> list:
+        # Results come back in submission order regardless of which worker finishes first.
+        if self.jobs == 1 or len(args) < 2:
+            return [fun(*a) for a in args]
+        if self.executor is None:
+            # The pool starts lazily, after the event loop and I/O threads are running, and forking a threaded process can
+            # deadlock a child on a lock held by another thread. Spawned workers rebuild their state from the arguments.
+            self.executor = ProcessPoolExecutor(self.jobs, mp_context=multiprocessing.get_context("spawn"))
+        loop = asyncio.get_running_loop()
+        return await asyncio.gather(*(loop.run_in_executor(self.executor, fun, *a) for a in args))
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+
+workers = WorkerPool()
@@ -15,6 +15,14 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 from .base import OBF
 from .entities import Entities
-from .images import Images
 from .jsons import Jsons
 from .uis import UIs
+
+
+# PIL is only imported once a pack actually has images to process.
+def __getattr__(name: str):
+    if name == "Images":
+        from .images import Images
+
+        return Images
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
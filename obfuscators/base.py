@@ -16,9 +16,7 @@
 import logging
 import os
 
-import aiofiles
-
-from models import FileHandler
+from models import FileHandler, iox
 from utils import default_dumps
 
 
@@ -29,14 +27,25 @@ class OBF:
         self.work_path = work_path
         self.namespace = namespace
         self.processed = {}
+        self.preloaded = {}
+
+    async def async_preload(self, *fh_lists: list[FileHandler]):
+        # Source files read ahead through iox; a file that fails here is read and reported again when the stage asks for it.
+        paths = [os.path.join(self.pack_path, j.path) for fhs in fh_lists for j in fhs if not j.processed]
+        for path, read in zip(paths, iox.prefetch(paths)):
+            try:
+                self.preloaded[path] = await read
+            except Exception:
+                pass
 
     async def async_get_json_data(self, j: FileHandler, output_str: bool = None):
         if j.path in self.processed:
             return default_dumps(self.processed[j.path]) if output_str else self.processed[j.path]
         path = os.path.join(self.work_path if j.processed else self.pack_path, j.path)
+        if not j.processed and (data := self.preloaded.get(path)) is not None:
+            return data
         try:
-            async with aiofiles.open(path, "r", encoding="utf-8") as f:
-                return await f.read()
+            return await iox.read(path)
         except Exception as e:
             print(f"An error occurred while loading json ({path}):{e}")
             self.logger.exception(e)
@@ -13,24 +13,20 @@
 #
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
-import asyncio
 import copy
 import json
 import os
-from typing import Any, Callable
+from typing import TYPE_CHECKING, Any, Callable
 
-import aiofiles
-import aiofiles.os as aioos
 import regex as re
 from wcmatch import glob
 
 from config import cfg
-from models import DAG, EntityHandler, FileHandler, OBFStrType, ProcessMapping, pbm, pm_factory, vd
+from models import DAGRecorder, EntityHandler, FileHandler, OBFStrType, ProcessMapping, iox, pbm, pm_factory, vd
 from utils import (
-    ENTITY_CHARS,
+    ENTITY_PREFIXES,
     IGNORE_RC_KEYS,
     TraverseJson,
-    async_mkdirs,
     gen_obfstr,
     get_ac_id,
     get_animation_id,
@@ -42,6 +38,9 @@ from utils import (
 
 from . import OBF
 
+if TYPE_CHECKING:
+    from models import DAG
+
 molang_var_pattern = re.compile(
     r"(?<=[!&|<>=*/+\-(){}?[\];',\s]|^)(v|t|c|q|variable|temp|context|query|array)\.(.+?)(?=[!&|<>=*/+\-(){}?[\];',\s.]|$)",
     flags=re.I,
@@ -59,6 +58,7 @@ class Entities(OBF):
         particles: list[FileHandler],
         rcs: list[FileHandler],
         materials: list[FileHandler],
+        dag_ops: dict[str, list] = None,
     ):
         self.animation_controllers = acs
         self.animations = animations
@@ -68,19 +68,28 @@ class Entities(OBF):
         self.particles = particles
         self.render_controllers = rcs
         self.materials = materials
-        self.dag = copy.deepcopy(vd.dag) if cfg.is_vanilla_data_needed else None
+        # A watched pack keeps the graph calls of every file by its processed key. A rebuild records the files it processes
+        # again and replays all of them, so the files it skips still count.
+        self.dag_ops = dag_ops if cfg.is_vanilla_data_needed else None
+        self.dag = copy.deepcopy(vd.dag) if cfg.is_vanilla_data_needed and dag_ops is None else None
         self.exclude_merge_files = set()
 
-        await asyncio.gather(
-            self.async_obf_ac(),
-            self.async_obf_animation(),
-            self.async_obf_materials(),
-            self.async_obf_model(),
-            self.async_obf_particles(),
-            self.async_obf_rc(),
-        )
+        # The sub-stages generate names into linked maps, so they run one after another in a fixed order, with their reads
+        # issued together up front.
+        await self.async_preload(acs, animations, entities, material_indexes, models, particles, rcs, materials)
+        await self.async_obf_ac()
+        await self.async_obf_animation()
+        await self.async_obf_materials()
+        await self.async_obf_model()
+        await self.async_obf_particles()
+        await self.async_obf_rc()
         if cfg.obfuscate_entity:
             await self.async_obf_entity()
+            if self.dag_ops is not None:
+                self.dag = copy.deepcopy(vd.dag)
+                for ops in self.dag_ops.values():
+                    for is_edge, args in ops or ():
+                        (self.dag.add_edge if is_edge else self.dag.add_node)(*args)
             await self.async_obf_bone_patterns()
 
         for k, v in self.processed.items():
@@ -91,14 +100,8 @@ class Entities(OBF):
                 getattr(self, filetype).append(FileHandler(merged_path, processed=True))
 
             new_path = os.path.join(self.work_path, (merged_path if "MERGED" in k else k))
-            data = v if isinstance(v, str) else json.dumps(v)
-            try:
-                await async_mkdirs(os.path.dirname(new_path))
-                async with aiofiles.open(new_path, "w", encoding="utf-8") as f:
-                    await f.write(data)
-            except Exception as e:
-                print(f"An error occurred while writing json ({new_path}):{e}")
-                self.logger.exception(e)
+            iox.submit_write(new_path, v if isinstance(v, str) else json.dumps(v), "json")
+        await iox.drain()
 
     def _merge_some_dict(self, data: dict, filetype: str, control_char: str, **merged_dicts):
         if controls := data.get(filetype):
@@ -143,7 +146,7 @@ class Entities(OBF):
                 or self.material_indexes
                 and filetype == "materials"
                 and j.cut not in can_merge
-                or any(os.path.basename(j.cut).split("/")[-1].startswith(e) for e in cfg.exclude_entity_names)
+                or cfg.exclude_matcher.prefix_of(os.path.basename(j.cut).split("/")[-1]) is not None
                 or j.cut in getattr(vd, filetype)
             ):
                 self.processed[j.path] = await self.async_get_json_data(j)
@@ -153,10 +156,14 @@ class Entities(OBF):
             splited = os.path.basename(j.path).partition(".")
             # obfuscate the filenames of files that cannot be merged
             if (is_exclude := j.cut in exclude_paths) or not cfg.merge_entity or j.subpack_path:
+                # Read under the source name; the new name may still hold the output of an earlier build of a watched pack.
+                data = await self.async_get_json_data(j)
                 if cfg.obfuscate_entity and not is_exclude:
+                    if j.processed:
+                        await iox.remove(os.path.join(self.work_path, j.path))
                     j.path = os.path.join(os.path.dirname(j.path), gen_obfstr(splited[0], OBFStrType.OBFFILE) + splited[2])
                     # j.path = os.path.join(os.path.dirname(j.path), gen_obfstr(splited[0], OBFStrType.OBFFILE, 2) + splited[2])
-                self.processed[j.path] = await self.async_get_json_data(j)
+                self.processed[j.path] = data
                 j.processed = True
                 if cfg.merge_entity:
                     self.exclude_merge_files.add(j.path)
@@ -170,7 +177,7 @@ class Entities(OBF):
                     **merged_dicts,
                 )
                 if j.processed:
-                    await aioos.remove(os.path.join(self.work_path, j.path))
+                    await iox.remove(os.path.join(self.work_path, j.path))
 
                 fh_list.remove(j)
                 pbm.revert_t_item(sum((cfg.comment, cfg.empty_dict, cfg.sort, cfg.unicode, cfg.obfuscate_entity)))
@@ -195,6 +202,12 @@ class Entities(OBF):
                 self.processed[j.path] = instance.traverse(await self.async_get_json_data(j))
                 pbm.update()
 
+    def _graph(self, key: str):
+        if self.dag_ops is None:
+            return self.dag
+        self.dag_ops[key] = recorder = DAGRecorder()
+        return recorder
+
     async def _async_obf_common(
         self, filetype: str, mapping=None, eh=EntityHandler(), versions: tuple[str] = (), get_id: Callable = None
     ):
@@ -203,11 +216,11 @@ class Entities(OBF):
         if cfg.merge_entity:
             for v in versions:
                 if (j := f"MERGED#{filetype.upper()}#{v}") in self.processed:
-                    self.processed[j] = TraverseEntities().traverse(self.processed[j], mapping, eh, self.dag, get_id)
+                    self.processed[j] = TraverseEntities().traverse(self.processed[j], mapping, eh, self._graph(j), get_id)
         for j in getattr(self, filetype):
             if filetype == "entity" or j.cut not in getattr(vd, filetype):
                 self.processed[j.path] = TraverseEntities().traverse(
-                    await self.async_get_json_data(j), mapping, eh, self.dag, get_id
+                    await self.async_get_json_data(j), mapping, eh, self._graph(j.path), get_id
                 )
 
                 pbm.update()
@@ -348,8 +361,14 @@ class Entities(OBF):
             )
 
     async def async_obf_bone_patterns(self):
-        # TODO: NOT TESTED
         wildcard = {"materials", "part_visibility"}
+        # Bones reachable from a render controller and the compiled wildcard patterns are shared by every RC file.
+        bones_cache: dict[tuple[str, frozenset[str]], tuple[str, ...]] = {}
+        matchers: dict[str, glob.WcMatcher] = {}
+
+        # The controllers are read back obfuscated, while the graph is labelled with the original names without prefix.
+        def original(name: str, obf_type: OBFStrType):
+            return obf_type.bi_map.backward.get(name := TraverseEntities.get_truly_id(name)[0], name)
 
         def process_dict(data: dict, *args):
             return_extra = []
@@ -363,7 +382,11 @@ class Entities(OBF):
                 elif isinstance(v, dict) and "geometry" in v:
                     TraverseJson(
                         str_fun=lambda data, *_: (
-                            mi_patterns.add(data.partition("geometry.")[2]) if data.startswith("geometry.") else None,
+                            (
+                                mi_patterns.add(original(data, OBFStrType.MODELINDEX))
+                                if data.lower().startswith("geometry.")
+                                else None
+                            ),
                             data,
                         )[1]
                     ).traverse(v)
@@ -381,49 +404,53 @@ class Entities(OBF):
                 mi_patterns,
             )
 
+        def get_bones(rc: str, mi_patterns: frozenset[str]):
+            if (key := (rc, mi_patterns)) not in bones_cache:
+                bones_cache[key] = tuple(
+                    dict.fromkeys(
+                        bone
+                        # Find all entity that reference this render controller
+                        for entity in self.dag.ppif("rc", rc, "entity")
+                        # Find all model indexes referenced by entities and filter them
+                        for mi in self.dag.successor_indices(entity)
+                        if (splited := self.dag[mi].partition("#"))[0] == "model_index" and splited[2] in mi_patterns
+                        # Find the model corresponding to the model index
+                        for model in self.dag.siif(mi, "model")
+                        # Find all bones from the model
+                        for bone in self.dag.sipf(model, "bone")
+                    )
+                )
+            return bones_cache[key]
+
         def process_list(data: list, *args):
+            if not args or args[0] not in wildcard:
+                return data, True
             new_list = []
             for i in data:
-                if args and args[0] in wildcard:
-                    for k, v in i.items():
-                        if "*" != k and "*" in k:
-                            processed = [
-                                {
-                                    OBFStrType.BONE.bi_map.get(
-                                        fin := self.dag[bone].split(":")[1], fin
-                                    ): f"{(splited := v.partition('.'))[0]}.{OBFStrType.MATERIALINDEX.bi_map.get(splited[2], splited[2])}"
-                                }
-                                # Find all entity that reference this render controller
-                                for entity in tuple(self.dag.ppif("rc", args[1], "entity"))[-1]
-                                # Find all model indexes referenced by entities and filter them
-                                for mi in self.dag.successor_indices(entity)
-                                if (splited := self.dag[mi].partition("#"))[0] == "model_index" and splited[2] in args[2]
-                                # Find the model corresponding to the model index
-                                for model in self.dag.siif(mi, "model")
-                                # Find all bones from the model
-                                for bone in self.dag.successors(model)
-                                if glob.globmatch(bone, k)
-                            ]
-                        else:
-                            processed = [
-                                {
-                                    OBFStrType.BONE.bi_map.get(
-                                        k, k
-                                    ): f"{(splited := v.partition('.'))[0]}.{OBFStrType.MATERIALINDEX.bi_map.get(splited[2], splited[2])}"
-                                }
-                            ]
-
-                        if any(k in OBFStrType.BONE.bi_map for d in processed for k in d):
-                            new_list += processed
-                        else:
-                            new_list.append(i)
-                else:
+                if not isinstance(i, dict):
                     new_list.append(i)
+                    continue
+                for k, v in i.items():
+                    # Materials name the entity's material indexes; part_visibility takes Molang or booleans.
+                    if args[0] == "materials" and isinstance(v, str):
+                        splited = v.partition(".")
+                        v = f"{splited[0]}.{OBFStrType.MATERIALINDEX.bi_map.get(splited[2], splited[2])}"
+                    if "*" != k and "*" in k:
+                        if (matcher := matchers.get(k)) is None:
+                            matcher = matchers[k] = glob.compile(k)
+                        bones = matcher.filter(get_bones(original(args[1], OBFStrType.RC), frozenset(args[2])))
+                        new_list += [{OBFStrType.BONE.bi_map[bone]: v} for bone in bones if bone in OBFStrType.BONE.bi_map]
+                        # The pattern still matches the bones that kept their names.
+                        if bones and all(bone in OBFStrType.BONE.bi_map for bone in bones):
+                            continue
+                    new_list.append({OBFStrType.BONE.bi_map.get(k, k): v})
 
             return new_list, True
 
         for j in self.render_controllers:
             self.processed[j.path] = TraverseJson(process_dict, process_list).traverse(await self.async_get_json_data(j))
+        for k in [k for k in self.processed if k.startswith("MERGED#RENDER_CONTROLLERS#")]:
+            self.processed[k] = TraverseJson(process_dict, process_list).traverse(self.processed[k])
 
 
 class TraverseEntities(TraverseJson):
@@ -435,7 +462,7 @@ class TraverseEntities(TraverseJson):
         data,
         mapping: dict[str, ProcessMapping],
         handler: EntityHandler,
-        dag: DAG,
+        dag: "DAG",
         get_id: Callable = None,
         output_dict={},
     ):
@@ -452,8 +479,9 @@ class TraverseEntities(TraverseJson):
 
         return super().traverse(data, output_dict)
 
-    def get_truly_id(self, identifier: str):
-        if char := next((c for c in ENTITY_CHARS if identifier.lower().startswith(c)), ""):
+    @staticmethod
+    def get_truly_id(identifier: str):
+        if char := ENTITY_PREFIXES.prefix_of(identifier.lower()):
             return identifier[len(char) :].partition(":")[0], char
         return identifier.split(":")[-1], ""
 
@@ -476,10 +504,11 @@ class TraverseEntities(TraverseJson):
         self, data: str, is_exclude: bool | tuple, splited: str | tuple, char: str, handler: EntityHandler, identifier: str
     ):
         if handler.dag_type:
-            self.dag.add_node(handler.dag_type, data, handler.dag_unique)
+            # Labelled like vanilla data and the files' own identifiers, without prefix, so references meet their nodes.
+            self.dag.add_node(handler.dag_type, (label := self.get_truly_id(data)[0]), handler.dag_unique)
             if handler is not self.handler:
                 self.dag.add_node(self.handler.dag_type, identifier, self.handler.dag_unique)
-                self.dag.add_edge(self.handler.dag_type, identifier, handler.dag_type, data)
+                self.dag.add_edge(self.handler.dag_type, identifier, handler.dag_type, label)
         if isinstance(splited, tuple):
             return f"{char[0]}{splited[0] if is_exclude[0] else gen_obfstr(splited[0], handler.obf_set)}:{char[1]}{splited[1] if is_exclude[1] else gen_obfstr(splited[1], handler.obf_set)}"
         return data if is_exclude else char + gen_obfstr(splited, handler.obf_set)
@@ -506,6 +535,9 @@ class TraverseEntities(TraverseJson):
                 v_is_str = isinstance(v, str)
                 new_v = self.obf_value(v, v_is_exclude, v_id, v_char, m.value, identifier) if v_is_str and not is_array else v
                 new_dict[new_k := self.obf_value(k, k_is_exclude, k_id, k_char, m.key, identifier)] = new_v
+                # A geometry name leads to its model, as in vanilla data, so bone patterns can reach the model's bones.
+                if v_is_str and not is_array and m.key.dag_type and m.value.dag_type:
+                    self.dag.add_edge(m.key.dag_type, self.get_truly_id(k)[0], m.value.dag_type, self.get_truly_id(v)[0])
 
                 if v_is_str and v_is_exclude or new_v != v:
                     stop.add(new_k)
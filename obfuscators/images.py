@@ -14,22 +14,22 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 import asyncio
+import io
 import os
 import random
-from functools import partial
 from itertools import chain
 
-import aiofiles
-import aioshutil
 import regex as re
-from PIL import PngImagePlugin
+from PIL import Image, ImageChops, PngImagePlugin
 
 from config import cfg
-from models import FileHandler, OBFStrType, pbm
-from utils import async_mkdirs, async_pil_dump, async_pil_load, gen_obfstr
+from models import FileHandler, OBFStrType, dedup, iox, pbm
+from utils import async_pil_dump, gen_obfstr, sub_json_values
 
 from . import OBF
 
+quoted_pattern = re.compile(r'"((?:[^"\\]|\\.)*)"')
+
 
 class Images(OBF):
     async def async_rename(
@@ -41,22 +41,22 @@ class Images(OBF):
         texture_jsons: list[FileHandler],
         texture_jsons_2: list[FileHandler],
         image_jsons: list[FileHandler],
+        lookups: dict[str, set] = None,
     ):
         self.pngs = pngs
         self.tgas = tgas
+        wm_refs = await self._async_index_sub_refs(texture_jsons)
+        obf_refs = await self._async_index_sub_refs(texture_jsons_2)
 
         for file, need_obf in chain(((x, False) for x in renames), ((x, True) for x in obf_names)):
             name, ext = os.path.splitext(os.path.basename(file.path))
             if name in cfg.exclude_image_names:
-                new_dir = os.path.join(self.work_path, os.path.dirname(file.path))
                 new_path = os.path.join(self.work_path, file.path)
                 pbm.revert_t_item()
             else:
                 # If the filenames of the subpack are different from those of the main pack, it will lead to a decrease in resource pack performance.
                 (rd := random.Random()).seed(
-                    file.path
-                    if await self._async_check_sub_ref(file, texture_jsons_2 if need_obf else texture_jsons)
-                    else file.cut
+                    file.path if file.cut in (obf_refs if need_obf else wm_refs).get(file.subpack_path, ()) else file.cut
                 )
                 if need_obf:
                     new_name = gen_obfstr(name, OBFStrType.OBFFILE) + ext
@@ -76,19 +76,13 @@ class Images(OBF):
                             result.append(name[char2_index])
                             char2_index += 1
                     new_name = "".join(result) + ext
-                new_path = os.path.join(new_dir := os.path.join(self.work_path, os.path.dirname(file.path)), new_name)
+                new_path = os.path.join(self.work_path, os.path.dirname(file.path), new_name)
                 OBFStrType.FILENAME.bi_map[file.path.replace("\\", "/")] = os.path.join(
                     os.path.dirname(file.path), new_name
                 ).replace("\\", "/")
                 pbm.update()
 
-            old_path = os.path.join(self.pack_path, file.path)
-            try:
-                await async_mkdirs(new_dir)
-                await aioshutil.copy2(old_path, new_path)
-            except Exception as e:
-                print(f"An error occurred while rename image ({new_path}):{e}")
-                self.logger.exception(e)
+            iox.submit_copy(os.path.join(self.pack_path, file.path), new_path, "rename image")
             if ext == ".png":
                 self.pngs.append(FileHandler(new_path, processed=True))
             else:
@@ -99,116 +93,233 @@ class Images(OBF):
             if os.path.splitext(os.path.basename(j.path))[0] in cfg.exclude_image_names:
                 pbm.revert_t_item()
             else:
-                new_dir = os.path.join(self.work_path, (rel_dir := os.path.dirname(j.path)))
+                rel_dir = os.path.dirname(j.path)
                 path = os.path.splitext(j.path)[0].replace("\\", "/")
                 new_name = os.path.splitext(
                     os.path.basename(
                         OBFStrType.FILENAME.bi_map.get(f"{path}.png") or OBFStrType.FILENAME.bi_map.get(f"{path}.tga")
                     )
                 )[0]
-                new_path = os.path.join(new_dir, f"{new_name}.json")
-                old_path = os.path.join(self.pack_path, j.path)
-                try:
-                    await async_mkdirs(new_dir)
-                    await aioshutil.copy2(old_path, new_path)
-                except Exception as e:
-                    print(f"An error occurred while rename json ({new_path}):{e}")
-                    self.logger.exception(e)
+                new_path = os.path.join(self.work_path, rel_dir, f"{new_name}.json")
+                iox.submit_copy(os.path.join(self.pack_path, j.path), new_path, "rename json")
 
                 j.path = os.path.join(rel_dir, f"{new_name}.json")
                 j.processed = True
                 pbm.update()
 
         # fix jsons
-        def repl(match: re.Match, subp):
-            if os.path.splitext(path := os.path.join(subp, (data := match.group(0))).replace("\\", "/"))[1] == "":
-                for ext in [".png", ".tga"]:
-                    spliced_path = path + ext
-                    if spliced_path in OBFStrType.FILENAME.bi_map:  # returns False when carrying subpack.
-                        return os.path.relpath(OBFStrType.FILENAME.bi_map[spliced_path], subp).replace("\\", "/")[: -len(ext)]
-                    elif (spliced_data := data + ext) in OBFStrType.FILENAME.bi_map:
-                        return OBFStrType.FILENAME.bi_map[spliced_data][: -len(ext)]
-                return data
-            elif path in OBFStrType.FILENAME.bi_map:
-                return os.path.relpath(OBFStrType.FILENAME.bi_map[path], subp).replace("\\", "/")[
-                    : -len(os.path.splitext(path)[1])
-                ]
-            elif data in OBFStrType.FILENAME.bi_map:
-                return OBFStrType.FILENAME.bi_map[data][: -len(os.path.splitext(data)[1])]
-            return data
-
         subp_pattern = re.compile(r"[/\\]?(subpacks[/\\].+?)[/\\]")
-        value_pattern = re.compile(r'(?<=(?<!//.*|/\*[\s\S]*(?!\*/))(?::|,|\[)(?:\s*/\*[\s\S]*\*/)*\s*(?<!//.*)").*?(?=")')
+        ref_indexes = {}
+        reads = iox.prefetch(os.path.join(self.pack_path, file.path) for file in texture_jsons + texture_jsons_2)
         for file in texture_jsons + texture_jsons_2:
             path = os.path.join(self.pack_path, file.path)
             try:
-                async with aiofiles.open(path, "r", encoding="utf-8") as f:
-                    data = await f.read()
+                data = await next(reads)
             except Exception as e:
                 print(f"An error occurred while loading json ({path}):{e}")
                 self.logger.exception(e)
                 data = ""
-            search = subp_pattern.search(file.path)
-            data = value_pattern.sub(partial(repl, subp=search.group(1) if search else ""), data)
-            new_dir = os.path.dirname(new_path := os.path.join(self.work_path, file.path))
-            try:
-                await async_mkdirs(new_dir)
-                async with aiofiles.open(new_path, "w", encoding="utf-8") as f:
-                    await f.write(data)
-            except Exception as e:
-                print(f"An error occurred while writing json ({new_path}):{e}")
-                self.logger.exception(e)
+            subp = search.group(1) if (search := subp_pattern.search(file.path)) else ""
+            if (refs := ref_indexes.get(subp)) is None:
+                refs = ref_indexes[subp] = self._index_renamed_refs(subp)
+            # A watched pack keeps the values each reference JSON looked up, by source path; see PackState.
+            looked_up = set() if lookups is None else lookups.setdefault(file.path, set())
+
+            def repl(v: str):
+                looked_up.add((OBFStrType.FILENAME, v))
+                return refs.get(v, v)
+
+            iox.submit_write(os.path.join(self.work_path, file.path), sub_json_values(data, repl), "json")
 
             file.processed = True
             pbm.update()
+        # async_obf reads the renamed copies back from the work path.
+        await iox.drain()
 
     async def async_obf(self):
+        # Images that share their content with another file of the pack are encoded once the same way.
+        self.encoded: dict[tuple[str, bytes], bytes] = {}
         await asyncio.gather(self.async_png(), self.async_tga())
+        await iox.drain()
+
+    async def async_load(self, path: str) -> bytes | None:
+        path = path if os.path.isabs(path) else os.path.join(self.pack_path, path)
+        try:
+            return await iox.read(path, "rb")
+        except Exception as e:
+            print(f"An error occurred while loading image ({path}):{e}")
+            self.logger.exception(e)
+
+    def _cached(self, data: bytes | None, fh: FileHandler, format: str):
+        if not fh.blob or data is None:
+            return None, None
+        if (encoded := self.encoded.get(key := (format, fh.blob))) is not None:
+            iox.submit_write(os.path.join(self.work_path, fh.path), encoded, "image")
+            dedup.add(len(data))
+        return key, encoded
+
+    def process_channel(self, data: bytes | None, path: str, png=False):
+        try:
+            img = None if data is None else Image.open(io.BytesIO(data))
+        except Exception as e:
+            print(f"An error occurred while loading image ({path}):{e}")
+            self.logger.exception(e)
+            img = None
+        return img, (self.reduce_mode(img, png) if img and cfg.image_compress == 9 else img)
+
+    def reduce_mode(self, img: Image.Image, png=False):
+        # Only lossless reductions, so the game still sees the exact same pixels.
+        if "transparency" not in img.info:
+            return self._reduce_mode(img, png)
+        if img.mode not in ("RGB", "L"):
+            return img
+        # A tRNS colour key is reduced through a real alpha channel, so keyed pixels stay transparent in the reduced mode.
+        # Without a reduction the keyed original is smaller than its alpha copy.
+        reduced = self._reduce_mode(keyed := img.convert("RGBA" if img.mode == "RGB" else "LA"), png)
+        return img if reduced.mode == keyed.mode else reduced
 
-    async def async_process_channel(self, path):
-        img = await async_pil_load(path if os.path.isabs(path) else os.path.join(self.pack_path, path))
-        if img.mode == "RGBA" and cfg.image_compress == 9 and img.getextrema()[3] == (255, 255):
-            return img.convert("RGB")
-        return img
+    def _reduce_mode(self, img: Image.Image, png: bool):
+        if img.mode not in ("RGBA", "RGB", "LA", "L"):
+            return img
+        if (has_alpha := img.mode[-1] == "A") and img.getchannel("A").getextrema() == (255, 255):
+            img, has_alpha = img.convert(img.mode[:-1]), False
+        if not png:
+            return img
+        if img.mode[0] == "R" and self._is_gray(img):
+            img = Image.merge("LA", (img.getchannel("R"), img.getchannel("A"))) if has_alpha else img.getchannel("R")
+        # 8-bit grayscale beats a palette once the palette can no longer be packed below 8 bits.
+        if (colors := img.getcolors(256)) is None or img.mode == "L" and len(colors) > 16:
+            return img
+        # Small textures with many colours spend more on PLTE/tRNS than they save on pixels.
+        bits = next(b for b in (1, 2, 4, 8) if len(colors) <= 1 << b)
+        if img.width * img.height * bits // 8 + len(colors) * (4 if has_alpha else 3) >= img.width * img.height * len(img.mode):
+            return img
+
+        rgba = img.convert("RGBA")
+        colors = [c for _, c in sorted(rgba.getcolors(256), key=lambda c: (c[1][3] == 255, -c[0]))]  # keeps tRNS short
+        reduced = Image.frombytes("P", img.size, self._palette_indices(rgba, colors, has_alpha).tobytes())
+        reduced.putpalette([v for c in colors for v in (c if has_alpha else c[:3])], "RGBA" if has_alpha else "RGB")
+        return reduced
+
+    def _palette_indices(self, rgba: Image.Image, colors: list[tuple], has_alpha: bool):
+        # Pillow's own palette mapping matches colours approximately, so the exact index is built one channel at a time in
+        # C: a channel and the rank of the channels before it are packed into a 16-bit key that a lookup table ranks again.
+        # The last pass ranks by the palette order.
+        channels = rgba.split()[: 4 if has_alpha else 3]
+        zero = Image.new("L", rgba.size)
+        keys, ranks = channels[0], {c[:1]: c[0] for c in colors}
+        for n in range(2, len(channels) + 1):
+            pairs = {}
+            for i, c in enumerate(colors):
+                pairs.setdefault((ranks[c[: n - 1]], c[n - 1]), i if n == len(channels) else len(pairs))
+            ranks = {c[:n]: pairs[ranks[c[: n - 1]], c[n - 1]] for c in colors}
+            lut = [0] * 65536
+            for (high, low), i in pairs.items():
+                lut[high << 8 | low] = i
+            packed = Image.merge("RGBA", (channels[n - 1], keys, zero, zero)).tobytes()
+            keys = Image.frombytes("I", rgba.size, packed, "raw", "I;32").point(lut, "L")
+        return keys
+
+    def _is_gray(self, img: Image.Image):
+        r, g, b = img.getchannel("R"), img.getchannel("G"), img.getchannel("B")
+        return ImageChops.difference(r, g).getbbox() is None and ImageChops.difference(g, b).getbbox() is None
+
+    def _kept_chunks(self, img: Image.Image, metadata: PngImagePlugin.PngInfo):
+        kwargs = {"icc_profile": img.info.get("icc_profile") if "iCCP" in cfg.keep_chunks else None}
+        if "pHYs" in cfg.keep_chunks and "dpi" in img.info:
+            kwargs["dpi"] = img.info["dpi"]
+        if "eXIf" in cfg.keep_chunks and "exif" in img.info:
+            kwargs["exif"] = img.info["exif"]
+        if cfg.keep_chunks & {"tEXt", "zTXt", "iTXt"}:
+            for k, v in getattr(img, "text", {}).items():
+                if "iTXt" in cfg.keep_chunks:
+                    metadata.add_itxt(k, v, zip=True)
+                else:
+                    metadata.add_text(k, v, "zTXt" in cfg.keep_chunks)
+        return kwargs
 
     async def async_png(self):
         for i in self.pngs:
-            (metadata := PngImagePlugin.PngInfo()).add_text(self.namespace, "")
-            await async_pil_dump(
-                os.path.join(self.work_path, i.path),
-                await self.async_process_channel(i.path),
-                "PNG",
-                compress_level=6 if cfg.image_compress == -1 else cfg.image_compress,
-                optimize=cfg.image_compress == 9,
-                pnginfo=metadata if cfg.extrainfo else None,
-            )
+            key, encoded = self._cached(data := await self.async_load(i.path), i, "PNG")
+            if encoded is None:
+                metadata = PngImagePlugin.PngInfo()
+                if cfg.extrainfo:
+                    metadata.add_text(self.namespace, "")
+                img, reduced = self.process_channel(data, i.path, True)
+                kwargs = self._kept_chunks(img, metadata) if img else {}
+                encoded = await async_pil_dump(
+                    os.path.join(self.work_path, i.path),
+                    reduced,
+                    "PNG",
+                    compress_level=6 if cfg.image_compress == -1 else cfg.image_compress,
+                    optimize=cfg.image_compress == 9,
+                    pnginfo=metadata if metadata.chunks else None,
+                    **kwargs,
+                )
+                if key and encoded:
+                    self.encoded[key] = encoded
 
             pbm.update_n_file()
             pbm.update(sum((cfg.image_compress != -1, cfg.extrainfo)))
 
     async def async_tga(self):
         for i in self.tgas:
-            compressing = cfg.image_compress > 6
-            await async_pil_dump(
-                os.path.join(self.work_path, i.path),
-                await self.async_process_channel(i.path),
-                "TGA",
-                compression="tga_rle" if compressing else "",
-                id_section=self.namespace.encode("utf-8") if cfg.extrainfo else b"",
-            )
+            key, encoded = self._cached(data := await self.async_load(i.path), i, "TGA")
+            if encoded is None:
+                compressing = cfg.image_compress > 6
+                encoded = await async_pil_dump(
+                    os.path.join(self.work_path, i.path),
+                    self.process_channel(data, i.path)[1],
+                    "TGA",
+                    compression="tga_rle" if compressing else "",
+                    id_section=self.namespace.encode("utf-8") if cfg.extrainfo else b"",
+                )
+                if key and encoded:
+                    self.encoded[key] = encoded
 
             pbm.update_n_file()
             pbm.update(sum((cfg.image_compress > 6, cfg.extrainfo)))
 
-    async def _async_check_sub_ref(self, item: FileHandler, jsons: list[FileHandler]):
+    def _index_renamed_refs(self, subp: str):
+        # Maps every way a JSON in `subp` can spell a renamed image to its new spelling. Paths relative to the subpack win
+        # over pack-relative ones and PNG wins over TGA, which is the order the references have always been resolved in.
+        renamed = OBFStrType.FILENAME.bi_map.items()
+        prefix = f"{subp.replace("\\", "/")}/" if subp else ""
+        refs = {}
+        for ext in (".png", ".tga"):
+            for old, new in renamed:
+                if (
+                    old.endswith(ext)
+                    and old.startswith(prefix)
+                    and not os.path.splitext(stem := old[len(prefix) : -len(ext)])[1]
+                ):
+                    refs.setdefault(stem, os.path.relpath(new, subp).replace("\\", "/")[: -len(ext)])
+            for old, new in renamed:
+                if old.endswith(ext) and not os.path.splitext(stem := old[: -len(ext)])[1]:
+                    refs.setdefault(stem, new[: -len(ext)])
+        for old, new in renamed:
+            if (ext := os.path.splitext(old)[1]) and old.startswith(prefix):
+                refs.setdefault(old[len(prefix) :], os.path.relpath(new, subp).replace("\\", "/")[: -len(ext)])
+        for old, new in renamed:
+            if ext := os.path.splitext(old)[1]:
+                refs.setdefault(old, new[: -len(ext)])
+        return refs
+
+    async def _async_index_sub_refs(self, jsons: list[FileHandler]):
+        # Read each subpack reference JSON once; image lookups are then plain set membership tests.
+        refs: dict[str, set[str]] = {}
+        jsons = [i for i in jsons if i.subpack_path]
+        reads = iox.prefetch(os.path.join(self.pack_path, i.path) for i in jsons)
         for i in jsons:
-            if item.subpack_path and item.subpack_path in i.path:
-                real_path = os.path.join(self.pack_path, i.path)
-                try:
-                    async with aiofiles.open(real_path, "r", encoding="utf-8") as f:
-                        data = await f.read()
-                except Exception as e:
-                    print(f"An error occurred while check file data ({real_path}):{e}")
-                    self.logger.exception(e)
-                if item.cut in data:
-                    return True
+            real_path = os.path.join(self.pack_path, i.path)
+            try:
+                data = await next(reads)
+            except Exception as e:
+                print(f"An error occurred while check file data ({real_path}):{e}")
+                self.logger.exception(e)
+                continue
+            refs.setdefault(i.subpack_path, set()).update(
+                os.path.splitext(ref)[0] if ref.endswith((".png", ".tga")) else ref
+                for ref in (m.replace("\\", "/") for m in quoted_pattern.findall(data))
+            )
+        return refs
@@ -13,31 +13,100 @@
 #
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import asyncio
 import json
 import os
 import random
 import time
+import traceback
 import uuid
 from itertools import chain
-from typing import Any
+from json.encoder import encode_basestring
+from typing import Any, Callable
 
-import aiofiles
-import aioshutil
 import regex as re
 from wcmatch import glob
 
 from config import cfg
-from models import FileHandler, OBFStrType, pbm
+from models import FileHandler, OBFStrType, copy_path, dedup, iox, pack_source, pbm, read_path, workers
 from utils import TraverseJson, async_mkdirs, default_dumps, gen_crc
 
 from . import OBF
 
+# Options the per-file formatter reads; they are shipped to the worker processes with each batch.
+FORMAT_OPTIONS = (
+    "comment",
+    "empty_dict",
+    "exclude_entity_names",
+    "exclude_jsonui_names",
+    "exclude_matcher",
+    "exclude_names",
+    "sort",
+    "unformat",
+    "unicode",
+)
+
+
+class Escaped(str):
+    # Text that is already a JSON string body of \uXXXX escapes, written between quotes as is.
+    __slots__ = ()
+
+
+class _EscapeTable(dict):
+    def __missing__(self, key):
+        self[key] = value = rf"\u{key:04x}"
+        return value
+
+
+UNICODE_ESCAPES = _EscapeTable((i, rf"\u{i:04x}") for i in range(0x800))
+
+
+def write_escaped(data, write: Callable[[str], Any], indent: int = None, level=0):
+    # Same layout as `default_dumps`, except that Escaped strings are written once instead of having their backslashes
+    # doubled, and other strings keep the "\\u" -> "\u" rewrite the unicode output has always applied.
+    if isinstance(data, Escaped):
+        write(f'"{data}"')
+    elif isinstance(data, str):
+        write(encode_basestring(data).replace(r"\\u", r"\u"))
+    elif isinstance(data, (dict, list)):
+        if not data:
+            write("{}" if isinstance(data, dict) else "[]")
+            return
+        opening, closing = "{}" if isinstance(data, dict) else "[]"
+        if indent is None:
+            separator = ", "
+            write(opening)
+        else:
+            separator = "," + (newline := "\n" + " " * (indent * (level + 1)))
+            write(opening + newline)
+        for i, item in enumerate(data.items() if isinstance(data, dict) else data):
+            if i:
+                write(separator)
+            if isinstance(data, dict):
+                write_escaped(item[0], write)
+                write(": ")
+                item = item[1]
+            write_escaped(item, write, indent, level + 1)
+        write(closing if indent is None else "\n" + " " * (indent * level) + closing)
+    else:
+        write(default_dumps(data))
+
+
+def _format_jsons(pack_path: str, work_path: str, namespace: str, options: dict, files: list[tuple[str, str, bool]]):
+    for k, v in options.items():
+        setattr(cfg, k, v)
+    pack_source(pack_path)  # workers that weren't forked register an archive pack themselves
+    jsons = Jsons(pack_path, work_path, namespace)
+    return [jsons.format_json(*f) for f in files]
+
 
 class Jsons(OBF):
-    async def async_obf(self, *args: list[FileHandler]):
-        self.comment_pattern = re.compile(r'(?<="[^"]*"):(?=\s*[^",\{\[]|".*?[^"]*")')
-        update_pbar = lambda: None if is_merged else pbm.update()
+    comment_pattern = re.compile(r'(?<="[^"]*"):(?=\s*[^",\{\[]|".*?[^"]*")')
 
+    async def async_obf(self, *args: list[FileHandler]):
+        files = []
+        shared = {}  # content -> index in `files` of the copy that is formatted
+        copies = []
         for j in chain(*args):
             path = os.path.join(self.work_path if j.processed else self.pack_path, j.path)
             new_dir = os.path.dirname(new_path := os.path.join(self.work_path, j.path))
@@ -47,54 +116,98 @@ class Jsons(OBF):
             if glob.globmatch(j.path, cfg.exclude_jsons, flags=glob.D | glob.G):
                 if not j.processed:
                     await async_mkdirs(new_dir)
-                    await aioshutil.copy2(path, new_path)
+                    await asyncio.to_thread(copy_path, path, new_path, "copy" if cfg.passthrough == "copy" else "clone")
                 pbm.revert_t_item(sum((cfg.comment, cfg.empty_dict, cfg.sort, cfg.unicode)))
+                if not is_merged:
+                    pbm.update_n_file()
+            elif j.blob and not j.processed and (first := shared.get((j.blob, is_merged))) is not None:
+                copies.append((first, j.path, new_path))
             else:
-                try:
-                    async with aiofiles.open(path, "r", encoding="utf-8") as f:
-                        data = await f.read()
-                except Exception as e:
-                    print(f"An error occurred while loading json ({path}):{e}")
-                    self.logger.exception(e)
-                    data = "{}"
-                if cfg.sort:
-                    data = self.sort_json(data)
-                    update_pbar()
-                if cfg.comment:
-                    comments = self.stats_comment(data)
-                if cfg.unicode:
-                    data = self.custom_json(self.encode_to_unicode(data))
-                    update_pbar()
-                if not cfg.unformat:
-                    data = default_dumps(json.loads(data) if isinstance(data, str) else data, indent=2)
-                if cfg.empty_dict:
-                    if any(s in str(data) for s in cfg.exclude_entity_names):
-                        if not is_merged:
-                            pbm.revert_t_item()
-                    else:
-                        data = (data if isinstance(data, str) else default_dumps(data)) + "{}"
-                        update_pbar()
-                if cfg.comment:
-                    data = self.add_comment(data, comments)
-                    update_pbar()
-                try:
-                    await async_mkdirs(new_dir)
-                    async with aiofiles.open(new_path, "w", encoding="utf-8") as f:
-                        await f.write(data)
-                except Exception as e:
-                    print(f"An error occurred while writing json ({new_path}):{e}")
-                    self.logger.exception(e)
+                if j.blob and not j.processed:
+                    shared[j.blob, is_merged] = len(files)
+                files.append((path, new_path, is_merged))
+
+        # The transforms are pure per file, so batches of paths are formatted in worker processes from disk to disk.
+        options = {k: getattr(cfg, k) for k in FORMAT_OPTIONS}
+        batches = workers.chunk(files)
+        results = await workers.map(
+            _format_jsons, [(self.pack_path, self.work_path, self.namespace, options, b) for b in batches]
+        )
+        results = list(chain.from_iterable(results))
+        for (_, _, is_merged), (updates, reverts, errors) in zip(files, results):
+            for message, trace in errors:
+                print(message)
+                self.logger.error(trace)
+            pbm.revert_t_item(reverts)
+            pbm.update(updates)
+            if not is_merged:
+                pbm.update_n_file()
 
+        # Files with the same content as one formatted above get its output.
+        for first, rel_path, new_path in copies:
+            _, formatted, is_merged = files[first]
+            try:
+                await async_mkdirs(os.path.dirname(new_path))
+                await asyncio.to_thread(copy_path, formatted, new_path)
+                dedup.add(pack_source(self.pack_path).size(rel_path))
+            except Exception as e:
+                print(f"An error occurred while writing json ({new_path}):{e}")
+                self.logger.exception(e)
+            updates, reverts, _ = results[first]
+            pbm.revert_t_item(reverts)
+            pbm.update(updates)
             if not is_merged:
                 pbm.update_n_file()
-        pbm.pbar.refresh()
+        pbm.refresh()
+
+    def format_json(self, path: str, new_path: str, is_merged: bool):
+        # Returns the progress items done and reverted, and the errors for the caller to report.
+        updates = reverts = 0
+        errors = []
+        try:
+            data = read_path(path)
+        except Exception as e:
+            errors.append((f"An error occurred while loading json ({path}):{e}", traceback.format_exc()))
+            data = "{}"
+        if cfg.sort:
+            data = self.sort_json(data)
+            updates += 1
+        if cfg.unicode:
+            data = self.encode_to_unicode(data)
+            # When nothing rewrites the text afterwards, the layout is streamed straight into the file.
+            if not cfg.unformat or cfg.empty_dict or cfg.comment:
+                data = self.custom_json(data)
+            updates += 1
+        if not cfg.unformat:
+            data = default_dumps(json.loads(data) if isinstance(data, str) else data, indent=2)
+        if cfg.empty_dict:
+            if any(s in str(data) for s in cfg.exclude_entity_names):
+                if not is_merged:
+                    reverts += 1
+            else:
+                data = (data if isinstance(data, str) else default_dumps(data)) + "{}"
+                updates += 1
+        if cfg.comment:
+            updates += 1
+        try:
+            os.makedirs(os.path.dirname(new_path), exist_ok=True)
+            with open(new_path, "w", encoding="utf-8") as f:
+                if cfg.comment:
+                    self.add_comment(data, f.write)
+                elif isinstance(data, str):
+                    f.write(data)
+                else:
+                    self.custom_json(data, f.write)
+        except Exception as e:
+            errors.append((f"An error occurred while writing json ({new_path}):{e}", traceback.format_exc()))
+        return 0 if is_merged else updates, reverts, errors
 
     def is_exclude(self, data: str, plus=True):
         return (
             plus
-            and data in cfg.exclude_names
+            and data in cfg.exclude_matcher
             or data.partition("@")[0] in cfg.exclude_jsonui_names
-            or any(".".join(data[-len(s.split(".")) :]) == s for s in cfg.exclude_entity_names)
+            or cfg.exclude_matcher.has_suffix(data)
         )
 
     def encode_to_unicode(self, data):
@@ -126,27 +239,32 @@ class Jsons(OBF):
             return new_dict, stop
 
         def process_str(data: str, *_):
-            return data if data in cfg.exclude_names else "".join([rf"\u{ord(c):04x}" for c in data])
+            return data if data in cfg.exclude_names else Escaped(data.translate(UNICODE_ESCAPES))
 
-        return TraverseJson(process_dict, str_fun=process_str).traverse(data)
+        return TraverseJson(process_dict, str_fun=process_str).traverse(data, True)
 
     # Does not allow whitelisted keys and their values to be escaped to unicode.
     # TODO: Multi-level JSON Whitelist Formatting.
-    def custom_json(self, data):
-        total_items = len(data := data if isinstance(data, dict) else json.loads(data))
-        return (
-            "{"
-            + "".join(
-                (
-                    default_dumps({k: v}, indent=2)[1:-2].replace(r"\\u", r"\u")
-                    if self.is_exclude(k, False)
-                    else (default_dumps({k: v}, indent=None if cfg.unformat else 2)[1:-1]).replace(r"\\u", r"\u")
-                )
-                + ("" if index == total_items - 1 else (",\n" if self.is_exclude(k, False) else ", "))
-                for index, (k, v) in enumerate(data.items())
-            )
-            + "}"
-        )
+    def custom_json(self, data, write: Callable[[str], Any] = None):
+        # The layout is emitted piece by piece through `write`, e.g. a file's; without one the text is returned.
+        if write is None:
+            parts = []
+            self.custom_json(data, parts.append)
+            return "".join(parts)
+        indent = None if cfg.unformat else 2
+        is_exclude = False
+        write("{")
+        for index, (k, v) in enumerate((data if isinstance(data, dict) else json.loads(data)).items()):
+            if index:
+                write(",\n" if is_exclude else ", ")
+            if (is_exclude := self.is_exclude(k, False)) or indent:
+                write("\n  ")
+            write_escaped(k, write)
+            write(": ")
+            write_escaped(v, write, 2 if is_exclude else indent, 1)
+            if indent and not is_exclude:
+                write("\n")
+        write("}")
 
     def sort_json(self, data):
         def process_dict(data: dict[str, Any]):
@@ -156,27 +274,34 @@ class Jsons(OBF):
 
         return TraverseJson(process_dict).traverse(data)
 
-    def stats_comment(self, data):
-        return [gen_crc(s + self.namespace) for s in self.comment_pattern.split(data)]
-
-    def add_comment(self, data, comments):
-        splited = self.comment_pattern.split(data)
-        return "".join(
-            (
-                v
-                if i == len(splited) - 1
-                else (f"{v}:" if r"\u" not in splited[i] or r"\u" not in splited[i + 1] else f"{v}:/*{comments[i]}*/")
-            )
-            for i, v in enumerate(splited)
-        )
+    def add_comment(self, data: str, write: Callable[[str], Any]):
+        # Walks the colons that split the text once. A colon whose segments on both sides hold escapes is followed by a
+        # "/*crc*/" of the segment before it and the namespace.
+        last = 0  # start of the segment before the pending colon
+        colon = -1  # the pending colon, written with the segment after it
+        last_escaped = False
+        for m in self.comment_pattern.finditer(data):
+            escaped = data.find(r"\u", colon + 1, m.start()) != -1
+            if colon == -1:
+                write(data[: m.start()])
+            else:
+                comment = f"/*{gen_crc(data[last:colon] + self.namespace)}*/" if last_escaped and escaped else ""
+                write(f":{comment}{data[colon + 1 : m.start()]}")
+                last = colon + 1
+            colon = m.start()
+            last_escaped = escaped
+        if colon == -1:
+            write(data)
+        else:
+            comment = f"/*{gen_crc(data[last:colon] + self.namespace)}*/" if last_escaped and r"\u" in data[colon + 1 :] else ""
+            write(f":{comment}{data[colon + 1 :]}")
 
     async def async_manifest(
         self, manifest: FileHandler, pack_name, header_uuid, header_version, modules_uuid, modules_version
     ):
         path = os.path.join(self.pack_path, manifest.path)
         try:
-            async with aiofiles.open(path, "r", encoding="utf-8") as f:
-                data = await f.read()
+            data = await iox.read(path)
         except Exception as e:
             print(f"An error occurred while loading json ({path}):{e}")
             self.logger.exception(e)
@@ -211,14 +336,7 @@ class Jsons(OBF):
                         int(random_number[split_points[1] :]),
                     ]
                 )
-        new_dir = os.path.dirname(new_path := os.path.join(self.work_path, manifest.path))
-        data = default_dumps(data, indent=2)
-        try:
-            await async_mkdirs(new_dir)
-            async with aiofiles.open(new_path, "w", encoding="utf-8") as f:
-                await f.write(data)
-        except Exception as e:
-            print(f"An error occurred while writing json ({new_path}):{e}")
-            self.logger.exception(e)
+        iox.submit_write(os.path.join(self.work_path, manifest.path), default_dumps(data, indent=2), "json")
+        await iox.drain()
         pbm.update_n_file()
         pbm.update()
@@ -14,21 +14,34 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 import asyncio
+import io
 import json
 import os
+import traceback
 from functools import partial
+from itertools import islice
 
-import aiofiles
-import aiofiles.os as aioos
-import aioshutil
 import regex as re
 
 from config import cfg
-from models import FileHandler, OBFStrType, pbm, vd
+from models import (
+    FileHandler,
+    NameView,
+    OBFStrType,
+    commit_obf_strs,
+    iox,
+    obf_strs_view,
+    open_path,
+    pack_source,
+    pbm,
+    vd,
+    workers,
+)
 from utils import (
+    ControlsPass,
     TraverseControls,
+    TraverseControlsChain,
     TraverseJson,
-    async_mkdirs,
     comment_pattern,
     default_dumps,
     gen_obfstr,
@@ -39,6 +52,40 @@ from utils import (
 from . import OBF
 
 
+def _scan_l10n(pack_path: str, path: str, names: NameView):
+    # Queues the keys in the order they first appear.
+    pack_source(pack_path)  # workers that weren't forked register an archive pack themselves
+    try:
+        with io.TextIOWrapper(open_path(path), encoding="utf-8") as f:
+            for line in f:
+                if m := l10n_pattern.match(line):
+                    names.request(m.group(1), OBFStrType.LOCALIZATION)
+    except Exception:
+        pass  # reported by _rewrite_l10n
+    return names
+
+
+def _rewrite_l10n(pack_path: str, path: str, new_path: str, names: NameView):
+    # Returns the errors for the caller to report.
+    pack_source(pack_path)
+    errors = []
+    try:
+        f = io.TextIOWrapper(open_path(path), encoding="utf-8")
+    except Exception as e:
+        errors.append((f"An error occurred while loading lang ({path}):{e}", traceback.format_exc()))
+        f = io.StringIO("{}")
+    try:
+        os.makedirs(os.path.dirname(new_path), exist_ok=True)
+        with f, open(new_path, "w", encoding="utf-8") as new_f:
+            for line in f:
+                if m := l10n_pattern.match(line):
+                    line = names.get(m.group(1), OBFStrType.LOCALIZATION, m.group(1)) + line[m.end() :]
+                new_f.write(line)
+    except Exception as e:
+        errors.append((f"An error occurred while writing lang ({new_path}):{e}", traceback.format_exc()))
+    return errors
+
+
 class UIs(OBF):
     async def async_obf(
         self,
@@ -47,6 +94,7 @@ class UIs(OBF):
         langs: list[FileHandler],
         ui_global_vars: list[FileHandler],
         ui_defs: list[FileHandler],
+        lookups: dict[str, set] = None,
     ):
         self.jsonuis = jsonuis
         self.uniqueuis = uniqueuis
@@ -56,41 +104,42 @@ class UIs(OBF):
 
         self.processed = {}
         self.uniqueui_namespace = []
+        # Variables declared by this pack's _global_variables.json; kept apart so the shared vanilla data is never mutated.
+        self.global_variables = set()
         self.variable_pattern = re.compile(r"([\$#].*?)(?=([@\|\)\s]|$))")
+        # A watched pack keeps the names each JsonUI looked up in the maps and the namespace of each unique one, by source
+        # path, so a rebuild can tell which of the JsonUIs it didn't process a new name reaches; see PackState.
+        self.lookups = lookups
+        self.looked_up = None
+        if lookups is not None:
+            for j in jsonuis + uniqueuis:
+                lookups.setdefault(j.path, set())
 
         if cfg.obfuscate_jsonui:
             stats_g_var_task = asyncio.create_task(self.async_stats_global_var())
         process_l10n_task = asyncio.create_task(self.async_process_l10n())
         if cfg.obfuscate_jsonui or cfg.merged_ui_path:
             await self.async_merge()
+        await process_l10n_task
         if cfg.obfuscate_jsonui:
-            await process_l10n_task
-            await self.async_fix_l10n()
             await stats_g_var_task
-            await self.async_obf_variable()
-            await self.async_obf_ctrl_name()
+            await self.async_obf_controls()
 
         for k, v in self.processed.items():
             if k == "MERGED":
                 uniqueuis.append(FileHandler(cfg.merged_ui_path, processed=True))
 
             new_path = os.path.join(self.work_path, cfg.merged_ui_path if k == "MERGED" else k)
-            new_dir = os.path.dirname(new_path)
-            data = v if isinstance(v, str) else json.dumps(v)
-            try:
-                await async_mkdirs(new_dir)
-                async with aiofiles.open(new_path, "w", encoding="utf-8") as f:
-                    await f.write(data)
-            except Exception as e:
-                print(f"An error occurred while writing json ({new_path}):{e}")
-                self.logger.exception(e)
+            iox.submit_write(new_path, v if isinstance(v, str) else json.dumps(v), "json")
+        await iox.drain()
 
     async def async_merge(self):
         control_split_pattern = re.compile(r"[@\.]")
         exclude_namespace = set()
 
-        def stats_ctrl_name(data: dict, renamed: list):
+        def stats_ctrl_name(data: dict, renamed: list, path: str):
             if (ns := data.get("namespace")) not in exclude_namespace:
+                self.record(path, ("namespace", ns))
                 self.uniqueui_namespace.append(ns)
 
                 new_dict = {"namespace": self.namespace}
@@ -102,49 +151,49 @@ class UIs(OBF):
                         new_dict[f"{new_ctrl_name}{"".join(splited[1:])}"] = v
             return new_dict, True
 
-        def fix_self_namespace_dict(data: dict, is_control: bool, renamed: list):
+        def fix_self_namespace_dict(data: dict, is_control: bool, renamed: dict):
             if (ns := data.get("namespace")) and ns in exclude_namespace:
                 return {}, True
             return {fix_self_namespace_str(k, renamed=renamed) if is_control else k: v for k, v in data.items()}, False
 
-        def fix_self_namespace_str(data: str, *_, renamed: list):
-            data = data.replace(f"{self.uniqueui_namespace[-1]}.", f"{self.namespace}.")
-            for control_name in renamed:
-                # Modify the namespace of all controls that inherit from first-level controls and have not been renamed. like "a@b.a"
-                cache_data = re.sub(
-                    rf"(^{control_name}@({self.namespace}\.)?){control_name}$",
-                    rf"{self.uniqueui_namespace[-1]}_\1{self.uniqueui_namespace[-1]}_{control_name}",
-                    data,
-                )
-                if cache_data == data:
-                    # Modify the namespace of all controls that inherit from first-level controls and have been renamed. like "a@b.c"
-                    cache_data = re.sub(
-                        rf"(^|@|(^|@){self.namespace}\.){control_name}$",
-                        rf"\1{self.uniqueui_namespace[-1]}_{control_name}",
-                        data,
-                    )
-                    if cache_data != data:
-                        return cache_data
-                else:
-                    return cache_data
-            return data
-
-        def fix_all_namespace_str(data: str, *_, namespace: str):
-            lens = len(splited := control_split_pattern.split(data))
-            if (three := lens == 3) and namespace == splited[1] or lens == 2 and namespace == splited[0]:
-                data = (f"{namespace}_{data}" if three and splited[0] == splited[2] else data).replace(
-                    f"{namespace}.", f"{self.namespace}.{namespace}_"
-                )
-                OBFStrType.UIMERGE.bi_map.replace_value(
-                    (o_str := ".".join(splited[-2:])), o_str.replace(f"{namespace}.", f"{namespace}_")
-                )
-            return data
+        def fix_self_namespace_str(data: str, *_, renamed: dict):
+            data = data.replace(f"{(ns := self.uniqueui_namespace[-1])}.", f"{self.namespace}.")
+            # `renamed` maps each first-level control to its declaration order; the earliest one the string refers to wins.
+            found = []
+            # Modify the namespace of all controls that inherit from first-level controls and have not been renamed. like "a@b.a"
+            if (head := data.partition("@"))[1] and head[2] in (head[0], f"{self.namespace}.{head[0]}") and head[0] in renamed:
+                found.append((renamed[head[0]], False, head[0]))
+            # Modify the namespace of all controls that inherit from first-level controls and have been renamed. like "a@b.c"
+            if (tail := data.rpartition("@")[2]) in renamed:
+                found.append((renamed[tail], True, tail))
+            if tail.startswith(f"{self.namespace}.") and (tail := tail[len(self.namespace) + 1 :]) in renamed:
+                found.append((renamed[tail], True, tail))
+            if not found:
+                return data
+            _, is_renamed, control_name = min(found)
+            prefix = data[: len(data) - len(control_name)]
+            return f"{prefix}{ns}_{control_name}" if is_renamed else f"{ns}_{prefix}{ns}_{control_name}"
+
+        def fix_all_namespace_str(data: str, *_):
+            # Applies every namespace in `uniqueui_namespace` order, jumping straight to the next one that matches.
+            start = 0
+            while True:
+                lens = len(splited := control_split_pattern.split(data))
+                namespace = splited[1] if (three := lens == 3) else splited[0] if lens == 2 else None
+                if (i := next((i for i in namespace_positions.get(namespace, ()) if i >= start), None)) is None:
+                    return data
+                old_prefix, new_prefix, merged_prefix = namespace_prefixes[namespace]
+                data = (f"{namespace}_{data}" if three and splited[0] == splited[2] else data).replace(old_prefix, new_prefix)
+                # Replayed per namespace after the traversal, so the merge table fills in namespace order.
+                replaced.append((i, o_str := ".".join(splited[-2:]), o_str.replace(old_prefix, merged_prefix)))
+                start = i + 1
 
         # TODO: Since I don’t need it, the functionality of exclude all unique JsonUIs with the same name as those in the subpack has not been tested.
         for j in self.uniqueuis:
             if j.subpack_path:
                 data = self.processed[j.path] = await self.async_get_json_data(j)
                 ns = (json.loads(comment_pattern.sub("", data)) if isinstance(data, str) else data)["namespace"]
+                self.record(j.path, ("namespace", ns))
                 self.uniqueui_namespace.append(ns)
                 exclude_namespace.add(ns)
 
@@ -153,9 +202,10 @@ class UIs(OBF):
         exclude_files = set()
         for j in self.uniqueuis.copy():
             renamed_controls = []
-            data = TraverseJson(partial(stats_ctrl_name, renamed=renamed_controls)).traverse(
+            data = TraverseJson(partial(stats_ctrl_name, renamed=renamed_controls, path=j.path)).traverse(
                 await self.async_get_json_data(j), True
             )
+            renamed_controls = {c: i for i, c in enumerate(dict.fromkeys(renamed_controls))}
             is_exclude = True
             if cfg.merged_ui_path:
                 if not j.subpack_path and (
@@ -170,7 +220,7 @@ class UIs(OBF):
                     merged_dict.update(new_dict)
 
                     if j.processed:
-                        await aioos.remove(os.path.join(self.work_path, j.path))
+                        await iox.remove(os.path.join(self.work_path, j.path))
                     self.processed["MERGED"] = merged_dict
 
                     self.uniqueuis.remove(j)
@@ -186,14 +236,8 @@ class UIs(OBF):
             if cfg.obfuscate_jsonui and is_exclude:
                 new_name = gen_obfstr((splited := os.path.basename(j.cut).partition("."))[0], OBFStrType.OBFFILE) + splited[2]
                 # new_name = (gen_obfstr((splited := os.path.basename(j.cut).partition("."))[0], OBFStrType.OBFFILE, 1) + splited[2])
-                new_path = os.path.join(new_dir := os.path.join(self.work_path, (rel_dir := os.path.dirname(j.path))), new_name)
-                old_path = os.path.join(self.pack_path, j.path)
-                try:
-                    await async_mkdirs(new_dir)
-                    await aioshutil.copy2(old_path, new_path)
-                except Exception as e:
-                    print(f"An error occurred while write json ({new_path}):{e}")
-                    self.logger.exception(e)
+                new_path = os.path.join(self.work_path, (rel_dir := os.path.dirname(j.path)), new_name)
+                iox.submit_copy(os.path.join(self.pack_path, j.path), new_path, "write json")
 
                 exclude_files.add(j.cut)
                 j.path = os.path.join(rel_dir, new_name)
@@ -203,34 +247,38 @@ class UIs(OBF):
             return
 
         # Fix all namespaces for each JsonUI.
-        for ns in self.uniqueui_namespace:
-            if ns not in exclude_namespace:
-                instance = TraverseControls(
-                    lambda data, *_: ({fix_all_namespace_str(k, namespace=ns): v for k, v in data.items()}, False),
-                    str_fun=partial(fix_all_namespace_str, namespace=ns),
-                )
-                self.processed["MERGED"] = instance.traverse(self.processed["MERGED"], exclude=False)
+        namespace_positions: dict[str, list[int]] = {}
+        for i, ns in enumerate(ns for ns in self.uniqueui_namespace if ns not in exclude_namespace):
+            namespace_positions.setdefault(ns, []).append(i)
+        if namespace_positions:
+            namespace_prefixes = {ns: (f"{ns}.", f"{self.namespace}.{ns}_", f"{ns}_") for ns in namespace_positions}
+            replaced = []
+            instance = TraverseControls(
+                lambda data, *_: ({fix_all_namespace_str(k): v for k, v in data.items()}, False), str_fun=fix_all_namespace_str
+            )
+            self.processed["MERGED"] = instance.traverse(self.processed["MERGED"], exclude=False)
 
-                for j in self.jsonuis:
-                    self.processed[j.path] = instance.traverse(await self.async_get_json_data(j), True, False)
+            for j in self.jsonuis:
+                self.processed[j.path] = instance.traverse(await self.async_get_json_data(j), True, False)
 
-                    j.processed = True
+                j.processed = True
+            for _, o_str, n_str in sorted(replaced, key=lambda r: r[0]):
+                OBFStrType.UIMERGE.bi_map.replace_value(o_str, n_str)
         pbm.update(len(self.jsonuis))
 
         # process _ui_def.json
         try:
-            cfg.defs_confused = json.loads(cfg.defs_confused) if cfg.defs_confused else {}
-            if not isinstance(cfg.defs_confused, dict):
+            defs_confused = json.loads(cfg.defs_confused) if cfg.defs_confused else {}
+            if not isinstance(defs_confused, dict):
                 raise
         except Exception:
-            cfg.defs_confused = {}
+            defs_confused = {}
             self.logger.error("defs_confused must be a JSON dictionary string or an empty string.")
+        reads = iox.prefetch(os.path.join(self.pack_path, j.path) for j in self.ui_defs)
         for j in self.ui_defs:
             new_path = os.path.join(self.pack_path, j.path)
             try:
-                async with aiofiles.open(new_path, "r", encoding="utf-8") as f:
-                    data = await f.read()
-                data: dict = json.loads(data)
+                data: dict = json.loads(await next(reads))
             except Exception as e:
                 print(f"An error occurred while reading json ({new_path}):{e}")
                 self.logger.exception(e)
@@ -251,170 +299,192 @@ class UIs(OBF):
                     )
                     for k, v in data.items()
                 }
-            ).update(cfg.defs_confused)
-            data = default_dumps(data)
-            new_dir = os.path.dirname(new_path := os.path.join(self.work_path, j.path))
-            try:
-                await async_mkdirs(new_dir)
-                async with aiofiles.open(new_path, "w", encoding="utf-8") as f:
-                    await f.write(data)
-            except Exception as e:
-                print(f"An error occurred while writing json ({new_path}):{e}")
-                self.logger.exception(e)
+            ).update(defs_confused)
+            iox.submit_write(os.path.join(self.work_path, j.path), default_dumps(data), "json")
 
             j.processed = True
             pbm.update()
 
-    async def async_obf_ctrl_name(self):
-        def stats_ctrl_dict(data: dict, is_control: bool, is_unique=False):
-            if not is_control:
-                return data, False
-
-            return {
-                (
-                    k
-                    if "$" in (splited := k.partition("@"))[0]
-                    or "#" in splited[0]
-                    or splited[0].isdigit()
-                    or splited[0] in vd.ui_keywords
-                    else (
-                        f"{gen_obfstr(splited[0], OBFStrType.UICONTROL)}@{splited[2]}"
-                        if "@" in k and (self.namespace in k or is_unique)
-                        else gen_obfstr(splited[0], OBFStrType.UICONTROL) if "@" not in k and is_unique else k
-                    )
-                ): v
-                for k, v in data.items()
-            }, False
-
-        def process_dict(data: dict, is_control: bool, is_unique=False):
-            if not is_control:
-                return data, vd.ui_properties
-
-            new_dict = {}
-            for k, v in data.items():
-                new_key = k
-                for ns in [self.namespace] if cfg.merged_ui_path else self.uniqueui_namespace:
-                    if f"@{ns}." in k and (o_key := (splited := k.partition(f"@{ns}."))[2]) in OBFStrType.UICONTROL.bi_map:
-                        new_key = f"{splited[0]}@{ns}.{OBFStrType.UICONTROL.bi_map[o_key]}"
-                        break
-                    elif "@" in k and is_unique and (o_key := (splited := k.partition("@"))[2]) in OBFStrType.UICONTROL.bi_map:
-                        new_key = f"{splited[0]}@{OBFStrType.UICONTROL.bi_map[o_key]}"
-                        break
-                new_dict[new_key] = v
-            return new_dict, vd.ui_properties
-
-        def process_str(data: str, *_, is_unique=False):
-            for o_key, n_key in OBFStrType.UICONTROL.bi_map.items():
-                for ns in [self.namespace] if cfg.merged_ui_path else self.uniqueui_namespace:
-                    if o_key in data:
-                        new_data = data
-                        if f"@{ns}." in data:
-                            new_data = re.sub(f"^(.*?)@{ns}.{o_key}$", rf"\1@{ns}.{n_key}", data)
-                        elif "@" in data and is_unique:
-                            new_data = re.sub(f"^@{o_key}$", f"@{n_key}", data)
-                        elif f"{ns}." in data:
-                            new_data = re.sub(f"^{ns}.{o_key}$", f"{ns}.{n_key}", data)
-                        elif is_unique:
-                            new_data = re.sub(f"^{o_key}$", n_key, data)
-                        if data != new_data:
-                            return new_data
-            return data
-
-        stats = TraverseControls(partial(stats_ctrl_dict, is_unique=True))
-        process = TraverseControls(partial(process_dict, is_unique=True), str_fun=partial(process_str, is_unique=True))
-        if cfg.merged_ui_path:
-            self.processed["MERGED"] = process.traverse(stats.traverse(self.processed["MERGED"]), exclude=False)
-        for j in self.uniqueuis:
-            self.processed[j.path] = stats.traverse(await self.async_get_json_data(j))
-        for j in self.uniqueuis:
-            self.processed[j.path] = process.traverse(self.processed[j.path], exclude=False)
-        for j in self.jsonuis:
-            self.processed[j.path] = TraverseControls(stats_ctrl_dict).traverse(  # process sub controls
-                TraverseControls(process_dict, str_fun=process_str).traverse(await self.async_get_json_data(j), exclude=False)
-            )
-
     async def async_stats_global_var(self):
+        reads = iox.prefetch(os.path.join(self.pack_path, j.path) for j in self.global_vars)
         for j in self.global_vars:
             path = os.path.join(self.pack_path, j.path)
             try:
-                async with aiofiles.open(path, "r", encoding="utf-8") as f:
-                    data = await f.read()
+                data = await next(reads)
             except Exception as e:
                 print(f"An error occurred while loading json ({path}):{e}")
                 self.logger.exception(e)
                 data = "{}"
-            vd.ui_variables.update(iter(uivar_pattern.findall(data)))
+            self.global_variables.update(iter(uivar_pattern.findall(data)))
 
-    async def async_obf_variable(self):
-        def process_dict(data: dict, *_, is_unique=False):
-            return {process_str(k, is_unique=is_unique): v for k, v in data.items()}, False
+    async def async_process_l10n(self):
+        # .lang files are streamed line by line in the worker processes. Their keys are named here in the order they first
+        # appear, then every file is rewritten with the same names.
+        paths = [(os.path.join(self.pack_path, l.path), os.path.join(self.work_path, l.path)) for l in self.langs]
+        if cfg.obfuscate_jsonui:
+            view = obf_strs_view(OBFStrType.LOCALIZATION)
+            commit_obf_strs(await workers.map(_scan_l10n, [(self.pack_path, p, view) for p, _ in paths]), vd.l10n)
+        names = obf_strs_view(OBFStrType.LOCALIZATION) if cfg.obfuscate_jsonui else NameView({})
+
+        for l, errors in zip(self.langs, await workers.map(_rewrite_l10n, [(self.pack_path, *p, names) for p in paths])):
+            for message, trace in errors:
+                print(message)
+                self.logger.error(trace)
+            if cfg.obfuscate_jsonui:
+                pbm.update_n_file()
+                pbm.update()
+            l.processed = True
 
-        def process_str(data: str, *_, is_unique=False):
+    async def async_obf_controls(self):
+        # One walk over the merged and unique JsonUIs collects the variables, bindings and control names they declare, which are
+        # then named in the order the separate passes used to name them. After that every document is rewritten in one walk.
+        namespaces = [self.namespace] if cfg.merged_ui_path else self.uniqueui_namespace
+        controls = OBFStrType.UICONTROL.bi_map
+        control_order = {}
+
+        def index_controls():
+            # Numbers the control names generated so far; a rewrite only sees the ones that existed when its pass used to run.
+            for k in islice(controls.forward, len(control_order), None):
+                control_order[k] = len(control_order)
+            return len(control_order)
+
+        def visible(o_key: str, limit: int):
+            if self.looked_up is not None:
+                self.looked_up.add((OBFStrType.UICONTROL, o_key))
+            return control_order.get(o_key, limit) < limit
+
+        def variable_str(data: str, *_, is_unique=False):
             def repl(m: re.Match):
-                if (var := m.group(1)) in vd.ui_variables or var in vd.ui_bindings:
+                if (var := m.group(1)) in vd.ui_variables or var in self.global_variables or var in vd.ui_bindings:
                     return var
 
                 is_var = var[0] == "$"
                 return ("$" if is_var else "#") + (
                     gen_obfstr(var[1:], OBFStrType.UIVARIABLE if is_var else OBFStrType.UIBINDIND)
                     if is_unique
-                    else (OBFStrType.UIVARIABLE if is_var else OBFStrType.UIBINDIND).bi_map.get(var[1:], var[1:])
+                    else self.look_up(OBFStrType.UIVARIABLE if is_var else OBFStrType.UIBINDIND, var[1:])
                 )
 
             return self.variable_pattern.sub(repl, data)
 
-        process = TraverseControls(partial(process_dict, is_unique=True), str_fun=partial(process_str, is_unique=True))
-        if cfg.merged_ui_path:
-            self.processed["MERGED"] = process.traverse(self.processed["MERGED"])
-        for j in self.uniqueuis:
-            self.processed[j.path] = process.traverse(await self.async_get_json_data(j))
-        for j in self.jsonuis:
-            self.processed[j.path] = TraverseControls(process_dict, str_fun=process_str).traverse(
-                await self.async_get_json_data(j), exclude=False
-            )
-
-    async def async_process_l10n(self):
-        def repl(m: re.Match):
-            return l10n if (l10n := m.group(1)) in vd.l10n else gen_obfstr(l10n, OBFStrType.LOCALIZATION)
-
-        for l in self.langs:
-            path = os.path.join(self.pack_path, l.path)
-            try:
-                async with aiofiles.open(path, "r", encoding="utf-8") as f:
-                    data = await f.read()
-            except Exception as e:
-                print(f"An error occurred while loading lang ({path}):{e}")
-                self.logger.exception(e)
-                data = "{}"
-            if cfg.obfuscate_jsonui:
-                data = l10n_pattern.sub(repl, data)
-                pbm.update_n_file()
-                pbm.update()
-            new_dir = os.path.dirname(new_path := os.path.join(self.work_path, l.path))
-            try:
-                await async_mkdirs(new_dir)
-                async with aiofiles.open(new_path, "w", encoding="utf-8") as f:
-                    await f.write(data)
-            except Exception as e:
-                print(f"An error occurred while writing lang ({new_path}):{e}")
-                self.logger.exception(e)
-            l.processed = True
+        def stats_key(k: str, is_control: bool, is_unique=False):
+            if (
+                not is_control
+                or "$" in (splited := k.partition("@"))[0]
+                or "#" in splited[0]
+                or splited[0].isdigit()
+                or splited[0] in vd.ui_keywords
+            ):
+                return k
+            if "@" in k and (self.namespace in k or is_unique):
+                return f"{gen_obfstr(splited[0], OBFStrType.UICONTROL)}@{splited[2]}"
+            return gen_obfstr(splited[0], OBFStrType.UICONTROL) if "@" not in k and is_unique else k
+
+        def process_key(k: str, is_control: bool, limit: int, is_unique=False):
+            if is_control:
+                for ns in namespaces:
+                    if f"@{ns}." in k and visible(o_key := (splited := k.partition(f"@{ns}."))[2], limit):
+                        return f"{splited[0]}@{ns}.{controls[o_key]}"
+                    elif "@" in k and is_unique and visible(o_key := (splited := k.partition("@"))[2], limit):
+                        return f"{splited[0]}@{controls[o_key]}"
+            return k
+
+        def process_str(data: str, *_, limit: int, is_unique=False):
+            # Each namespace points at no more than one control name; the one generated first wins, as it did when every name
+            # was tried in turn.
+            found = []
+            for i, ns in enumerate(namespaces):
+                if f"@{ns}." in data:
+                    prefix, sep, o_key = data.rpartition(f"@{ns}.")
+                    prefix += sep
+                elif "@" in data and is_unique:
+                    prefix, o_key = "@", data[1:] if data[0] == "@" else None
+                elif f"{ns}." in data:
+                    prefix, o_key = f"{ns}.", data[len(ns) + 1 :] if data.startswith(f"{ns}.") else None
+                elif is_unique:
+                    prefix, o_key = "", data
+                else:
+                    continue
+                if o_key is not None and visible(o_key, limit) and (new_data := prefix + controls[o_key]) != data:
+                    found.append((control_order[o_key], i, new_data))
+            return min(found)[2] if found else data
+
+        l10n = ControlsPass(
+            str_fun=lambda data, *_: self.look_up(OBFStrType.LOCALIZATION, data),
+            stop_fun=lambda data: data.get("localize") == False and {k for k, v in data.items() if isinstance(v, str)},
+            exclude=False,
+        )
+        variable = lambda is_unique: ControlsPass(
+            lambda k, _: variable_str(k, is_unique=is_unique), partial(variable_str, is_unique=is_unique), exclude=is_unique
+        )
+        stats = lambda is_unique: ControlsPass(partial(stats_key, is_unique=is_unique))
+        process = lambda limit, is_unique: ControlsPass(
+            partial(process_key, limit=limit, is_unique=is_unique),
+            partial(process_str, limit=limit, is_unique=is_unique),
+            lambda _: vd.ui_properties,
+            False,
+        )
+
+        docs = {"MERGED": self.processed.get("MERGED", {})} if cfg.merged_ui_path else {}
+        texts = set()
+        for j in self.uniqueuis + self.jsonuis:
+            if isinstance(data := await self.async_get_json_data(j), str):
+                data = json.loads(comment_pattern.sub("", data))
+                texts.add(j.path)
+            docs[j.path] = data
+
+        # collect
+        variables = []
+        declared = {}
+
+        def record_variable(data: str, *_):
+            variables.append(data)
+            return data
 
-    async def async_fix_l10n(self):
-        def process_dict(data: dict, *_):
-            return data, {k for k, v in data.items() if isinstance(v, str)} if data.get("localize") == False else False
+        def record_control(k: str, is_control: bool, names: list):
+            if is_control:
+                names.append(k)
+            return k
+
+        for k in [k for k in docs if k == "MERGED"] + [j.path for j in self.uniqueuis]:
+            TraverseControlsChain(
+                l10n,
+                ControlsPass(lambda k, _: record_variable(k), record_variable),
+                ControlsPass(partial(record_control, names=declared.setdefault(k, []))),
+            ).traverse(docs[k])
+        for data in variables:
+            variable_str(data, is_unique=True)
+        for k, names in declared.items():
+            for name in names:
+                stats_key(variable_str(name, is_unique=True), True, True)
+            if k == "MERGED":
+                merged_limit = index_controls()
+        unique_limit = index_controls()
 
-        def process_str(data: str, *_):
-            return OBFStrType.LOCALIZATION.bi_map.get(data, data)
+        # rewrite
+        def rewrite(path: str, *passes: ControlsPass):
+            data = TraverseControlsChain(*passes).traverse(docs[path])
+            self.processed[path] = default_dumps(data, indent=2) if path in texts else data
 
-        process = TraverseControls(process_dict, str_fun=process_str)
         if cfg.merged_ui_path:
-            self.processed["MERGED"] = process.traverse(self.processed.get("MERGED", {}), exclude=False)
+            rewrite("MERGED", l10n, variable(True), stats(True), process(merged_limit, True))
         for j in self.uniqueuis:
-            self.processed[j.path] = process.traverse(await self.async_get_json_data(j), exclude=False)
+            rewrite(j.path, l10n, variable(True), stats(True), process(unique_limit, True))
             j.processed = True
             pbm.update()
         for j in self.jsonuis:
-            self.processed[j.path] = process.traverse(await self.async_get_json_data(j), exclude=False)
+            self.looked_up = None if self.lookups is None else self.lookups[j.path]
+            # process sub controls
+            rewrite(j.path, l10n, variable(False), process(index_controls(), False), stats(False))
             j.processed = True
             pbm.update()
+        self.looked_up = None
+
+    def record(self, path: str, *names: tuple):
+        if self.lookups is not None:
+            self.lookups[path].update(names)
+
+    def look_up(self, obf_type: OBFStrType, name: str) -> str:
+        if self.looked_up is not None:
+            self.looked_up.add((obf_type, name))
+        return obf_type.bi_map.get(name, name)
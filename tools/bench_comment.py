@@ -0,0 +1,81 @@
+# Enigmata, an obfuscator for Minecraft Bedrock Editon resource packs.
+# Copyright (C) 2024 github.com/Eric-Joker
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+# Times Jsons.add_comment, the CRC comment pass of the JSON formatter, and measures its peak memory while it writes to a
+# file. The document is a formatted JSON file given with --file, or a synthetic JsonUI-like one of about --size MB whose
+# keys and values are escaped the way the unicode option leaves them.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def control(i: int) -> dict:
+    return {
+        "type": "panel",
+        "绑定": [{"binding_name": f"#名称_{i}", "binding_condition": "always"}],
+        "控制": [{f"子项_{i}_{j}@基础.标签": {"text": f"文本 {j}", "size": [j, "100%"]}} for j in range(4)],
+        "$变量": f"值_{i}",
+    }
+
+
+def synthetic(size: int) -> str:
+    per_control = len(json.dumps({"控件_0@基础.面板": control(0)}, indent=2))
+    return json.dumps({f"控件_{i}@基础.面板": control(i) for i in range(max(1, size // per_control))}, indent=2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the CRC comment pass of the JSON formatter.")
+    parser.add_argument("--file", type=str, help="A formatted JSON file to comment instead of the synthetic document.")
+    parser.add_argument("--size", type=float, default=16, help="Size in MB of the synthetic document.")
+    parser.add_argument("--runs", type=int, default=5, help="Timed runs; the fastest is reported.")
+    args = parser.parse_args()
+
+    # In main.py's order; the config package can't be imported before the obfuscators.
+    from obfuscators.jsons import Jsons
+    from config import cfg
+
+    cfg.load({})
+    if args.file:
+        with open(args.file, encoding="utf-8") as f:
+            data = f.read()
+    else:
+        data = synthetic(int(args.size * 1e6))
+    jsons = Jsons("", "", "ns")
+
+    times = []
+    for _ in range(max(1, args.runs)):
+        start = time.perf_counter()
+        jsons.add_comment(data, lambda s: None)
+        times.append(time.perf_counter() - start)
+
+    with tempfile.TemporaryDirectory() as tmp, open(os.path.join(tmp, "out.json"), "w", encoding="utf-8") as f:
+        tracemalloc.start()
+        jsons.add_comment(data, f.write)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        written = f.tell()
+
+    print(f"document: {len(data) / 1e6:.1f} MB, {written / 1e6:.1f} MB written with comments")
+    print(f"add_comment: best {min(times):.3f}s of {len(times)} runs, peak {peak / 1e3:.0f} KB over the document")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+# Enigmata, an obfuscator for Minecraft Bedrock Editon resource packs.
+# Copyright (C) 2024 github.com/Eric-Joker
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+# Checks that startup stays cheap: `import main` and `main.py --help` must not pull in the heavy dependencies, and
+# importing main must stay under a time budget. Run from anywhere with `python tools/bench_import.py`.
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEAVY = ("PIL", "rustworkx", "tqdm")
+
+PROBE = f"""
+import json, sys, time
+start = time.perf_counter()
+import main
+elapsed = time.perf_counter() - start
+print(json.dumps({{"elapsed": elapsed, "heavy": [m for m in {HEAVY!r} if m in sys.modules]}}))
+"""
+
+
+def probe_import() -> dict:
+    # A fresh interpreter each time, so nothing is already cached in sys.modules.
+    out = subprocess.run([sys.executable, "-c", PROBE], cwd=ROOT, capture_output=True, text=True, check=True).stdout
+    return json.loads(out.splitlines()[-1])
+
+
+def probe_help() -> list[str]:
+    # -X importtime lists every module the interpreter imported on stderr.
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "main.py", "--help"], cwd=ROOT, capture_output=True, text=True, check=True
+    )
+    imported = {line.rpartition("|")[2].strip() for line in proc.stderr.splitlines() if line.startswith("import time:")}
+    return [m for m in HEAVY if m in imported]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check the import time and the modules loaded at startup.")
+    parser.add_argument("--budget", type=float, default=1.0, help="Seconds `import main` may take at best.")
+    parser.add_argument("--runs", type=int, default=5, help="Fresh interpreters to time; the fastest run is compared.")
+    args = parser.parse_args()
+
+    results = [probe_import() for _ in range(max(1, args.runs))]
+    best = min(r["elapsed"] for r in results)
+    heavy = sorted({m for r in results for m in r["heavy"]})
+    help_heavy = probe_help()
+    print(f"import main: best {best * 1000:.1f}ms of {len(results)} runs, budget {args.budget * 1000:.0f}ms")
+
+    failed = []
+    if heavy:
+        failed.append(f"`import main` loaded {', '.join(heavy)}")
+    if help_heavy:
+        failed.append(f"`main.py --help` loaded {', '.join(help_heavy)}")
+    if best > args.budget:
+        failed.append(f"`import main` took {best:.3f}s, over the {args.budget:.3f}s budget")
+    for message in failed:
+        print(message, file=sys.stderr)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
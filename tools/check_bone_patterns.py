@@ -0,0 +1,152 @@
+# Enigmata, an obfuscator for Minecraft Bedrock Editon resource packs.
+# Copyright (C) 2024 github.com/Eric-Joker
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import argparse
+import glob
+import json
+import os
+import sys
+import tempfile
+
+# Obfuscates a small fixture pack, an entity whose render controller sets materials and part visibility with the bone
+# wildcard "leg*", and checks that the wildcard comes out as one entry per obfuscated leg bone, with the entry for "*"
+# kept and the material renamed, both with and without merge_entity. --config names a YAML file to start from, e.g.
+# for its data_path.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+PACK = {
+    "manifest.json": {
+        "format_version": 2,
+        "header": {
+            "name": "bone patterns",
+            "description": "",
+            "uuid": "8d1f5e36-0d3c-4a43-9c8e-6f7f3d2b1a01",
+            "version": [1, 0, 0],
+            "min_engine_version": [1, 20, 0],
+        },
+        "modules": [{"type": "resources", "uuid": "8d1f5e36-0d3c-4a43-9c8e-6f7f3d2b1a02", "version": [1, 0, 0]}],
+    },
+    "entity/golem.entity.json": {
+        "format_version": "1.10.0",
+        "minecraft:client_entity": {
+            "description": {
+                "identifier": "fx:golem",
+                "materials": {"default": "entity_alphatest"},
+                "textures": {"default": "textures/entity/golem"},
+                "geometry": {"default": "geometry.fx_golem"},
+                "render_controllers": ["controller.render.fx_golem"],
+            }
+        },
+    },
+    "models/entity/golem.geo.json": {
+        "format_version": "1.12.0",
+        "minecraft:geometry": [
+            {
+                "description": {"identifier": "geometry.fx_golem", "texture_width": 64, "texture_height": 64},
+                "bones": [
+                    {"name": "body", "pivot": [0, 0, 0]},
+                    {"name": "leg_left", "parent": "body", "pivot": [0, 0, 0]},
+                    {"name": "leg_right", "parent": "body", "pivot": [0, 0, 0]},
+                    {"name": "head", "parent": "body", "pivot": [0, 0, 0]},
+                ],
+            }
+        ],
+    },
+    "render_controllers/golem.render_controllers.json": {
+        "format_version": "1.8.0",
+        "render_controllers": {
+            "controller.render.fx_golem": {
+                "geometry": "Geometry.default",
+                "materials": [{"*": "Material.default"}, {"leg*": "Material.default"}],
+                "textures": ["Texture.default"],
+                "part_visibility": [{"*": True}, {"leg*": "query.is_baby"}],
+            }
+        },
+    },
+}
+
+
+def write_pack(root: str):
+    for name, data in PACK.items():
+        os.makedirs(os.path.dirname(path := os.path.join(root, name)), exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(data, f)
+    # The texture only has to exist for the entity's reference to it.
+    from PIL import Image
+
+    os.makedirs(os.path.join(root, "textures", "entity"), exist_ok=True)
+    Image.new("RGBA", (64, 64)).save(os.path.join(root, "textures", "entity", "golem.png"))
+
+
+def check(result) -> list[str]:
+    from models import OBFStrType
+
+    bones = result.references.get(OBFStrType.BONE.value, {})
+    material = result.references.get(OBFStrType.MATERIALINDEX.value, {}).get("default")
+    if not all(bone in bones for bone in ("leg_left", "leg_right")) or material is None:
+        return [f"the bones or the material were not renamed: {bones}, {material}"]
+    (path,) = glob.glob(os.path.join(result.work_path, "render_controllers", "**", "*.json"), recursive=True)
+    with open(path, encoding="utf-8") as f:
+        # Comments are kept out of this pack's output, so the file is plain JSON.
+        (controller,) = json.load(f)["render_controllers"].values()
+    legs = {bones["leg_left"], bones["leg_right"]}
+    errors = []
+    for key, value in (("materials", f"Material.{material}"), ("part_visibility", "query.is_baby")):
+        entries = controller.get(key, [])
+        if (expanded := {k for entry in entries for k, v in entry.items() if v == value and k != "*"}) != legs:
+            errors.append(f"{key}: 'leg*' came out as {sorted(expanded)} instead of {sorted(legs)}")
+        if not any("*" in entry for entry in entries):
+            errors.append(f"{key}: the entry for '*' is missing")
+        if any("leg*" in entry for entry in entries):
+            errors.append(f"{key}: 'leg*' is still there after every leg bone was renamed")
+    if controller["materials"][0].get("*") != f"Material.{material}":
+        errors.append(f"materials: '*' names {controller['materials'][0].get('*')} instead of Material.{material}")
+    return errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check that bone wildcards expand to the obfuscated bone names.")
+    parser.add_argument("--config", type=str, help="A YAML file to start the options from.")
+    args = parser.parse_args()
+
+    # api imports main first, which brings the obfuscators in ahead of the config package.
+    import api
+
+    failed = False
+    with tempfile.TemporaryDirectory() as tmp:
+        write_pack(source := os.path.join(tmp, "pack"))
+        for merge in (True, False):
+            result = api.obfuscate_pack(
+                source,
+                {
+                    "config": args.config,
+                    "namespace": "fx",
+                    "work_path": os.path.join(tmp, f"out_{merge}"),
+                    "zip_name": None,
+                    "merge_entity": merge,
+                    "unformat": False,
+                    "comment": False,
+                },
+            )
+            errors = check(result)
+            print(f"merge_entity={merge}: {'passed' if not errors else 'failed'}")
+            for error in errors:
+                print(f"  {error}")
+            failed |= bool(errors)
+    sys.exit(failed)
+
+
+if __name__ == "__main__":
+    main()
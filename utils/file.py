@@ -13,18 +13,34 @@
 #
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import asyncio
 import io
 import logging
 import os
+import shutil
+from typing import TYPE_CHECKING
 
 import aiofiles
 import aiofiles.os as aioos
-from PIL import Image
+
+if TYPE_CHECKING:
+    from PIL import Image
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 logger = logging.getLogger(__name__)
 
+FICLONE = 0x40049409
 
-def mkdirs(path: str):
+
+def mkdirs(path: str, made: set = None):
+    if made is not None:
+        if path in made:
+            return
+        made.add(path)
     try:
         return os.makedirs(path, exist_ok=True)
     except Exception as e:
@@ -48,21 +64,38 @@ async def async_mkdirs(path: str):
     return await aioos.makedirs(path, exist_ok=True)
 
 
-async def async_pil_load(path: str):
-    try:
-        async with aiofiles.open(path, "rb") as f:
-            return Image.open(io.BytesIO(await f.read()))
-    except Exception as e:
-        print(f"An error occurred while loading image ({path}):{e}")
-        logger.exception(e)
-
-
-async def async_pil_dump(path: str, img: Image, format: str, **kwargs):
+def clone_file(src: str, dst: str, hardlink=False):
+    # Hard link, then reflink, then an in-kernel copy; the bytes only pass through userspace as a last resort.
+    if os.path.lexists(dst):
+        os.remove(dst)
+    if hardlink:
+        try:
+            return os.link(src, dst)
+        except OSError:
+            pass
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        except (AttributeError, OSError):
+            try:
+                while os.copy_file_range(fsrc.fileno(), fdst.fileno(), 1 << 30):
+                    pass
+            except (AttributeError, OSError):
+                shutil.copyfileobj(fsrc, fdst, 1 << 20)
+    shutil.copystat(src, dst)
+
+
+async def async_clone_file(src: str, dst: str):
+    return await asyncio.to_thread(clone_file, src, dst)
+
+
+async def async_pil_dump(path: str, img: "Image.Image", format: str, **kwargs):
     img.save((byte_arr := io.BytesIO()), format=format, **kwargs)
     try:
         await async_mkdirs(os.path.dirname(path))
         async with aiofiles.open(path, "wb") as f:
-            return await f.write(byte_arr.getvalue())
+            await f.write(data := byte_arr.getvalue())
+        return data
     except Exception as e:
         print(f"An error occurred while writing image ({path}):{e}")
         logger.exception(e)
@@ -49,3 +49,40 @@ def default_dumps(d, *args, **kwargs):
 
 def gen_crc(data):
     return format(binascii.crc32(data.encode()), "08x")
+
+
+class NameMatcher:
+    # Exact names, prefixes and dot-separated suffixes compiled once from config, so a test no longer loops over the lists.
+    END = None
+
+    def __init__(self, exact=(), prefixes=(), suffixes=()):
+        self.exact = frozenset(exact)
+        self.prefixes = {}
+        for p in prefixes:
+            node = self.prefixes
+            for c in p:
+                node = node.setdefault(c, {})
+            node[self.END] = p
+        # Suffixes are grouped by their number of segments, one set lookup per group.
+        self.suffixes: dict[int, set[str]] = {}
+        for s in suffixes:
+            self.suffixes.setdefault(len(s.split(".")), set()).add(s)
+
+    def __contains__(self, data: str):
+        return data in self.exact
+
+    def prefix_of(self, data: str):
+        # Returns the shortest registered prefix of `data`, or None.
+        node = self.prefixes
+        for c in data:
+            if self.END in node:
+                return node[self.END]
+            if (node := node.get(c)) is None:
+                return None
+        return node.get(self.END)
+
+    # Same test as Jsons.is_exclude has always made: the last n characters of `data`, not its last n segments, joined with
+    # dots. So only suffixes made of one-character segments can match, and names such as "player.base" never do. Testing
+    # segments instead would change the layout, escaping and key order of existing outputs, so that is left to its own change.
+    def has_suffix(self, data: str):
+        return any(".".join(data[-n:]) in names for n, names in self.suffixes.items())
@@ -16,12 +16,13 @@
 import json
 import math
 import random
+from dataclasses import dataclass
 from typing import Any, Callable
 
 import regex as re
 
 from models import OBFStrType
-from utils import default_dumps
+from utils import NameMatcher, default_dumps
 
 NOT_CONTROL_KEYS = {
     "requires",
@@ -37,12 +38,14 @@ NOT_CONTROL_KEYS = {
 }  # If any of these keys exist in the first-level dictionary of a list, then the dictionary is not a control.
 
 ENTITY_CHARS = ("geometry.", "controller.animation.", "animation.", "controller.render.", "materials.", "texture.", "array.")
+ENTITY_PREFIXES = NameMatcher(prefixes=ENTITY_CHARS)
 
 IGNORE_RC_KEYS = {"format_version", "on_fire_color", "is_hurt_color", "overlay_color", "ignore_lighting", "filter_lighting"}
 
 comment_pattern = re.compile(r'(?<!:\s*"[^"]*?)(//.*?$|/\*[\s\S]*?\*/)', re.MULTILINE)
 uivar_pattern = re.compile(r'(\$.+?)(?=[@\|\)\s"])')
 l10n_pattern = re.compile(r"(^.+?)(?==.+?[\n#])", re.MULTILINE)
+json_token_pattern = re.compile(r'"(?:[^"\\]|\\.)*"|//[^\n]*|/\*[\s\S]*?\*/|[^\s"/]+|/')
 
 obf_dict_fun = lambda d, *args: (d, False, *args)
 obf_list_fun = lambda l, *args: (l, False, *args)
@@ -55,6 +58,24 @@ get_animation_id = lambda d: list(d.get("animations", {}))
 get_rc_id = lambda d: list(d.get("render_controllers", {}))
 
 
+def sub_json_values(data: str, repl: Callable[[str], str]):
+    # Rewrites the strings that follow ":", "," or "[" in a commented JSON text and keeps everything else byte for byte.
+    result = []
+    last = 0
+    prev = ""
+    for m in json_token_pattern.finditer(data):
+        if (token := m.group())[0] == '"':
+            if prev and prev in ":,[" and (new := repl(token[1:-1])) != token[1:-1]:
+                result.append(data[last : m.start() + 1])
+                result.append(new)
+                last = m.end() - 1
+            prev = '"'
+        elif token[0] != "/" or len(token) == 1:
+            prev = token[-1]
+    result.append(data[last:])
+    return "".join(result)
+
+
 class TraverseJson:
     def __init__(
         self,
@@ -160,6 +181,78 @@ class TraverseControls(TraverseJson):
         return data if self.exclude and data.partition("@")[-1] in cfg.exclude_jsonui_names else self.str_fun(data, *args)
 
 
+@dataclass
+class ControlsPass:
+    # One TraverseControls pass, split into what it does to each dict key, when it stops descending and what it does to strings.
+    key_fun: Callable[[str, bool], str] = lambda k, _: k
+    str_fun: Callable[..., str] = obf_str_fun
+    stop_fun: Callable[[dict[str, Any]], set | bool] = lambda _: False
+    exclude: bool = True
+
+
+class TraverseControlsChain:
+    # Runs several TraverseControls passes in one walk. Each node goes through the passes in order, and a subtree is only handed
+    # to the passes that would have reached it on their own, so the result matches running them one after another.
+    def __init__(self, *passes: ControlsPass):
+        self.passes = passes
+
+    def traverse(self, data, output_dict=None):
+        from config import cfg
+
+        self.exclude_names = cfg.exclude_jsonui_names
+        cache_data = self._traverse(
+            json.loads(comment_pattern.sub("", data)) if isinstance(data, str) else data, [(p, ()) for p in self.passes]
+        )
+        return default_dumps(cache_data, indent=2) if isinstance(data, str) and not output_dict else cache_data
+
+    def _traverse(self, data: Any, passes: list[tuple[ControlsPass, tuple]]):
+        if not passes:
+            return data
+
+        if isinstance(data, dict):
+            return self.process_dict(data, passes)
+
+        elif isinstance(data, list):
+            return [self._traverse(v, [(p, (True,)) for p, _ in passes]) for v in data]
+
+        elif isinstance(data, str):
+            for p, args in passes:
+                if not (p.exclude and data.partition("@")[-1] in self.exclude_names):
+                    data = p.str_fun(data, *args)
+
+        return data
+
+    def process_dict(self, data: dict[str, Any], passes: list[tuple[ControlsPass, tuple]]):
+        # [key, value, passes still to run on the value]
+        items = [[k, v, []] for k, v in data.items()]
+        for p, args in passes:
+            is_control = args[0] if args else True
+            current = {i[0]: i for i in items}
+
+            # exclude some keys
+            front = {"namespace": i} if (i := current.get("namespace")) and i[1] else {}
+            for k, i in current.items():
+                if p.exclude and k.partition("@")[0] in self.exclude_names:
+                    front[k] = i
+                if k in NOT_CONTROL_KEYS:
+                    is_control = False
+
+            rest = {k: i for k, i in current.items() if k not in front}
+            stop = p.stop_fun({k: i[1] for k, i in rest.items()})
+            renamed = {}
+            for k, i in rest.items():
+                renamed[p.key_fun(k, is_control)] = i
+
+            items = list(front.values())
+            for k, i in renamed.items():
+                if k not in front:
+                    i[0] = k
+                    if not (stop and (stop == True or k in stop)):
+                        i[2].append((p, (k == "value",)))
+                    items.append(i)
+        return {k: self._traverse(v, pending) for k, v, pending in items}
+
+
 ENUM_LINKS = (
     (OBFStrType.UICONTROL, OBFStrType.UIVARIABLE, OBFStrType.UIBINDIND, OBFStrType.LOCALIZATION),
     (